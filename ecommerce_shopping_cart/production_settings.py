@@ -0,0 +1,82 @@
+"""
+Production settings for ecommerce_shopping_cart project.
+
+Select them with DJANGO_SETTINGS_MODULE=ecommerce_shopping_cart.production_settings.
+They extend the development settings and read deployment specific values
+from the environment:
+
+- DJANGO_SECRET_KEY (required)
+- DJANGO_ALLOWED_HOSTS, a comma separated list of host names
+- DJANGO_CONN_MAX_AGE, seconds a database connection is kept open
+- DJANGO_CART_SHARDS, a comma separated list of the databases holding carts
+- DJANGO_CACHE_LOCATION, directory of the cache shared by the worker processes
+- DJANGO_PASSWORD_HASH_WORKERS, processes hashing passwords in each worker for bulk user provisioning
+- DJANGO_ACTIVE_CART_STORE, 1 to write the changes of the carts being changed behind
+
+See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, REST_FRAMEWORK
+
+SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
+
+# also stops Django from keeping every executed query in connection.queries
+DEBUG = False
+
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get('DJANGO_ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',') if host.strip()]
+
+
+# Database
+# https://docs.djangoproject.com/en/4.2/ref/databases/#persistent-connections
+
+for database in DATABASES.values():
+    database['CONN_MAX_AGE'] = int(os.environ.get('DJANGO_CONN_MAX_AGE', 60))
+    database['CONN_HEALTH_CHECKS'] = True
+
+CART_SHARDS = [alias.strip() for alias in os.environ.get('DJANGO_CART_SHARDS', 'default').split(',') if alias.strip()]
+
+# every gunicorn worker starts its own pool, so keep workers x hash workers near the number of cores
+PASSWORD_HASH_WORKERS = int(os.environ.get('DJANGO_PASSWORD_HASH_WORKERS', 0)) or None
+
+
+# Cache
+# Every worker process must see the same catalog version, so the cache is
+# shared through the file system instead of kept in process memory. Its
+# incr() is not atomic across processes, so search indexes are rebuilt
+# after every catalog change (see shopping_cart.cache.ATOMIC_INCR_BACKENDS).
+
+CACHE_LOCATION = os.environ.get('DJANGO_CACHE_LOCATION', '/tmp/shopping_cart_cache')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_LOCATION,
+    },
+    # when full, the file based cache drops a third of its entries instead of the least recently used ones
+    'user_carts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': f'{CACHE_LOCATION}-user-carts',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # on disk, so that the changes held by the active-cart store outlive a crashed worker
+    'active_carts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': f'{CACHE_LOCATION}-active-carts',
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+}
+
+ACTIVE_CART_STORE = os.environ.get('DJANGO_ACTIVE_CART_STORE', '0') == '1'
+
+
+# Django REST framework
+# Only JSON is rendered; the browsable API is a development tool.
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+}
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shopping_cart.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,11 +78,129 @@ WSGI_APPLICATION = 'ecommerce_shopping_cart.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # django.db.backends.sqlite3 with per-connection PRAGMAs and BEGIN IMMEDIATE
+        'ENGINE': 'shopping_cart.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'pragmas': {
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'mmap_size': 268435456,
+                'cache_size': -64000,
+                'busy_timeout': 5000,
+            },
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# Extra database files carts and cart items can be sharded over
+DATABASES.update({
+    alias: {**DATABASES['default'], 'NAME': BASE_DIR / f'db_{alias}.sqlite3'}
+    for alias in ('carts_1', 'carts_2')
+})
+
+# Databases holding the carts and cart items, picked by user id (see
+# shopping_cart.sharding). Users and items are written to 'default' and
+# copied to the other shards. The list must not change once carts exist.
+CART_SHARDS = ['default']
+
+DATABASE_ROUTERS = ['shopping_cart.sharding.CartShardRouter']
+
+# Retries of cart item writes failing with "database is locked", with
+# exponential backoff starting at DATABASE_LOCK_BACKOFF seconds
+DATABASE_LOCK_RETRIES = 5
+DATABASE_LOCK_BACKOFF = 0.05
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # user id -> cart id, the least recently used entries are dropped first
+    'user_carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'user_carts',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # documents of the active-cart store; an evicted document loses the changes it holds
+    'active_carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'active_carts',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+USER_CART_CACHE = 'user_carts'
+
+# Seconds a cached catalog response (items list, item details, available items) is kept
+CATALOG_CACHE_TIMEOUT = 300
+
+
+# Django REST framework
+# https://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'shopping_cart.pagination.KeysetPagination',
+    'PAGE_SIZE': 100,
+}
+
+# Largest page size a client can ask for with ?page_size=
+MAX_PAGE_SIZE = 1000
+
+# Serve list and retrieve of items, carts and cart items from QuerySet.values()
+# rows instead of the ModelSerializers; the JSON output is the same
+FAST_READ_SERIALIZERS = True
+
+# Rows read from the database at a time by the export endpoints and command
+EXPORT_CHUNK_SIZE = 2000
+
+# Worker processes hashing passwords for bulk user provisioning (POST
+# /api/users/bulk/ and the provision_users command), os.cpu_count() when None
+PASSWORD_HASH_WORKERS = None
+
+# Most users POST /api/users/bulk/ accepts in one request
+MAX_BULK_USERS = 10000
+
+# Most carts POST /api/carts/price_batch/ prices in one request
+MAX_PRICE_BATCH_CARTS = 50000
+
+# Deletions started with DELETE ?mode=background run in a thread of the
+# process (False runs them in the request thread once it commits) and
+# delete the cart items of the deleted object DELETE_CHUNK_SIZE at a time
+BACKGROUND_JOBS = True
+DELETE_CHUNK_SIZE = 500
+
+# Change feed of carts (GET /api/carts/<id>/changes/): longest wait of a
+# long poll (and interval of the keep-alive comments of event streams),
+# seconds between two checks of the cached cart version, most events per
+# response, lifetime of an event stream and of a cached cart version, and
+# the cap on waits and streams served under WSGI, where each holds a worker
+CART_FEED_TIMEOUT = 25
+CART_FEED_POLL_INTERVAL = 0.5
+CART_FEED_MAX_EVENTS = 1000
+CART_FEED_STREAM_SECONDS = 300
+CART_FEED_CACHE_TIMEOUT = 300
+CART_FEED_WSGI_TIMEOUT = 5
+# events older than this many seconds are deleted by the prune_cart_events command
+CART_FEED_RETENTION = 86400
+
+# keep the carts being changed in ACTIVE_CART_CACHE and write their changes behind (see shopping_cart.active_carts)
+ACTIVE_CART_STORE = False
+ACTIVE_CART_CACHE = 'active_carts'
+ACTIVE_CART_FLUSH_AFTER = 30
+ACTIVE_CART_MAX_DELAY = 300
+ACTIVE_CART_TIMEOUT = 3600
+ACTIVE_CART_LOCK_TIMEOUT = 5
+
+# Seconds a cart item of an item with stock holds its units after its last
+# change, before the expire_reservations command removes it from its cart
+STOCK_RESERVATION_TTL = 1800
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
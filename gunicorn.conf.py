@@ -0,0 +1,40 @@
+"""
+Gunicorn configuration for serving ecommerce_shopping_cart.wsgi with
+several worker processes, or ecommerce_shopping_cart.asgi with uvicorn
+workers when GUNICORN_ASGI=1, so that clients waiting on the cart change
+feed hold no worker. Every value can be overridden from the environment,
+e.g. WEB_CONCURRENCY=8.
+"""
+
+import multiprocessing
+import os
+
+if os.environ.get('GUNICORN_ASGI', '0') == '1':
+    wsgi_app = 'ecommerce_shopping_cart.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'ecommerce_shopping_cart.wsgi:application'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# sync workers only; uvicorn workers serve every request from one event loop
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+# recycle workers now and then so a leak in one of them stays bounded
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    # build the catalog search index before the worker takes requests
+    from shopping_cart.search import index
+
+    index.sync()
+
+
+def worker_exit(server, worker):
+    # write the cart changes held by the active-cart store before the worker goes
+    from shopping_cart import active_carts
+
+    if active_carts.enabled():
+        active_carts.flush_idle(everything=True)
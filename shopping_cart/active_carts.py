@@ -0,0 +1,524 @@
+"""
+Active-cart store, an optional write-behind layer for the carts shoppers
+are changing right now (ACTIVE_CART_STORE = True). The first change to a
+cart loads it into a compact document in the ACTIVE_CART_CACHE cache:
+
+    {'id', 'user', 'lines': {item id: [cart item id, quantity]},
+     'prices': {item id: price}, 'catalog': catalog version of the prices,
+     'stocked': {item ids tracking their stock},
+     'flushed': {stocked item id changed since the last flush: its quantity in the database},
+     'dirty': {item ids changed since the last flush},
+     'changed_at': time of the last change, 'dirty_since': time of the first one}
+
+Quantity changes and deletions of cart items (quantity None) are then
+applied to the document only, under a per-cart lock, and reads of the cart
+are served from it. The changes are written to Cart/CartItem in batches,
+one transaction per shard for every cart due, once a cart has been idle for
+ACTIVE_CART_FLUSH_AFTER seconds or has held changes for ACTIVE_CART_MAX_DELAY
+seconds (by a thread of every process, or the persist_carts command), or
+right away with persist(). Creating a cart item still inserts it at once,
+since its id is needed; writes that do not go through the store persist
+and drop the documents of their carts first (see bypass()).
+
+Crash recovery: the carts holding changes are listed in a registry kept
+next to the documents. Flushing writes absolute quantities, so a flush
+interrupted by a crash is repaired by the next one, and locks die with
+their process (file locks) or expire (cache locks). With a cache shared
+by the processes and kept on disk (the file based cache of the production
+settings), the changes held by a crashed process are persisted by the
+flusher of another one or by persist_carts after a restart. Changes whose
+document is lost with the cache (process memory, eviction or clear) are
+lost too: at most ACTIVE_CART_MAX_DELAY seconds of them.
+
+Stock (see reserve()) is taken as soon as a document asks for more units
+than the database holds, and the units the database holds are only given
+back once a flush has written the smaller quantity, so neither a lost
+document nor a lost flush sells a unit twice. The registry keeps the
+units each cart took ahead of the database, which are given back when its
+document is found lost; when the registry is lost with the cache as well,
+so are those units, until the stock is set again.
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import connections, transaction
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from .cache import ACTIVE_CART_KEY, active_cart_cache, get_catalog_version
+from .models import Cart, CartEvent, CartItem, Item, ItemStats
+from .sharding import group_by_shard, shard_for_id
+from .transactions import retry_on_locked
+
+logger = logging.getLogger(__name__)
+
+DIRTY_KEY = 'active-carts:dirty'
+LOCK_KEY = 'active-carts:lock:{}'
+# carts share this many locks, so that the file based cache needs a bounded number of lock files
+LOCK_STRIPES = 1024
+# seconds before the cache lock of a crashed process expires
+LOCK_EXPIRY = 60
+LOCK_POLL_INTERVAL = 0.005
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+class CartLockTimeout(APIException):
+    status_code = 503
+    default_detail = 'The cart is being changed by another request, try again.'
+    default_code = 'cart_locked'
+
+
+def enabled():
+    return getattr(settings, 'ACTIVE_CART_STORE', False)
+
+
+def store_setting(name, default):
+    return getattr(settings, f'ACTIVE_CART_{name}', default)
+
+
+def cart_key(cart_id):
+    return ACTIVE_CART_KEY.format(cart_id)
+
+
+def acquire(name, wait):
+    """
+    Take the named lock and return the function releasing it, or None when
+    another request holds it past ACTIVE_CART_LOCK_TIMEOUT seconds (right
+    away without wait).
+    """
+    store = active_cart_cache()
+    deadline = time.monotonic() + (store_setting('LOCK_TIMEOUT', 5) if wait else 0)
+    if isinstance(store, FileBasedCache):
+        # FileBasedCache.add() is not atomic across processes, flock() is
+        os.makedirs(store._dir, exist_ok=True)
+        fd = os.open(os.path.join(store._dir, f'active-carts-{name}.lock'), os.O_RDWR | os.O_CREAT)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # closing the file releases the lock
+                return lambda: os.close(fd)
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+    key = LOCK_KEY.format(name)
+    while not store.add(key, 1, timeout=LOCK_EXPIRY):
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(LOCK_POLL_INTERVAL)
+    return lambda: store.delete(key)
+
+
+@contextmanager
+def holding(cart_ids, wait=True):
+    """
+    Hold the locks of the given carts and yield the set of the ids held:
+    all of them with wait (or raise CartLockTimeout), the ones no other
+    request holds without.
+    """
+    stripes = {}
+    for cart_id in cart_ids:
+        stripes.setdefault(cart_id % LOCK_STRIPES, []).append(cart_id)
+    releases, held = [], set()
+    try:
+        # always in the same order, so that requests holding several carts never wait on each other in a cycle
+        for stripe in sorted(stripes):
+            release = acquire(stripe, wait)
+            if release is None:
+                if wait:
+                    raise CartLockTimeout()
+                continue
+            releases.append(release)
+            held.update(stripes[stripe])
+        yield held
+    finally:
+        for release in reversed(releases):
+            release()
+
+
+@contextmanager
+def dirty_carts():
+    """
+    The registry of the carts holding changes, {cart id: time of the first
+    change}, saved on exit. Taken after the locks of the carts, never before.
+    """
+    release = acquire('dirty', wait=True)
+    if release is None:
+        raise CartLockTimeout()
+    try:
+        store = active_cart_cache()
+        dirty = store.get(DIRTY_KEY, {})
+        yield dirty
+        store.set(DIRTY_KEY, dirty, timeout=None)
+    finally:
+        release()
+
+
+def save(doc):
+    # documents holding changes never expire, the others make way after ACTIVE_CART_TIMEOUT seconds
+    timeout = None if doc['dirty'] else store_setting('TIMEOUT', 3600)
+    active_cart_cache().set(cart_key(doc['id']), doc, timeout=timeout)
+
+
+def load(cart_id):
+    """
+    The document of a cart read from the database. Raises Cart.DoesNotExist.
+    """
+    shard = shard_for_id(cart_id)
+    catalog = get_catalog_version()
+    user_id = Cart.objects.using(shard).filter(pk=cart_id).values_list('user', flat=True).first()
+    if user_id is None:
+        raise Cart.DoesNotExist(f'Cart {cart_id} does not exist')
+    doc = {'id': cart_id, 'user': user_id, 'lines': {}, 'prices': {}, 'stocked': set(), 'flushed': {}, 'catalog': catalog,
+           'dirty': set(), 'changed_at': None, 'dirty_since': None}
+    lines = CartItem.objects.using(shard).filter(cart=cart_id).values_list('item', 'id', 'quantity', 'item__price', 'item__stock')
+    for item_id, pk, quantity, price, stock in lines:
+        doc['lines'][item_id] = [pk, quantity]
+        doc['prices'][item_id] = price
+        if stock is not None:
+            doc['stocked'].add(item_id)
+    return doc
+
+
+def reprice(doc):
+    """
+    Read the prices of the items of the cart again when the catalog changed
+    since they were read, dropping the cart items of deleted items, and
+    which of them track their stock.
+    """
+    catalog = get_catalog_version()
+    if doc['catalog'] == catalog:
+        return
+    rows = []
+    if doc['lines']:
+        rows = Item.objects.using(shard_for_id(doc['id'])).filter(pk__in=list(doc['lines'])).values_list('id', 'price', 'stock')
+    prices, stocked = {}, set()
+    for item_id, price, stock in rows:
+        prices[item_id] = price
+        if stock is not None:
+            stocked.add(item_id)
+    for item_id in set(doc['lines']) - set(prices):
+        # the database deleted them with the item
+        del doc['lines'][item_id]
+        doc['dirty'].discard(item_id)
+        doc.get('flushed', {}).pop(item_id, None)
+    doc['prices'] = prices
+    doc['stocked'] = stocked
+    doc['catalog'] = catalog
+
+
+def read(cart_id):
+    """
+    The document of the cart, or None when the store does not hold it.
+    """
+    doc = active_cart_cache().get(cart_key(cart_id))
+    if doc is not None:
+        reprice(doc)
+    return doc
+
+
+def line(cart_id, item_id):
+    """
+    The [cart item id, quantity] held for the given cart and item, quantity
+    None for a deleted cart item, or None when the store does not hold it.
+    """
+    doc = active_cart_cache().get(cart_key(cart_id))
+    return None if doc is None else doc['lines'].get(item_id)
+
+
+def cart_rows(doc):
+    """
+    The cart of a document as a CartValuesSerializer row, and its cart
+    items as CartItemValuesSerializer rows.
+    """
+    lines = sorted((pk, item_id, quantity) for item_id, (pk, quantity) in doc['lines'].items() if quantity is not None)
+    items = [{'id': pk, 'cart_id': doc['id'], 'item_id': item_id, 'quantity': quantity} for pk, item_id, quantity in lines]
+    total = sum((doc['prices'][item_id] * quantity for _, item_id, quantity in lines), Decimal('0'))
+    return {'id': doc['id'], 'user_id': doc['user'], 'running_total': total, 'item_count': len(items)}, items
+
+
+@contextmanager
+def changing(cart_id):
+    """
+    Hold the lock of the cart and yield its document, loading it first,
+    then save it and register it when it started holding changes.
+    """
+    with holding([cart_id]):
+        doc = active_cart_cache().get(cart_key(cart_id)) or load(cart_id)
+        reprice(doc)
+        was_dirty, ahead = bool(doc['dirty']), stock_ahead(doc)
+        yield doc
+        save(doc)
+        if doc['dirty'] and (not was_dirty or stock_ahead(doc) != ahead):
+            # after the document is saved, so that the registry never lists a cart without one
+            with dirty_carts() as dirty:
+                lost = None if was_dirty else dirty.get(cart_id)
+                dirty[cart_id] = [doc['dirty_since'], stock_ahead(doc)]
+            if lost is not None:
+                # registered by a document lost before the one loaded here
+                Item.objects.release(lost[1])
+            start_flusher()
+
+
+def changed(doc, item_id):
+    now = time.time()
+    doc['dirty'].add(item_id)
+    doc['changed_at'] = now
+    if doc['dirty_since'] is None:
+        doc['dirty_since'] = now
+
+
+def add_quantity(cart_id, item_id, quantity):
+    """
+    CartItemQuerySet.add_quantity() on the document of the cart. Returns
+    (cart item row, created); the row is None when no cart item is left.
+    Raises Cart.DoesNotExist or Item.DoesNotExist like add_quantity().
+    """
+    with changing(cart_id) as doc:
+        current = doc['lines'].get(item_id)
+        if current is None:
+            # a new cart item is inserted right away, for its id
+            cart_item, created = CartItem.objects.add_quantity(cart_id, item_id, quantity)
+            if cart_item is None:
+                return None, False
+            doc['lines'][item_id] = current = [cart_item.pk, cart_item.quantity]
+            doc['prices'][item_id], stock = Item.objects.using(cart_item._state.db).filter(pk=item_id).values_list('price', 'stock').get()
+            if stock is not None:
+                doc.setdefault('stocked', set()).add(item_id)
+        else:
+            pk, held = current
+            created = held is None
+            if held is None:
+                if quantity <= 0:
+                    return None, False
+                new = quantity
+            elif quantity < 0 and held + quantity <= 0:
+                new = None
+            else:
+                new = held + quantity
+            reserve(doc, item_id, held, new)
+            current[1] = new
+            changed(doc, item_id)
+    if current[1] is None:
+        return None, False
+    return {'id': current[0], 'cart_id': cart_id, 'item_id': item_id, 'quantity': current[1]}, created
+
+
+def set_quantity(cart_id, item_id, quantity):
+    """
+    Set the quantity of the cart item of the given cart and item in the
+    document of the cart, None deleting it. Returns False when there is no such cart item.
+    """
+    with changing(cart_id) as doc:
+        current = doc['lines'].get(item_id)
+        if current is None or current[1] is None:
+            return False
+        reserve(doc, item_id, current[1], quantity)
+        current[1] = quantity
+        changed(doc, item_id)
+    return True
+
+
+def reserve(doc, item_id, held, quantity):
+    """
+    Follow a change of the quantity of a stocked item from held to quantity
+    in the stock right away, as there is no transaction to join. Until the
+    change is flushed the stock holds the larger of the quantity of the
+    document and the one of the database, whichever of them wins.
+    """
+    if item_id not in doc.get('stocked', ()):
+        return
+    flushed = doc.setdefault('flushed', {}).setdefault(item_id, held or 0)
+    delta = max(flushed, quantity or 0) - max(flushed, held or 0)
+    if delta > 0:
+        Item.objects.reserve(item_id, delta)
+    elif delta < 0:
+        Item.objects.release({item_id: -delta})
+
+
+def stock_ahead(doc):
+    """
+    {item id: units} the document took from the stock above the quantities of the database.
+    """
+    return {item_id: units for item_id, flushed in doc.get('flushed', {}).items()
+            if (units := (doc['lines'][item_id][1] or 0) - flushed) > 0}
+
+
+def stock_behind(doc):
+    """
+    {item id: units} the database holds above the quantities of the document, to give back once they are flushed.
+    """
+    return {item_id: units for item_id, flushed in doc.get('flushed', {}).items()
+            if (units := flushed - (doc['lines'][item_id][1] or 0)) > 0}
+
+
+@retry_on_locked
+def flush(cart_ids):
+    """
+    Write the changes held for the given carts, whose locks are held, to
+    the database: for each shard, one transaction deleting, updating and
+    counting the cart items of every cart with a few queries. Returns the
+    number of cart items written.
+    """
+    store = active_cart_cache()
+    docs = {doc['id']: doc for doc in store.get_many([cart_key(cart_id) for cart_id in cart_ids]).values()}
+    pending = {cart_id: doc for cart_id, doc in docs.items() if doc['dirty']}
+    written = 0
+    for shard, shard_cart_ids in group_by_shard(pending).items():
+        with transaction.atomic(using=shard):
+            existing = set(Cart.objects.using(shard).filter(pk__in=shard_cart_ids).values_list('id', flat=True))
+            deleted, updated, changes = [], [], []
+            for cart_id in existing:
+                for item_id in pending[cart_id]['dirty']:
+                    pk, quantity = pending[cart_id]['lines'][item_id]
+                    if quantity is None:
+                        deleted.append(pk)
+                        changes.append((cart_id, CartEvent.DELETED, pk, item_id, 0))
+                    else:
+                        updated.append(CartItem(pk=pk, quantity=quantity, reserved_at=timezone.now()))
+                        changes.append((cart_id, CartEvent.UPDATED, pk, item_id, quantity))
+            # the writes below bypass CartItem.save()/delete(), so count the lines out of the item counters and back in
+            written_lines = CartItem.objects.using(shard).filter(pk__in=deleted + [line.pk for line in updated])
+            ItemStats.objects.using(shard).count_lines(written_lines, -1)
+            if deleted:
+                CartItem.objects.using(shard).filter(pk__in=deleted).delete()
+            if updated:
+                # the stock was reserved when the quantities changed in the documents
+                CartItem.objects.using(shard).bulk_update(updated, ['quantity', 'reserved_at'])
+            ItemStats.objects.using(shard).count_lines(written_lines)
+            Cart.objects.using(shard).filter(pk__in=existing).refresh_totals()
+            CartEvent.objects.using(shard).append(changes)
+        written += len(changes)
+        returned = {}
+        for cart_id in shard_cart_ids:
+            doc = pending[cart_id]
+            if cart_id not in existing:
+                # deleted with its user, which gave back the units of its cart items but not the ones taken ahead of them
+                units = stock_ahead(doc)
+                store.delete(cart_key(cart_id))
+            else:
+                # the database no longer holds the units the documents gave up
+                units = stock_behind(doc)
+                doc['lines'] = {item_id: current for item_id, current in doc['lines'].items() if current[1] is not None}
+                doc['flushed'] = {}
+                doc['dirty'] = set()
+                doc['dirty_since'] = None
+                save(doc)
+            for item_id, quantity in units.items():
+                returned[item_id] = returned.get(item_id, 0) + quantity
+        # after the documents are saved, so that a crash in between leaves units unsold rather than given back twice
+        Item.objects.release(returned)
+    if pending:
+        with dirty_carts() as dirty:
+            for cart_id in pending:
+                dirty.pop(cart_id, None)
+    return written
+
+
+def persist(cart_ids):
+    """
+    Write the changes held for the given carts to the database now.
+    Returns the number of cart items written.
+    """
+    cart_ids = {cart_id for cart_id in cart_ids if cart_id is not None}
+    if not enabled() or not cart_ids:
+        return 0
+    docs = active_cart_cache().get_many([cart_key(cart_id) for cart_id in cart_ids]).values()
+    dirty = [doc['id'] for doc in docs if doc['dirty']]
+    if not dirty:
+        return 0
+    with holding(dirty) as held:
+        return flush(held)
+
+
+@contextmanager
+def bypass(cart_ids):
+    """
+    Wrap a write to the cart items of the given carts that does not go
+    through the store: their changes are persisted and their documents
+    dropped first, and the carts stay locked until the write is done so
+    that no document is loaded from the rows being written.
+    """
+    cart_ids = {cart_id for cart_id in cart_ids if cart_id is not None}
+    if not enabled() or not cart_ids:
+        yield
+        return
+    with holding(cart_ids):
+        flush(cart_ids)
+        active_cart_cache().delete_many([cart_key(cart_id) for cart_id in cart_ids])
+        yield
+
+
+def flush_idle(everything=False):
+    """
+    Persist, in one batch, the carts idle for ACTIVE_CART_FLUSH_AFTER
+    seconds or holding changes for ACTIVE_CART_MAX_DELAY seconds, skipping
+    the ones a request holds; with everything, every cart holding changes,
+    waiting for their locks. Returns the number of carts persisted.
+    """
+    store = active_cart_cache()
+    registered = store.get(DIRTY_KEY, {})
+    if not registered:
+        return 0
+    docs = store.get_many([cart_key(cart_id) for cart_id in registered])
+    idle_since = time.time() - store_setting('FLUSH_AFTER', 30)
+    held_since = time.time() - store_setting('MAX_DELAY', 300)
+    due, lost = [], []
+    for cart_id in registered:
+        doc = docs.get(cart_key(cart_id))
+        if doc is None:
+            lost.append(cart_id)
+        elif everything or doc['changed_at'] <= idle_since or doc['dirty_since'] <= held_since:
+            due.append(cart_id)
+    if lost:
+        logger.warning('Changes to carts %s were lost with their documents before being persisted', lost)
+        returned = {}
+        with holding(lost, wait=everything) as held, dirty_carts() as dirty:
+            for cart_id in held:
+                entry = dirty.pop(cart_id, None)
+                # a cart changed again since has a new document
+                if entry is not None and active_cart_cache().get(cart_key(cart_id)) is None:
+                    for item_id, units in entry[1].items():
+                        returned[item_id] = returned.get(item_id, 0) + units
+        # the stock taken ahead of the database by the lost changes
+        Item.objects.release(returned)
+    with holding(due, wait=everything) as held:
+        if held:
+            flush(held)
+    return len(held)
+
+
+def start_flusher():
+    """
+    Start the thread persisting the idle carts of every process, once per
+    process (unless BACKGROUND_JOBS is off: then only persist_carts does).
+    """
+    global _flusher
+    if not getattr(settings, 'BACKGROUND_JOBS', True):
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=run_flusher, name='active-carts', daemon=True)
+            _flusher.start()
+
+
+def run_flusher():
+    while True:
+        time.sleep(max(1, store_setting('FLUSH_AFTER', 30) / 2))
+        try:
+            flush_idle()
+        except Exception:
+            logger.exception('Persisting the active carts failed')
+        finally:
+            # the connections of this thread are not closed at the end of any request
+            connections.close_all()
@@ -1,6 +1,30 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 
 
 class ShoppingCartConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shopping_cart'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+
+        from .cache import forget_deleted_cart, forget_deleted_user_cart
+        from .models import Cart, Item, release_deleted_cart
+        from .search import item_deleted, item_saved
+        from .sharding import replicate_deleted, replicate_saved, reserve_id_ranges
+
+        # users and items are copied to every cart shard
+        for model in (User, Item):
+            post_save.connect(replicate_saved, sender=model, dispatch_uid=f'replicate_saved_{model._meta.label_lower}')
+            post_delete.connect(replicate_deleted, sender=model, dispatch_uid=f'replicate_deleted_{model._meta.label_lower}')
+        post_migrate.connect(reserve_id_ranges, sender=self)
+        # keep the search index of this process up to date
+        post_save.connect(item_saved, sender=Item, dispatch_uid='search_item_saved')
+        post_delete.connect(item_deleted, sender=Item, dispatch_uid='search_item_deleted')
+        # deleting a user deletes its cart without going through Cart.delete()
+        post_delete.connect(forget_deleted_user_cart, sender=User, dispatch_uid='forget_deleted_user_cart')
+        # drop the change feed version and the active-cart document of deleted carts
+        post_delete.connect(forget_deleted_cart, sender=Cart, dispatch_uid='forget_deleted_cart')
+        # and give back the stock of their cart items and take them out of the item counters
+        pre_delete.connect(release_deleted_cart, sender=Cart, dispatch_uid='release_deleted_cart')
@@ -0,0 +1,230 @@
+"""
+Endpoint benchmark used by the benchmark command, with the number of SQL
+queries each endpoint is allowed to run. The budgets are enforced by
+QueryBudgetTest, so an N+1 query in a view or serializer fails the tests.
+"""
+import json
+import random
+import statistics
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .cache import catalog_changed, user_cart_cache
+from .models import Cart, CartItem, Item, ItemStats
+from .sharding import group_by_shard, on_shards, replicate_ids, shard_for_user
+
+
+class Endpoint:
+    """
+    A request to time. path and data are formatted with the ids of the
+    seeded rows, plus the ones returned by prepare(ids, n), which creates
+    the rows a single iteration needs (for example the row it deletes).
+    """
+
+    def __init__(self, method, path, budget, data=None, prepare=None):
+        self.method = method
+        self.path = path
+        self.budget = budget
+        self.data = data
+        self.prepare = prepare
+
+    @property
+    def name(self):
+        return f'{self.method.upper()} {self.path}'
+
+    def build(self, ids, n):
+        """
+        Return the path and client keyword arguments of the n-th request.
+        """
+        if self.prepare is not None:
+            ids = {**ids, **self.prepare(ids, n)}
+        kwargs = {}
+        if self.data is not None:
+            kwargs = {'data': json.dumps(_format(self.data, ids)), 'content_type': 'application/json'}
+        return self.path.format(**ids), kwargs
+
+
+def _format(data, ids):
+    if isinstance(data, dict):
+        return {key: _format(value, ids) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_format(value, ids) for value in data]
+    if isinstance(data, str):
+        value = data.format(**ids)
+        return int(value) if value.isdigit() else value
+    return data
+
+
+def _new_user(ids, n):
+    return {'new_user': User.objects.create(username=f'benchmark-user-{n}-{time.time_ns()}', password='!').id}
+
+
+def _new_cart(ids, n):
+    user = _new_user(ids, n)['new_user']
+    return {'new_user': user, 'new_cart': Cart.objects.create(user_id=user).id}
+
+
+def _new_item(ids, n):
+    return {'new_item': Item.objects.create(name=f'benchmark item {n}', description='benchmark', price='1.00').id}
+
+
+def _new_cart_item(ids, n):
+    item = _new_item(ids, n)['new_item']
+    return {'new_item': item, 'new_cart_item': CartItem.objects.create(cart_id=ids['cart'], item_id=item, quantity=1).id}
+
+
+def _unique(ids, n):
+    return {'unique': f'{n}-{time.time_ns()}'}
+
+
+# every endpoint of the README, with the most queries it may run, counting
+# transaction statements (savepoints under tests, BEGIN under autocommit)
+ENDPOINTS = [
+    Endpoint('get', '/api/users/', 1),
+    Endpoint('get', '/api/users/{user}/', 1),
+    Endpoint('get', '/api/users/available_items/', 1),
+    Endpoint('get', '/api/admin/items/', 1),
+    Endpoint('get', '/api/admin/items/{item}/', 1),
+    Endpoint('get', '/api/admin/items/?fields=id,name,price', 1),
+    Endpoint('get', '/api/admin/items/?ids={item},{new_item}', 1, prepare=_new_item),
+    Endpoint('get', '/api/admin/items/export/?format=ndjson', 1),
+    Endpoint('get', '/api/admin/items/stats/?ordering=reserved_value', 1),
+    Endpoint('get', '/api/admin/items/{item}/stock/', 1),
+    # builds the search index when the catalog changed
+    Endpoint('get', '/api/items/search?q=item+1&max_price=500', 1),
+    Endpoint('get', '/api/carts/', 2),
+    # without the items of the carts, which need a second query
+    Endpoint('get', '/api/carts/?fields=id,user,total_cost', 1),
+    Endpoint('get', '/api/carts/?user={user}', 2),
+    Endpoint('get', '/api/carts/{cart}/', 2),
+    Endpoint('get', '/api/carts/{cart}/?expand=item', 2),
+    Endpoint('get', '/api/carts/?ids={cart},{new_cart}', 2, prepare=_new_cart),
+    Endpoint('get', '/api/carts/{cart}/total_cost/', 1),
+    Endpoint('get', '/api/carts/cart_id/?user={user}', 1),
+    Endpoint('get', '/api/carts/export/?format=csv', 1),
+    Endpoint('get', '/api/cartitems/', 1),
+    Endpoint('get', '/api/cartitems/?user={user}', 1),
+    Endpoint('get', '/api/cartitems/?cart={cart}', 1),
+    Endpoint('get', '/api/cartitems/?cart={cart}&expand=item', 1),
+    Endpoint('get', '/api/cartitems/{cart_item}/', 1),
+    Endpoint('get', '/api/cartitems/export/?format=ndjson', 1),
+    Endpoint('post', '/api/users/', 2, data={'username': 'benchmark-{unique}', 'password': 'benchmark-password'}, prepare=_unique),
+    Endpoint('put', '/api/users/{new_user}/', 3, data={'username': 'benchmark-{unique}', 'password': 'benchmark-password'},
+             prepare=lambda ids, n: {**_new_user(ids, n), **_unique(ids, n)}),
+    Endpoint('patch', '/api/users/{new_user}/', 3, data={'username': 'benchmark-{unique}'},
+             prepare=lambda ids, n: {**_new_user(ids, n), **_unique(ids, n)}),
+    Endpoint('delete', '/api/users/{new_user}/', 8, prepare=_new_user),
+    Endpoint('delete', '/api/users/{new_user}/?mode=background', 6, prepare=_new_cart),
+    Endpoint('post', '/api/users/bulk/?carts=true', 7, data=[{'username': f'benchmark-{{unique}}-{n}', 'password': 'benchmark-password'} for n in range(3)],
+             prepare=_unique),
+    Endpoint('post', '/api/admin/items/', 3, data={'name': 'New Item', 'description': 'New description', 'price': '29.99'}),
+    Endpoint('put', '/api/admin/items/{new_item}/', 7, data={'name': 'Updated Item', 'description': 'Updated', 'price': '39.99'},
+             prepare=_new_item),
+    Endpoint('patch', '/api/admin/items/{new_item}/', 7, data={'price': '19.99'}, prepare=_new_item),
+    Endpoint('delete', '/api/admin/items/{new_item}/', 8, prepare=_new_item),
+    # hides the item and queues the job deleting its cart items chunk by chunk
+    Endpoint('delete', '/api/admin/items/{new_item}/?mode=background', 7, prepare=_new_cart_item),
+    Endpoint('post', '/api/carts/', 4, data={'user': '{new_user}'}, prepare=_new_user),
+    # gives back the stock held by the cart items of the cart
+    Endpoint('delete', '/api/carts/{new_cart}/', 7, prepare=_new_cart),
+    # the prices of every item of the batch in one query
+    Endpoint('post', '/api/carts/price_batch/', 1, data=[[['{item}', 2], ['{new_item}', 1]], [['{item}', 5]]], prepare=_new_item),
+    # cart item writes also number and insert their change feed events (2 queries), update
+    # the counters of their item (1 query, 3 for the first cart item of an item on a shard)
+    # and reserve or give back its stock (1 conditional UPDATE per item)
+    Endpoint('post', '/api/cartitems/', 13, data={'cart': '{cart}', 'item': '{new_item}', 'quantity': 5}, prepare=_new_item),
+    Endpoint('post', '/api/cartitems/', 14, data={'user': '{user}', 'item': '{new_item}', 'quantity': 5}, prepare=_new_item),
+    Endpoint('post', '/api/cartitems/add/', 9, data={'cart': '{cart}', 'item': '{item}', 'quantity': 1}),
+    Endpoint('post', '/api/cartitems/bulk/', 16, data=[{'cart': '{cart}', 'item': '{item}', 'quantity': 2}, {'user': '{user}', 'item': '{new_item}', 'quantity': 1}],
+             prepare=_new_item),
+    Endpoint('patch', '/api/cartitems/{cart_item}/', 13, data={'quantity': 3}),
+    Endpoint('delete', '/api/cartitems/{new_cart_item}/', 10, prepare=_new_cart_item),
+]
+
+
+def seed(items, users, cart_items, batch_size=5000, random_seed=0):
+    """
+    Fill the database with items, users with one cart each and cart items
+    spread over the carts, and return the ids used by the endpoints.
+    """
+    rng = random.Random(random_seed)
+    last_item = Item.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    last_user = User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    Item.objects.bulk_create(
+        (Item(name=f'item {n}', description=f'description of item {n}', price=f'{rng.randint(100, 99999) / 100:.2f}') for n in range(items)),
+        batch_size=batch_size,
+    )
+    catalog_changed()
+    password = make_password('benchmark-password')
+    User.objects.bulk_create((User(username=f'user {last_user + n}', password=password) for n in range(users)), batch_size=batch_size)
+    user_ids = list(User.objects.filter(pk__gt=last_user).order_by('pk').values_list('id', flat=True))
+    item_ids = list(Item.objects.filter(pk__gt=last_item).order_by('pk').values_list('id', flat=True))
+    # bulk_create skips the signals copying users and items to the cart shards
+    replicate_ids(User, user_ids)
+    replicate_ids(Item, item_ids)
+    for shard, shard_user_ids in group_by_shard(user_ids, shard_for_user).items():
+        Cart.objects.using(shard).bulk_create((Cart(user_id=user_id) for user_id in shard_user_ids), batch_size=batch_size)
+    cart_ids = list(on_shards(Cart.objects.filter(user__gt=last_user).order_by('pk')).values_list('id', flat=True))
+
+    def lines(shard_cart_ids):
+        for cart_id in shard_cart_ids:
+            start = rng.randrange(len(item_ids))
+            count = min(per_cart + (cart_id in extra), len(item_ids))
+            for offset in range(count):
+                yield CartItem(cart_id=cart_id, item_id=item_ids[(start + offset) % len(item_ids)], quantity=rng.randint(1, 5))
+
+    if cart_ids and item_ids:
+        per_cart, remainder = divmod(cart_items, len(cart_ids))
+        # the first carts get one line more when the lines do not divide evenly
+        extra = set(cart_ids[:remainder])
+        for shard, shard_cart_ids in group_by_shard(cart_ids).items():
+            CartItem.objects.using(shard).bulk_create(lines(shard_cart_ids), batch_size=batch_size)
+            Cart.objects.using(shard).filter(pk__in=shard_cart_ids).refresh_totals()
+            ItemStats.objects.using(shard).count_lines(CartItem.objects.using(shard).filter(cart__in=shard_cart_ids))
+    cart_item = on_shards(CartItem.objects.filter(cart__user__gt=last_user).order_by('pk')).values('id', 'cart', 'cart__user', 'item').first()
+    return {'user': cart_item['cart__user'], 'cart': cart_item['cart'], 'item': cart_item['item'], 'cart_item': cart_item['id']}
+
+
+def count_rows(response):
+    if response.streaming:
+        return b''.join(response.streaming_content).count(b'\n')
+    data = getattr(response, 'data', None)
+    if isinstance(data, dict) and isinstance(data.get('results'), list):
+        return len(data['results'])
+    if isinstance(data, dict) and isinstance(data.get('available_items'), list):
+        return len(data['available_items'])
+    return 1
+
+
+def measure(client, endpoint, ids, iterations=20, clear_cache=False):
+    """
+    Run the endpoint iterations times and return the most queries run by
+    a single request, the p50/p95 latency in milliseconds and rows/s.
+    """
+    samples = []
+    queries = rows = 0
+    for n in range(iterations):
+        if clear_cache:
+            cache.clear()
+            user_cart_cache().clear()
+        path, kwargs = endpoint.build(ids, n)
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = getattr(client, endpoint.method)(path, **kwargs)
+            rows += count_rows(response)
+            samples.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise AssertionError(f'{endpoint.name} returned {response.status_code}')
+        queries = max(queries, len(context.captured_queries))
+    samples.sort()
+    return {
+        'queries': queries,
+        'p50': statistics.median(samples) * 1000,
+        'p95': samples[min(len(samples) - 1, round(0.95 * (len(samples) - 1)))] * 1000,
+        'rows_per_second': rows / sum(samples),
+    }
@@ -0,0 +1,145 @@
+import hashlib
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = 'catalog:version'
+USER_CART_KEY = 'user-cart:{}'
+CART_FEED_KEY = 'cart-feed:{}'
+ACTIVE_CART_KEY = 'active-cart:{}'
+
+# the last catalog versions handed out by this process for changes that
+# its Item signals applied to its search index
+local_catalog_versions = deque(maxlen=1024)
+
+# cache backends whose incr() never hands out a version twice to the
+# processes sharing them (a LocMemCache is only shared by the threads of
+# one process, under its lock); the file based and database caches read
+# and write back the value, so two processes can bump to the same version
+ATOMIC_INCR_BACKENDS = {'LocMemCache', 'RedisCache', 'PyMemcacheCache', 'PyLibMCCache'}
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # start from the clock so that a cleared cache never hands out a version (and ETag) again
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def catalog_versions_are_unique():
+    return type(caches['default']).__name__ in ATOMIC_INCR_BACKENDS
+
+
+def bump_catalog_version(signalled=False):
+    try:
+        version = cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+    # a version another process may have bumped to as well does not say the change was only ours
+    if signalled and catalog_versions_are_unique():
+        local_catalog_versions.append(version)
+
+
+def catalog_changed_locally(since, version):
+    """
+    Whether every catalog version after since, up to version, was handed
+    out by this process for a change its signals applied.
+    """
+    if not since < version <= since + local_catalog_versions.maxlen:
+        return False
+    local = set(local_catalog_versions)
+    return all(number in local for number in range(since + 1, version + 1))
+
+
+def catalog_changed(signalled=False):
+    """
+    Invalidate every cached catalog response. The version is bumped right
+    away so the current request never reads stale data, and again on
+    commit so that a response cached by another request between the
+    write and the commit is not served either. signalled says the change
+    went through the Item signals, which update the search index of this
+    process in place; other changes (bulk writes) make it rebuild.
+    """
+    bump_catalog_version(signalled)
+    transaction.on_commit(lambda: bump_catalog_version(signalled))
+
+
+def cached_catalog_response(request, name, build):
+    """
+    Serve the catalog data returned by build() from the cache, keyed on
+    the catalog version and the request path. Requests whose If-None-Match
+    matches the current ETag get a 304 without touching the database.
+    """
+    version = get_catalog_version()
+    digest = hashlib.sha1(f'{request.get_full_path()}|{request.accepted_media_type}'.encode()).hexdigest()[:16]
+    etag = f'"{name}-{version}-{digest}"'
+    tags = parse_etags(request.headers.get('If-None-Match', ''))
+    if '*' in tags or etag in [tag.removeprefix('W/') for tag in tags]:
+        return Response(status=304, headers={'ETag': etag})
+
+    key = f'catalog:{version}:{name}:{digest}'
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, timeout=getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300))
+    return Response(data, headers={'ETag': etag})
+
+
+def publish_cart_versions(versions):
+    """
+    Record the latest change feed version of the given carts, which long
+    polls and event streams wait on without querying the database.
+    """
+    timeout = getattr(settings, 'CART_FEED_CACHE_TIMEOUT', 300)
+    cache.set_many({CART_FEED_KEY.format(cart_id): version for cart_id, version in versions.items()}, timeout=timeout)
+
+
+def forget_cart_feeds(*cart_ids):
+    keys = [CART_FEED_KEY.format(cart_id) for cart_id in cart_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def active_cart_cache():
+    """
+    The cache holding the documents of the active-cart store (see shopping_cart.active_carts).
+    """
+    return caches[getattr(settings, 'ACTIVE_CART_CACHE', 'active_carts')]
+
+
+def forget_deleted_cart(sender, instance, using, **kwargs):
+    # carts are also deleted with their user or by queryset, without going through Cart.delete()
+    forget_cart_feeds(instance.pk)
+    forget_user_carts(instance.user_id, using=using)
+    if getattr(settings, 'ACTIVE_CART_STORE', False):
+        key = ACTIVE_CART_KEY.format(instance.pk)
+        transaction.on_commit(lambda: active_cart_cache().delete(key), using=using)
+
+
+def user_cart_cache():
+    """
+    The cache holding the cart id of each user, bounded by its MAX_ENTRIES.
+    """
+    return caches[getattr(settings, 'USER_CART_CACHE', 'default')]
+
+
+def forget_user_carts(*user_ids, using=None):
+    """
+    Drop the cached cart ids of the given users, right away and again on
+    commit (of the database using), so that a lookup racing with the write
+    cannot cache the old cart.
+    """
+    keys = [USER_CART_KEY.format(user_id) for user_id in user_ids if user_id is not None]
+    user_cart_cache().delete_many(keys)
+    transaction.on_commit(lambda: user_cart_cache().delete_many(keys), using=using)
+
+
+def forget_deleted_user_cart(sender, instance, **kwargs):
+    forget_user_carts(instance.pk)
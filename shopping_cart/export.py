@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Item, Cart, CartItem
+
+# output column -> model field, per exported model
+EXPORT_COLUMNS = {
+    'items': (Item, {'id': 'id', 'name': 'name', 'description': 'description', 'price': 'price', 'sku': 'sku'}),
+    'carts': (Cart, {'id': 'id', 'user': 'user', 'total_cost': 'running_total', 'item_count': 'item_count'}),
+    'cartitems': (CartItem, {'id': 'id', 'cart': 'cart', 'item': 'item', 'quantity': 'quantity'}),
+}
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+def export_rows(queryset, columns, chunk_size=None):
+    """
+    Yield one dict per row of the queryset, reading chunk_size rows at a
+    time from the database so memory stays flat however many rows there are.
+    """
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+    names = list(columns)
+    rows = queryset.order_by('pk').values_list(*columns.values())
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(names, row))
+
+
+def export_lines(queryset, columns, export_format, chunk_size=None):
+    """
+    Yield the rows of the queryset as NDJSON or CSV text lines.
+    """
+    rows = export_rows(queryset, columns, chunk_size)
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+    elif export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(columns))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # header only when there are no rows
+        yield buffer.getvalue()
+    else:
+        raise ValueError(f"Unknown export format '{export_format}'")
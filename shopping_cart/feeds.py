@@ -0,0 +1,239 @@
+"""
+Change feed of a cart, so that clients stop polling the whole cart. Every
+cart item write appends a CartEvent numbered by the version of its cart
+and, on commit, records that version in the cache (see
+CartEventQuerySet.append). The views below wait for the cached version to
+move past the one the client has seen, then read the new events, so a
+client waiting on an idle cart costs cache reads but no database query.
+
+They are async views: served by the ASGI application (asgi.py, see
+gunicorn.conf.py) a waiting client holds no thread. A WSGI server holds a
+worker for every waiting client and reads an async stream whole before
+sending it, so under WSGI waits and streams end after
+CART_FEED_WSGI_TIMEOUT seconds and streams are served by a sync iterator
+(stream_changes_sync); clients then simply poll again or reconnect.
+
+Events older than CART_FEED_RETENTION seconds are deleted by
+prune_events() (the prune_cart_events command), except the last event of
+each cart, which keeps its version counting; a client that missed pruned
+events is told to reload the cart.
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .cache import CART_FEED_KEY
+from .models import Cart, CartEvent
+from .serializers import CartEventValuesSerializer
+from .jobs import delete_chunk_size
+from .sharding import cart_shards, shard_for_id
+from .transactions import retry_on_locked
+
+
+def feed_setting(name, default):
+    return getattr(settings, f'CART_FEED_{name}', default)
+
+
+def prune_events(retention=None):
+    """
+    Delete the events older than retention seconds (CART_FEED_RETENTION by
+    default) but the last one of each cart, a chunk at a time. Returns the
+    number of events deleted.
+    """
+    seconds = feed_setting('RETENTION', 86400) if retention is None else retention
+    cutoff = timezone.now() - timedelta(seconds=seconds)
+    pruned = 0
+    for alias in cart_shards():
+        while count := prune_chunk(alias, cutoff):
+            pruned += count
+    return pruned
+
+
+@retry_on_locked
+def prune_chunk(alias, cutoff):
+    """
+    Delete up to DELETE_CHUNK_SIZE events of the shard created before
+    cutoff and followed by a newer event of their cart. Returns the number
+    of events deleted.
+    """
+    events = CartEvent.objects.using(alias)
+    last = events.filter(cart=OuterRef('cart')).order_by('-version').values('version')[:1]
+    with transaction.atomic(using=alias):
+        pks = list(events.filter(created_at__lt=cutoff, version__lt=Subquery(last)).values_list('pk', flat=True)[:delete_chunk_size()])
+        return events.filter(pk__in=pks)._raw_delete(alias) if pks else 0
+
+
+async def current_version(cart_id, shard):
+    """
+    The version of the cart from the cache, or from the database (once,
+    until the next write publishes a new one). Raises Http404 for a missing cart.
+    """
+    key = CART_FEED_KEY.format(cart_id)
+    version = await cache.aget(key)
+    if version is None:
+        if not await Cart.objects.using(shard).filter(pk=cart_id).aexists():
+            raise Http404(f'Cart {cart_id} does not exist')
+        version = (await CartEvent.objects.using(shard).filter(cart=cart_id).aaggregate(last=Max('version')))['last'] or 0
+        # add() rather than set(): a write publishing a newer version in the meantime wins
+        await cache.aadd(key, version, timeout=feed_setting('CACHE_TIMEOUT', 300))
+        version = await cache.aget(key, version)
+    return version
+
+
+async def wait_for_version(cart_id, shard, since, timeout):
+    """
+    Poll the cached version of the cart until it moves past since or the
+    timeout runs out, and return it.
+    """
+    deadline = time.monotonic() + timeout
+    interval = feed_setting('POLL_INTERVAL', 0.5)
+    while True:
+        version = await current_version(cart_id, shard)
+        remaining = deadline - time.monotonic()
+        if version != since or remaining <= 0:
+            return version
+        await asyncio.sleep(min(interval, remaining))
+
+
+async def read_changes(cart_id, shard, since):
+    """
+    The events of the cart after version since, and whether the client has
+    to reload the whole cart because events it missed were pruned.
+    """
+    limit = feed_setting('MAX_EVENTS', 1000)
+    events = CartEvent.objects.using(shard).filter(cart=cart_id, version__gt=since).order_by('version')
+    rows = [row async for row in events.values(*CartEventValuesSerializer.values_fields())[:limit]]
+    reset = bool(rows) and rows[0]['version'] != since + 1
+    return CartEventValuesSerializer(rows, many=True).data, reset
+
+
+def longest_wait(request):
+    """
+    Seconds a request may wait or stream: a WSGI worker is busy the whole time.
+    """
+    if isinstance(request, ASGIRequest):
+        return feed_setting('TIMEOUT', 25)
+    return min(feed_setting('TIMEOUT', 25), feed_setting('WSGI_TIMEOUT', 5))
+
+
+def parse_feed_params(request, cart_id):
+    try:
+        shard = shard_for_id(cart_id)
+    except (TypeError, ValueError):
+        raise Http404(f'Cart {cart_id} does not exist')
+    errors = {}
+    since = request.GET.get('since', request.headers.get('Last-Event-ID'))
+    if since is not None:
+        if not since.isdigit():
+            errors['since'] = ['A valid integer is required.']
+        else:
+            since = int(since)
+    max_timeout = longest_wait(request)
+    try:
+        timeout = min(float(request.GET.get('timeout', max_timeout)), max_timeout)
+    except ValueError:
+        errors['timeout'] = ['A valid number is required.']
+        timeout = None
+    return shard, since, timeout, errors
+
+
+async def cart_changes(request, pk):
+    """
+    GET /api/carts/<pk>/changes/?since=<version> waits up to ?timeout=
+    seconds for the cart to change after version since, then answers with
+    the events since then and the version to pass next. Without since it
+    answers right away with the current version, to start from.
+    With Accept: text/event-stream it streams the events instead.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    shard, since, timeout, errors = parse_feed_params(request, pk)
+    if errors:
+        return JsonResponse(errors, status=400)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        await current_version(pk, shard)
+        keep_alive = longest_wait(request)
+        if isinstance(request, ASGIRequest):
+            stream = stream_changes(pk, shard, since, feed_setting('STREAM_SECONDS', 300), keep_alive)
+        else:
+            stream = stream_changes_sync(pk, shard, since, min(feed_setting('STREAM_SECONDS', 300), keep_alive))
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # keep proxies such as nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    if since is None:
+        return JsonResponse({'cart': pk, 'version': await current_version(pk, shard), 'events': [], 'reset': False})
+    version = await wait_for_version(pk, shard, since, timeout)
+    if version <= since:
+        # a version behind the client's means the events it saw are gone, with their cart
+        events, reset = [], version < since
+    else:
+        events, reset = await read_changes(pk, shard, since)
+    if events:
+        version = events[-1]['version']
+    return JsonResponse({'cart': pk, 'version': version, 'events': events, 'reset': reset})
+
+
+async def next_messages(cart_id, shard, since, timeout):
+    """
+    The Server-Sent Events of the changes of the cart after version since,
+    within timeout seconds (a keep-alive comment when there is none), and
+    the version to go on from, None once the cart is gone.
+    """
+    try:
+        version = await wait_for_version(cart_id, shard, since, timeout)
+    except Http404:
+        return ['event: deleted\ndata: {}\n\n'], None
+    if version == since:
+        return [': keep-alive\n\n'], since
+    events, reset = ([], True) if version < since else await read_changes(cart_id, shard, since)
+    messages = [f'event: reset\ndata: {json.dumps({"version": version})}\n\n'] if reset else []
+    messages += [f'id: {event["version"]}\nevent: change\ndata: {json.dumps(event)}\n\n' for event in events]
+    return messages, events[-1]['version'] if events else version
+
+
+def version_message(version):
+    return f'event: version\ndata: {json.dumps({"version": version})}\n\n'
+
+
+async def stream_changes(cart_id, shard, since, seconds, keep_alive):
+    """
+    Server-Sent Events of the changes of the cart, with the version as
+    event id so that a reconnecting EventSource resumes where it stopped.
+    The stream ends after the given seconds, and a comment is sent every
+    keep_alive seconds to keep idle connections open.
+    """
+    if since is None:
+        since = await current_version(cart_id, shard)
+        yield version_message(since)
+    deadline = time.monotonic() + seconds
+    while since is not None and time.monotonic() < deadline:
+        messages, since = await next_messages(cart_id, shard, since, min(keep_alive, deadline - time.monotonic()))
+        for message in messages:
+            yield message
+
+
+def stream_changes_sync(cart_id, shard, since, seconds):
+    """
+    stream_changes() for a WSGI server, which reads an async stream whole
+    before sending any of it: every step runs in an event loop of its own.
+    """
+    if since is None:
+        since = async_to_sync(current_version)(cart_id, shard)
+        yield version_message(since)
+    deadline = time.monotonic() + seconds
+    while since is not None and time.monotonic() < deadline:
+        messages, since = async_to_sync(next_messages)(cart_id, shard, since, deadline - time.monotonic())
+        yield from messages
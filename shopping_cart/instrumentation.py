@@ -0,0 +1,202 @@
+"""
+Per-request SQL and timing instrumentation. RequestMetricsMiddleware
+records the number of queries, the database time, the serialization time
+and the response size of every request, sends them back in a
+Server-Timing header and adds them to per-view histograms that
+metrics_view exposes in the Prometheus text format.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+from django.http import HttpResponse
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRICS = (
+    # name, help, buckets
+    ('request_duration_seconds', 'Time spent handling the request', DURATION_BUCKETS),
+    ('db_duration_seconds', 'Time spent running SQL queries', DURATION_BUCKETS),
+    ('serialization_duration_seconds', 'Time spent in the view and renderer outside of SQL queries', DURATION_BUCKETS),
+    ('db_queries', 'Number of SQL queries', QUERY_BUCKETS),
+    ('response_size_bytes', 'Size of the response body', SIZE_BUCKETS),
+)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """
+    Histograms of every metric per view label. Kept in process memory, so
+    each worker process exposes its own series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, values):
+        with self.lock:
+            histograms = self.histograms.get(view)
+            if histograms is None:
+                histograms = self.histograms[view] = {name: Histogram(buckets) for name, _, buckets in METRICS}
+            for name, value in values.items():
+                histograms[name].observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help_text, buckets in METRICS:
+                metric = f'shopping_cart_{name}'
+                lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} histogram')
+                for view, histograms in sorted(self.histograms.items()):
+                    histogram = histograms[name]
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{view="{view}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{view="{view}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# the RequestTimer of the request being handled; sync_to_async and
+# async_to_sync carry it to the thread running the queries of the request
+current_timer = ContextVar('current_timer', default=None)
+
+
+class RequestTimer:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.view = 'unresolved'
+        self.view_started = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed once on every connection, which times the
+    query for the request being handled, if any.
+    """
+    timer = current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def view_label(request, view_func):
+    """
+    viewset.action for REST framework views, the view name otherwise.
+    """
+    cls = getattr(view_func, 'cls', None)
+    actions = getattr(view_func, 'actions', None)
+    if cls is not None and actions:
+        return f'{cls.__name__}.{actions.get(request.method.lower(), request.method.lower())}'
+    if cls is not None:
+        return cls.__name__
+    return getattr(view_func, '__name__', 'unknown')
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def instrument():
+        # the wrapper stays on the connections of the thread: concurrent
+        # async requests share them, so each finds its timer in its context
+        for connection in connections.all():
+            if count_query not in connection.execute_wrappers:
+                connection.execute_wrappers.append(count_query)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = request.metrics_timer = RequestTimer()
+        started = time.perf_counter()
+        self.instrument()
+        token = current_timer.set(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.record(request, response, started)
+
+    async def __acall__(self, request):
+        # connections belong to the thread running the sync code of the
+        # request, which is also where async ORM calls run their queries
+        timer = request.metrics_timer = RequestTimer()
+        started = time.perf_counter()
+        await sync_to_async(self.instrument)()
+        token = current_timer.set(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        return self.record(request, response, started)
+
+    def record(self, request, response, started):
+        timer = request.metrics_timer
+        finished = time.perf_counter()
+
+        # time spent in the view and in rendering its response, minus the queries
+        in_view = finished - timer.view_started if timer.view_started is not None else 0.0
+        serialization = max(in_view - timer.db_time, 0.0)
+        size = 0 if response.streaming else len(response.content)
+
+        response['Server-Timing'] = (
+            f'db;dur={timer.db_time * 1000:.2f};desc="{timer.queries} queries", '
+            f'serialize;dur={serialization * 1000:.2f}, '
+            f'total;dur={(finished - started) * 1000:.2f}'
+        )
+        registry.observe(timer.view, {
+            'request_duration_seconds': finished - started,
+            'db_duration_seconds': timer.db_time,
+            'serialization_duration_seconds': serialization,
+            'db_queries': timer.queries,
+            'response_size_bytes': size,
+        })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = request.metrics_timer
+        timer.view = view_label(request, view_func)
+        timer.view_started = time.perf_counter()
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
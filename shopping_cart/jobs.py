@@ -0,0 +1,154 @@
+"""
+Background deletion of items and users. Deleting a popular item with
+Model.delete() makes the collector load every cart item holding it and
+delete them in one long write transaction, which blocks every other cart
+write. start_deletion() instead hides the object right away and records
+a DeletionJob, which a local job runner then works through: the cart
+items depending on the object are deleted shard by shard, in chunks of
+DELETE_CHUNK_SIZE rows that each commit on their own, and the object is
+deleted last, once nothing points at it any more.
+
+Jobs run in a thread of the process that started them (or in the request
+thread after commit with BACKGROUND_JOBS = False). A job interrupted by a
+restart is picked up again by the run_deletion_jobs command; every step
+only works on the rows still left, so running a job twice is harmless.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .cache import forget_user_carts
+from .models import Cart, CartEvent, CartItem, DeletionJob, Item, ItemStats, StockReservation
+from .sharding import PRIMARY, cart_shards, shard_for_user
+from .transactions import retry_on_locked
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def delete_chunk_size():
+    return getattr(settings, 'DELETE_CHUNK_SIZE', 500)
+
+
+def executor():
+    """
+    The thread running the deletion jobs of this process, one at a time
+    so that they do not compete with each other for the write lock.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='deletion-jobs')
+        return _executor
+
+
+def start_deletion(instance):
+    """
+    Hide the item or user, record its DeletionJob and run the job once the
+    current transaction commits. Returns the job.
+    """
+    with transaction.atomic(using=PRIMARY):
+        if isinstance(instance, Item):
+            instance.hidden = True
+            instance.save(update_fields=['hidden'])
+        else:
+            instance.is_active = False
+            instance.save(update_fields=['is_active'])
+            forget_user_carts(instance.pk)
+        job = DeletionJob.objects.create(model=instance._meta.label_lower, object_id=instance.pk)
+        transaction.on_commit(lambda: enqueue(job.pk), using=PRIMARY)
+    return job
+
+
+def enqueue(job_id):
+    if getattr(settings, 'BACKGROUND_JOBS', True):
+        executor().submit(run_in_thread, job_id)
+    else:
+        run_job(job_id)
+
+
+def run_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # the connections of this thread are not closed at the end of any request
+        connections.close_all()
+
+
+def update_job(job_id, **fields):
+    return DeletionJob.objects.filter(pk=job_id).update(updated_at=timezone.now(), **fields)
+
+
+def run_job(job_id):
+    job = DeletionJob.objects.get(pk=job_id)
+    if job.status == DeletionJob.DONE:
+        return
+    update_job(job_id, status=DeletionJob.RUNNING, error='')
+    try:
+        model = apps.get_model(job.model)
+        instance = model._base_manager.using(PRIMARY).filter(pk=job.object_id).first()
+        if instance is not None:
+            if model is Item:
+                lines = {alias: CartItem.objects.using(alias).filter(item=instance.pk) for alias in cart_shards()}
+            else:
+                alias = shard_for_user(instance.pk)
+                lines = {alias: CartItem.objects.using(alias).filter(cart__user=instance.pk)}
+            if job.total is None:
+                update_job(job_id, total=sum(queryset.count() for queryset in lines.values()))
+            for queryset in lines.values():
+                while delete_chunk(job_id, queryset, instance):
+                    pass
+            # nothing points at the object any more, so the collector has next to nothing left to do
+            instance.delete()
+    except Exception as exc:
+        logger.exception('Deletion job %s failed', job_id)
+        update_job(job_id, status=DeletionJob.FAILED, error=f'{type(exc).__name__}: {exc}')
+    else:
+        update_job(job_id, status=DeletionJob.DONE)
+
+
+@retry_on_locked
+def delete_chunk(job_id, lines, instance):
+    """
+    Delete up to DELETE_CHUNK_SIZE of the cart items in lines, which
+    depend on the deleted instance, in one transaction that also keeps the
+    totals of their carts and the counters of their items in step (and
+    gives back the stock of the cart items of a deleted user). Returns the number of cart items deleted.
+    """
+    alias = lines.db
+    with transaction.atomic(using=alias):
+        rows = list(lines.values_list('id', 'cart', 'item')[:delete_chunk_size()])
+        if not rows:
+            return 0
+        chunk = CartItem.objects.using(alias).filter(pk__in=[pk for pk, _, _ in rows])
+        ItemStats.objects.using(alias).count_lines(chunk, -1)
+        if isinstance(instance, Item):
+            Cart.objects.using(alias).filter(pk__in=chunk.values('cart')).adjust_for_item(instance.pk, -instance.price, line_delta=-1)
+            # a plain DELETE ... WHERE id IN (...), without loading the rows like the collector does
+            deleted = chunk._raw_delete(alias)
+            CartEvent.objects.using(alias).append((cart_id, CartEvent.DELETED, pk, item_id, 0) for pk, cart_id, item_id in rows)
+        else:
+            StockReservation(alias).give_back(chunk.quantities_by_item())
+            deleted = chunk._raw_delete(alias)
+            Cart.objects.using(alias).filter(user=instance.pk).refresh_totals()
+    update_job(job_id, deleted=F('deleted') + deleted)
+    return deleted
+
+
+def run_pending_jobs():
+    """
+    Run the jobs left queued, running (for example by a restart) or
+    failed, in this thread. Returns the number of jobs run.
+    """
+    job_ids = list(DeletionJob.objects.exclude(status=DeletionJob.DONE).order_by('pk').values_list('pk', flat=True))
+    for job_id in job_ids:
+        run_job(job_id)
+    return len(job_ids)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from shopping_cart.benchmark import ENDPOINTS, measure, seed
+from shopping_cart.sharding import PRIMARY, cart_shards
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throw-away test database and report the SQL queries, p50/p95 latency '
+        'and rows per second of every API endpoint against its query budget'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--cart-items', type=int, default=100000)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--endpoint', help='Only run the endpoints whose name contains this text')
+        parser.add_argument('--cold', action='store_true', help='Clear the cache before every request')
+
+    def handle(self, *args, **options):
+        endpoints = [endpoint for endpoint in ENDPOINTS if not options['endpoint'] or options['endpoint'] in endpoint.name]
+        setup_test_environment()
+        aliases = dict.fromkeys([PRIMARY, *cart_shards()])
+        old_names = {alias: connections[alias].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False) for alias in aliases}
+        over_budget = []
+        try:
+            self.stdout.write(f"Seeding {options['items']} items, {options['users']} users and {options['cart_items']} cart items")
+            ids = seed(options['items'], options['users'], options['cart_items'])
+            client = Client()
+            self.stdout.write(f"{'endpoint':<50} {'queries':>7} {'budget':>6} {'p50 ms':>9} {'p95 ms':>9} {'rows/s':>11}")
+            for endpoint in endpoints:
+                result = measure(client, endpoint, ids, options['iterations'], options['cold'])
+                line = (
+                    f"{endpoint.name:<50} {result['queries']:>7} {endpoint.budget:>6} "
+                    f"{result['p50']:>9.2f} {result['p95']:>9.2f} {result['rows_per_second']:>11.0f}"
+                )
+                if result['queries'] > endpoint.budget:
+                    over_budget.append(endpoint.name)
+                    line = self.style.ERROR(line)
+                self.stdout.write(line)
+        finally:
+            for alias, old_name in old_names.items():
+                connections[alias].creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        if over_budget:
+            raise CommandError(f"{len(over_budget)} endpoints ran more queries than their budget: {', '.join(over_budget)}")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.stock import expire_reservations, reservation_ttl
+
+
+class Command(BaseCommand):
+    help = (
+        'Remove the cart items of stocked items left unchanged for STOCK_RESERVATION_TTL seconds '
+        'from their carts and give their stock back; run it periodically, for example from cron'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, help='Seconds a reservation lasts, STOCK_RESERVATION_TTL by default')
+
+    def handle(self, *args, **options):
+        ttl = reservation_ttl() if options['ttl'] is None else options['ttl']
+        if ttl < 0:
+            raise CommandError('--ttl must not be negative')
+        expired = expire_reservations(ttl)
+        self.stdout.write(self.style.SUCCESS(f'Expired {expired} cart items unchanged for {ttl}s'))
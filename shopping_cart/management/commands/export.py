@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from shopping_cart.export import EXPORT_COLUMNS, EXPORT_FORMATS, export_lines
+from shopping_cart.sharding import on_shards
+
+
+class Command(BaseCommand):
+    help = 'Stream every item, cart (with its totals) or cart item as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(EXPORT_COLUMNS))
+        parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--output', help='File to write to instead of standard output')
+        parser.add_argument('--chunk-size', type=int, help='Rows read from the database at a time')
+
+    def handle(self, *args, **options):
+        model, columns = EXPORT_COLUMNS[options['model']]
+        lines = export_lines(on_shards(model.objects.all()), columns, options['export_format'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,142 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from rest_framework import serializers
+
+from shopping_cart.cache import catalog_changed
+from shopping_cart.models import Cart, CartItem, Item, ItemStats
+from shopping_cart.serializers import ItemSerializer
+from shopping_cart.sharding import cart_shards, replicate_ids
+
+IMPORTED_FIELDS = ('name', 'description', 'price')
+
+
+class Command(BaseCommand):
+    help = (
+        'Import items from a CSV or NDJSON file with sku, name, description and price columns. '
+        'Items are created or updated by sku in batches, and an interrupted import can be resumed '
+        'from the last committed batch with --resume.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', dest='import_format', choices=('csv', 'ndjson'),
+                            help='Format of the file, guessed from its extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the rows committed by a previous run of the same import')
+        parser.add_argument('--checkpoint',
+                            help='File recording the number of committed rows, <path>.checkpoint by default')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        import_format = options['import_format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        done = 0
+        if options['resume'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                done = json.load(f)['rows']
+            self.stdout.write(f'Resuming after row {done}')
+
+        # the serializer fields are built once and reused for every row
+        fields = ItemSerializer().fields
+        sku_field = serializers.CharField(max_length=fields['sku'].max_length)
+        self.created = self.updated = self.failed = 0
+        started = time.monotonic()
+
+        try:
+            with open(path, newline='') as f:
+                rows = enumerate(self.read_rows(f, import_format), start=1)
+                rows = islice(rows, done, None)
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+                    self.import_batch(batch, fields, sku_field)
+                    done = batch[-1][0]
+                    with open(checkpoint, 'w') as f_checkpoint:
+                        json.dump({'rows': done}, f_checkpoint)
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(
+                        f'{done} rows: {self.created} created, {self.updated} updated, {self.failed} failed '
+                        f'({(self.created + self.updated + self.failed) / elapsed:.0f} rows/s)'
+                    )
+        except (OSError, ValueError, csv.Error) as exc:
+            raise CommandError(f'Import stopped after row {done}: {exc}')
+
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.created + self.updated} items ({self.created} created, {self.updated} updated, '
+            f'{self.failed} failed) in {time.monotonic() - started:.1f}s'
+        ))
+
+    def read_rows(self, f, import_format):
+        if import_format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def validate(self, row, fields, sku_field):
+        if not isinstance(row, dict):
+            # a valid NDJSON line may hold any JSON value; the same error as a serializer given one
+            return {}, {'non_field_errors': [f'Invalid data. Expected a dictionary, but got {type(row).__name__}.']}
+        values, errors = {}, {}
+        for name, field in (('sku', sku_field),) + tuple((name, fields[name]) for name in IMPORTED_FIELDS):
+            try:
+                values[name] = field.run_validation(row.get(name, serializers.empty))
+            except serializers.ValidationError as exc:
+                errors[name] = exc.detail
+        return values, errors
+
+    def import_batch(self, batch, fields, sku_field):
+        items = {}
+        for number, row in batch:
+            values, errors = self.validate(row, fields, sku_field)
+            if errors:
+                self.failed += 1
+                self.stderr.write(f'Row {number}: {errors}')
+            else:
+                # a later row for the same sku wins
+                items[values['sku']] = values
+
+        if not items:
+            return
+        existing = {sku: (pk, price) for sku, pk, price in Item.objects.filter(sku__in=items).values_list('sku', 'id', 'price')}
+        to_create, to_update, repriced = [], [], []
+        for sku, values in items.items():
+            if sku in existing:
+                pk, price = existing[sku]
+                to_update.append(Item(pk=pk, **values))
+                if values['price'] != price:
+                    repriced.append(pk)
+            else:
+                to_create.append(Item(**values))
+
+        with transaction.atomic():
+            Item.objects.bulk_create(to_create)
+            Item.objects.bulk_update(to_update, IMPORTED_FIELDS)
+            # bulk writes bypass Item.save() and its signals, so copy the items to the
+            # cart shards and refresh the stored totals of the affected carts and items by hand
+            replicate_ids(Item, Item.objects.filter(sku__in=items).values_list('id', flat=True))
+            if repriced:
+                for alias in cart_shards():
+                    Cart.objects.using(alias).filter(pk__in=CartItem.objects.filter(item__in=repriced).values('cart')).refresh_totals()
+                    ItemStats.objects.using(alias).filter(item__in=repriced).update(
+                        reserved_value=F('quantity') * Subquery(Item.objects.filter(pk=OuterRef('item')).values('price')[:1])
+                    )
+            catalog_changed()
+        self.created += len(to_create)
+        self.updated += len(to_update)
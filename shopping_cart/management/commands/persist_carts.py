@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart import active_carts
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the cart changes held by the active-cart store to the database: those of the carts '
+        'idle for ACTIVE_CART_FLUSH_AFTER seconds, or all of them with --all, for example after a '
+        'restart or before turning the store off.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='everything', help='Persist every cart holding changes')
+
+    def handle(self, *args, **options):
+        if not active_carts.enabled():
+            raise CommandError('The active-cart store is off (ACTIVE_CART_STORE)')
+        count = active_carts.flush_idle(everything=options['everything'])
+        self.stdout.write(self.style.SUCCESS(f'Persisted {count} carts'))
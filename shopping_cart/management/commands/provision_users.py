@@ -0,0 +1,73 @@
+import csv
+import json
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.provisioning import hash_workers, provision_users, user_fields
+
+
+class Command(BaseCommand):
+    help = (
+        'Create users from a CSV or NDJSON file with username and password columns. '
+        'Passwords are hashed in a pool of worker processes and users are inserted in batches, '
+        'optionally with their carts.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', dest='import_format', choices=('csv', 'ndjson'),
+                            help='Format of the file, guessed from its extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int,
+                            help='Processes hashing passwords, PASSWORD_HASH_WORKERS or the number of cores by default')
+        parser.add_argument('--carts', action='store_true', help='Also create a cart for every user')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        import_format = options['import_format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+        workers = options['workers'] or hash_workers()
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+
+        # the serializer fields are built once and reused for every row
+        fields = user_fields()
+        created = failed = done = 0
+        started = time.monotonic()
+        try:
+            with open(path, newline='') as f:
+                rows = self.read_rows(f, import_format)
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+                    for result in provision_users(batch, create_carts=options['carts'], workers=workers, fields=fields):
+                        if result['status'] == 'created':
+                            created += 1
+                        else:
+                            failed += 1
+                            self.stderr.write(f'Row {done + result["index"] + 1}: {result["errors"]}')
+                    done += len(batch)
+                    self.stdout.write(
+                        f'{done} rows: {created} created, {failed} failed '
+                        f'({done / (time.monotonic() - started):.0f} rows/s)'
+                    )
+        except (OSError, ValueError, csv.Error) as exc:
+            raise CommandError(f'Provisioning stopped after row {done}: {exc}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} users ({failed} failed) with {workers} hashing processes '
+            f'in {time.monotonic() - started:.1f}s'
+        ))
+
+    def read_rows(self, f, import_format):
+        if import_format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
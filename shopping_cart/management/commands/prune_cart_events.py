@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.feeds import feed_setting, prune_events
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the cart change feed events older than CART_FEED_RETENTION seconds, '
+        'except the last event of each cart; run it periodically, for example from cron'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=int, help='Seconds events are kept, CART_FEED_RETENTION by default')
+
+    def handle(self, *args, **options):
+        retention = feed_setting('RETENTION', 86400) if options['retention'] is None else options['retention']
+        if retention < 0:
+            raise CommandError('--retention must not be negative')
+        pruned = prune_events(retention)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {pruned} cart events older than {retention}s'))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from shopping_cart.models import Cart
+from shopping_cart.sharding import cart_shards, on_shards
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the stored cart totals and item counts and check them against the live aggregate'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report carts whose stored totals are out of date, without rebuilding them',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            updated = sum(Cart.objects.using(alias).refresh_totals() for alias in cart_shards())
+            self.stdout.write(f'Rebuilt totals for {updated} carts')
+
+        stale = 0
+        carts = (
+            on_shards(Cart.objects.all()).with_total_cost()
+            .annotate(live_item_count=Count('cartitem'))
+            .values_list('id', 'running_total', 'annotated_total_cost', 'item_count', 'live_item_count')
+            .order_by()
+        )
+        for cart_id, running_total, live_total, item_count, live_item_count in carts.iterator(chunk_size=2000):
+            if running_total != live_total or item_count != live_item_count:
+                stale += 1
+                self.stdout.write(
+                    f'Cart {cart_id}: stored total {running_total} ({item_count} lines), '
+                    f'live total {live_total} ({live_item_count} lines)'
+                )
+        if stale:
+            raise CommandError(f'{stale} carts have stale totals')
+        self.stdout.write(self.style.SUCCESS('All cart totals are up to date'))
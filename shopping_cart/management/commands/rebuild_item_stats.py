@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.models import ItemStats
+from shopping_cart.sharding import cart_shards
+
+
+class Command(BaseCommand):
+    help = 'Recount the item popularity counters from the cart items, in one streaming pass per shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report items whose counters are out of date, without rebuilding them',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            counted = sum(ItemStats.objects.using(alias).rebuild() for alias in cart_shards())
+            self.stdout.write(f'Rebuilt counters for {counted} items')
+
+        stale = 0
+        zero = (0, 0, 0)
+        for alias in cart_shards():
+            live = ItemStats.objects.using(alias).recount()
+            stored = {
+                item_id: counters for item_id, *counters in
+                ItemStats.objects.using(alias).values_list('item', 'cart_count', 'quantity', 'reserved_value').iterator(chunk_size=2000)
+            }
+            for item_id in sorted(set(live) | set(stored)):
+                stored_counters, live_counters = tuple(stored.get(item_id, zero)), live.get(item_id, zero)
+                if stored_counters != live_counters:
+                    stale += 1
+                    self.stdout.write(
+                        f'Item {item_id} on {alias}: stored (carts, quantity, value) {stored_counters}, live {live_counters}'
+                    )
+        if stale:
+            raise CommandError(f'{stale} item counters are stale')
+        self.stdout.write(self.style.SUCCESS('All item counters are up to date'))
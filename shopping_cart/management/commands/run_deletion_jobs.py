@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shopping_cart.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the background deletions of items and users left unfinished, for example '
+        'by a restart of the process that started them, or failed.'
+    )
+
+    def handle(self, *args, **options):
+        count = run_pending_jobs()
+        self.stdout.write(self.style.SUCCESS(f'Ran {count} deletion jobs'))
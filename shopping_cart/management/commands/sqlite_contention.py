@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.sqlite3.base import DEFAULT_PRAGMAS
+
+PROFILES = {
+    # what django.db.backends.sqlite3 does out of the box
+    'default': {'pragmas': {}, 'begin': 'BEGIN'},
+    'tuned': {'pragmas': DEFAULT_PRAGMAS, 'begin': 'BEGIN IMMEDIATE'},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Run concurrent cart item writers against a scratch SQLite database with the default '
+        'and the tuned connection profiles and report their write throughput and lock errors'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--transactions', type=int, default=200, help='Transactions per thread')
+        parser.add_argument('--carts', type=int, default=4, help='Number of cart rows the writers compete for')
+        parser.add_argument('--timeout', type=float, default=5.0, help='sqlite3 busy timeout in seconds')
+        parser.add_argument('--profile', choices=sorted(PROFILES), action='append',
+                            help='Profile to run, both by default')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['transactions'] < 1 or options['carts'] < 1:
+            raise CommandError('--threads, --transactions and --carts must be at least 1')
+        self.stdout.write(f"{'profile':<10} {'committed':>9} {'locked':>7} {'seconds':>8} {'tx/s':>9}")
+        for name in options['profile'] or ('default', 'tuned'):
+            with tempfile.TemporaryDirectory() as directory:
+                result = self.run_profile(os.path.join(directory, 'contention.sqlite3'), PROFILES[name], options)
+            self.stdout.write(
+                f"{name:<10} {result['committed']:>9} {result['locked']:>7} "
+                f"{result['seconds']:>8.2f} {result['committed'] / result['seconds']:>9.0f}"
+            )
+
+    def connect(self, path, profile, timeout):
+        # isolation_level=None leaves transaction control to the explicit BEGIN, as Django does
+        conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        for name, value in profile['pragmas'].items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def run_profile(self, path, profile, options):
+        conn = self.connect(path, profile, options['timeout'])
+        conn.execute('CREATE TABLE cart (id INTEGER PRIMARY KEY, running_total INTEGER NOT NULL, item_count INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE cartitem (id INTEGER PRIMARY KEY, cart_id INTEGER NOT NULL, quantity INTEGER NOT NULL)')
+        conn.executemany('INSERT INTO cart VALUES (?, 0, 0)', [(n,) for n in range(options['carts'])])
+        conn.close()
+
+        counts = {'committed': 0, 'locked': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(options['threads'])
+
+        def writer(number):
+            conn = self.connect(path, profile, options['timeout'])
+            committed = locked = 0
+            start.wait()
+            for n in range(options['transactions']):
+                cart_id = (number + n) % options['carts']
+                try:
+                    # read then write, like adding a line and updating the stored cart total
+                    conn.execute(profile['begin'])
+                    conn.execute('SELECT running_total FROM cart WHERE id = ?', (cart_id,)).fetchone()
+                    conn.execute('INSERT INTO cartitem (cart_id, quantity) VALUES (?, 1)', (cart_id,))
+                    conn.execute('UPDATE cart SET running_total = running_total + 1, item_count = item_count + 1 WHERE id = ?', (cart_id,))
+                    conn.execute('COMMIT')
+                    committed += 1
+                except sqlite3.OperationalError:
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    locked += 1
+            conn.close()
+            with lock:
+                counts['committed'] += committed
+                counts['locked'] += locked
+
+        threads = [threading.Thread(target=writer, args=(number,)) for number in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {**counts, 'seconds': time.perf_counter() - started}
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Sum
+
+from shopping_cart.models import Cart, CartItem, Item, OutOfStock
+from shopping_cart.sharding import cart_shards
+from shopping_cart.transactions import retry_on_locked
+
+
+class Command(BaseCommand):
+    help = (
+        'Add one item with stock to the carts of concurrent threads, a unit at a time, through the '
+        'conditional reservations of the API, and report the reservation throughput and any overselling'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--stock', type=int, default=200, help='Units of the hot item')
+        parser.add_argument('--attempts', type=int, default=50, help='Units each thread tries to add')
+        parser.add_argument('--keep', action='store_true', help='Keep the item, users and carts created for the run')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['attempts'] < 1 or options['stock'] < 0:
+            raise CommandError('--threads and --attempts must be at least 1 and --stock must not be negative')
+        item = Item.objects.create(name='stock contention', description='hot item', price='1.00', stock=options['stock'])
+        carts = [
+            Cart.objects.create(user=User.objects.create_user(username=f'stock-contention-{item.pk}-{n}'))
+            for n in range(options['threads'])
+        ]
+        try:
+            result = self.run_threads(item, carts, options['attempts'])
+            in_carts = sum(
+                CartItem.objects.using(alias).filter(item=item).aggregate(total=Sum('quantity'))['total'] or 0
+                for alias in cart_shards()
+            )
+            left = Item.objects.get(pk=item.pk).stock
+        finally:
+            if not options['keep']:
+                User.objects.filter(pk__in=[cart.user_id for cart in carts]).delete()
+                item.delete()
+
+        oversold = max(0, in_carts - options['stock'])
+        self.stdout.write(f"{'threads':>7} {'reserved':>8} {'rejected':>8} {'in-carts':>8} {'left':>6} {'oversold':>8} {'seconds':>8} {'res/s':>8}")
+        self.stdout.write(
+            f"{options['threads']:>7} {result['reserved']:>8} {result['rejected']:>8} {in_carts:>8} {left:>6} "
+            f"{oversold:>8} {result['seconds']:>8.2f} {result['reserved'] / result['seconds']:>8.0f}"
+        )
+        if oversold or in_carts + left != options['stock'] or in_carts != result['reserved']:
+            raise CommandError(f'{in_carts} units in carts and {left} left do not add up to the stock of {options["stock"]}')
+
+    def run_threads(self, item, carts, attempts):
+        counts = {'reserved': 0, 'rejected': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(len(carts))
+        add_quantity = retry_on_locked(CartItem.objects.add_quantity)
+
+        def worker(cart_id):
+            reserved = rejected = 0
+            try:
+                start.wait()
+                for _ in range(attempts):
+                    try:
+                        add_quantity(cart_id, item.pk, 1)
+                        reserved += 1
+                    except OutOfStock:
+                        rejected += 1
+            finally:
+                # the connections of this thread are not closed at the end of any request
+                connections.close_all()
+                with lock:
+                    counts['reserved'] += reserved
+                    counts['rejected'] += rejected
+
+        threads = [threading.Thread(target=worker, args=(cart.pk,)) for cart in carts]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {**counts, 'seconds': time.perf_counter() - started}
@@ -0,0 +1,29 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from shopping_cart.models import Item
+from shopping_cart.sharding import PRIMARY, cart_shards, replica_databases, replicate_ids, reserve_id_ranges
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy every user and item from the primary database to the other cart shards and '
+        'make sure each shard hands out ids from its own range. Run it after adding a shard '
+        'to CART_SHARDS and migrating it, before it receives carts.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if not cart_shards():
+            raise CommandError('CART_SHARDS is empty')
+        for alias in cart_shards():
+            reserve_id_ranges(using=alias)
+        for model in (User, Item):
+            ids = model._base_manager.using(PRIMARY).order_by('pk').values_list('pk', flat=True)
+            replicate_ids(model, ids, options['batch_size'])
+            self.stdout.write(f'Copied {ids.count()} {model._meta.verbose_name_plural} to {len(replica_databases())} shards')
+        self.stdout.write(self.style.SUCCESS('Shards are in sync'))
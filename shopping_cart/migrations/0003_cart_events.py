@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopping_cart', '0002_deletion_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=10)),
+                ('cart_item', models.BigIntegerField()),
+                ('item', models.BigIntegerField()),
+                ('quantity', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='shopping_cart.cart')),
+            ],
+            options={
+                'unique_together': {('cart', 'version')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 04:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+from decimal import Decimal
+
+
+def count_cart_items(apps, schema_editor):
+    # the same streaming pass as ItemStats.objects.rebuild(), on the database being migrated
+    alias = schema_editor.connection.alias
+    CartItem = apps.get_model('shopping_cart', 'CartItem')
+    ItemStats = apps.get_model('shopping_cart', 'ItemStats')
+    counters = {}
+    for item_id, quantity, price in CartItem.objects.using(alias).order_by().values_list('item', 'quantity', 'item__price').iterator(chunk_size=2000):
+        carts, units, value = counters.get(item_id, (0, 0, Decimal('0')))
+        counters[item_id] = (carts + 1, units + quantity, value + price * quantity)
+    ItemStats.objects.using(alias).bulk_create(
+        [ItemStats(item_id=item_id, cart_count=carts, quantity=units, reserved_value=value) for item_id, (carts, units, value) in counters.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shopping_cart', '0003_cart_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemStats',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='shopping_cart.item')),
+                ('cart_count', models.IntegerField(db_index=True, default=0)),
+                ('quantity', models.IntegerField(db_index=True, default=0)),
+                ('reserved_value', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.RunPython(count_cart_items, migrations.RunPython.noop),
+    ]
@@ -1,32 +1,601 @@
-from django.db import models
+import heapq
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Case, Count, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from .cache import USER_CART_KEY, catalog_changed, forget_user_carts, publish_cart_versions, user_cart_cache
+from .sharding import PRIMARY, cart_shards, shard_for_id, shard_for_user
+
+
+class OutOfStock(APIException):
+    status_code = 409
+    default_detail = 'Not enough stock.'
+    default_code = 'out_of_stock'
+
+
+class ItemQuerySet(models.QuerySet):
+    def visible(self):
+        """
+        The items that are not hidden while a background deletion removes them.
+        """
+        return self.filter(hidden=False)
+
+    def reserve(self, item_id, quantity):
+        """
+        Take quantity units from the stock of the item on the primary
+        database with one conditional UPDATE, which only matches while
+        enough units are left, so that concurrent reservations never take
+        more than the stock and no lock is held in between. Items without
+        stock (None) are not tracked and cost a read, never a write.
+        Returns whether the stock was taken. Raises OutOfStock.
+        """
+        items = self.using(PRIMARY).filter(pk=item_id)
+        if quantity <= 0 or items.values_list('stock', flat=True).first() is None:
+            return False
+        if not items.filter(stock__gte=quantity).update(stock=F('stock') - quantity):
+            raise OutOfStock(f'Not enough stock of item {item_id}.')
+        return True
+
+    def release(self, quantities):
+        """
+        Give {item id: quantity} units back to the stock of their items with
+        a single UPDATE, once a read has found which of them track it.
+        """
+        quantities = {item_id: quantity for item_id, quantity in quantities.items() if quantity}
+        if quantities:
+            stocked = list(self.using(PRIMARY).filter(pk__in=quantities, stock__isnull=False).values_list('pk', flat=True))
+            if stocked:
+                self.using(PRIMARY).filter(pk__in=stocked).update(
+                    stock=F('stock') + Case(*(When(pk=item_id, then=Value(quantities[item_id])) for item_id in stocked), default=Value(0))
+                )
+
 
 class Item(models.Model):
+    # stable identifier of the item in the supplier catalog, used by import_items
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     name = models.CharField(max_length=200)
     description = models.CharField(max_length=200)
     price = models.DecimalField(max_digits=6, decimal_places=2)
+    # set while a DeletionJob removes the item from the carts holding it
+    hidden = models.BooleanField(default=False)
+    # units left to put in carts, None when the stock is not tracked; only
+    # the primary database has the current value (see ItemQuerySet.reserve)
+    stock = models.PositiveIntegerField(null=True, blank=True)
+
+    objects = ItemQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_stock = instance.__dict__.get('stock')
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if not self._state.adding and update_fields is None and self.__dict__.get('stock') == getattr(self, '_loaded_stock', None):
+            # leave the stock to the reservations made since the item was read, unless it was changed on purpose
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'stock' and field.attname not in deferred
+            ]
+        with transaction.atomic(using=kwargs.get('using')):
+            if self._state.adding or (update_fields is not None and 'price' not in update_fields):
+                super().save(*args, **kwargs)
+            else:
+                old_price = Item.objects.select_for_update().filter(pk=self.pk).values_list('price', flat=True).first()
+                super().save(*args, **kwargs)
+                new_price = Decimal(str(self.price))
+                if old_price is not None and old_price != new_price:
+                    # one UPDATE per shard for every cart that holds this item
+                    for alias in cart_shards():
+                        Cart.objects.using(alias).containing(self.pk).adjust_for_item(self.pk, new_price - old_price)
+                        ItemStats.objects.using(alias).filter(item=self.pk).update(reserved_value=F('quantity') * Value(new_price))
+            catalog_changed(signalled=True)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            # the cascade below bypasses CartItem.delete(), so take the lines out of the cart totals
+            # and append their deleted events to the change feeds first
+            price = Item.objects.select_for_update().filter(pk=self.pk).values_list('price', flat=True).first()
+            if price is not None:
+                for alias in cart_shards():
+                    with transaction.atomic(using=alias, savepoint=False):
+                        rows = list(CartItem.objects.using(alias).filter(item=self.pk).values_list('id', 'cart'))
+                        if rows:
+                            Cart.objects.using(alias).containing(self.pk).adjust_for_item(self.pk, -price, line_delta=-1)
+                            CartEvent.objects.using(alias).append((cart_id, CartEvent.DELETED, pk, self.pk, 0) for pk, cart_id in rows)
+            result = super().delete(*args, **kwargs)
+            catalog_changed(signalled=True)
+            return result
 
     def __str__(self):
         return self.name
 
 
+class StockReservation:
+    """
+    The stock taken and given back by a cart item write on the database
+    using, as a context manager around its transaction. On the primary
+    database the UPDATEs are part of that transaction. On another shard
+    they cannot be, so units taken are committed right away and given back
+    if the write fails, and units given back wait for the write to commit:
+    a failure in between can leave stock unsold, never sold twice.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.taken = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None and self.using != PRIMARY:
+            Item.objects.release(self.taken)
+
+    def take(self, item_id, quantity):
+        """
+        Take quantity units of the item, or give them back when negative. Raises OutOfStock.
+        """
+        if quantity < 0:
+            self.give_back({item_id: -quantity})
+        elif Item.objects.reserve(item_id, quantity):
+            self.taken[item_id] = self.taken.get(item_id, 0) + quantity
+
+    def give_back(self, quantities):
+        if self.using == PRIMARY:
+            Item.objects.release(quantities)
+        else:
+            transaction.on_commit(lambda: Item.objects.release(quantities), using=self.using)
+
+
+class ShardedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # QuerySet.create() saves to self.db, which knows nothing of the
+        # new row, so let the router pick its shard from the instance
+        if self._db is None:
+            return self.using(router.db_for_write(self.model, instance=self.model(**kwargs))).create(**kwargs)
+        return super().create(**kwargs)
+
+
+class CartQuerySet(ShardedQuerySet):
+    def with_total_cost(self):
+        """
+        Annotate every cart with the sum of price * quantity over its
+        cart items, computed by the database in the same query.
+        """
+        return self.annotate(
+            annotated_total_cost=Coalesce(
+                Sum(F('cartitem__item__price') * F('cartitem__quantity')),
+                Value(Decimal('0')),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            )
+        )
+
+    def id_for_user(self, user_id, read_through=True):
+        """
+        The id of the cart of the given user, or None. Read through the user
+        cart cache, which Cart.save()/delete() and user deletion keep in sync;
+        with read_through=False a cache miss returns None without a query.
+        """
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        cache = user_cart_cache()
+        key = USER_CART_KEY.format(user_id)
+        cart_id = cache.get(key)
+        if cart_id is None and read_through:
+            cart_id = self.using(self._db or shard_for_user(user_id)).filter(user=user_id).values_list('id', flat=True).first()
+            if cart_id is not None:
+                cache.set(key, cart_id)
+        return cart_id
+
+    def containing(self, item_id):
+        return self.filter(pk__in=CartItem.objects.filter(item=item_id).values('cart'))
+
+    def adjust_for_line(self, item_id, quantity_delta, line_delta=0):
+        """
+        Add quantity_delta units of the given item and line_delta lines
+        to the stored totals of the carts in this queryset.
+        """
+        price = Subquery(Item.objects.filter(pk=item_id).values('price')[:1])
+        return self.update(
+            running_total=F('running_total') + Coalesce(price, Value(Decimal('0'))) * quantity_delta,
+            item_count=F('item_count') + line_delta,
+        )
+
+    def adjust_for_item(self, item_id, price_delta, line_delta=0):
+        """
+        Change the price of the given item by price_delta in the stored
+        totals of the carts in this queryset, in a single UPDATE.
+        """
+        quantity = Subquery(CartItem.objects.filter(cart=OuterRef('pk'), item=item_id).values('quantity')[:1])
+        return self.update(
+            running_total=F('running_total') + Coalesce(quantity, Value(0)) * Value(price_delta),
+            item_count=F('item_count') + line_delta,
+        )
+
+    def refresh_totals(self):
+        """
+        Recompute the stored totals of the carts in this queryset from
+        their cart items, in a single UPDATE.
+        """
+        lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        total = lines.annotate(total=Sum(F('item__price') * F('quantity'))).values('total')
+        count = lines.annotate(count=Count('pk')).values('count')
+        return self.update(
+            running_total=Coalesce(Subquery(total), Value(Decimal('0')), output_field=models.DecimalField(max_digits=12, decimal_places=2)),
+            item_count=Coalesce(Subquery(count), Value(0)),
+        )
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # kept up to date by CartItem.save()/delete() and Item.save()/delete()
+    running_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
+
+    objects = CartQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        previous_user = None
+        if not self._state.adding:
+            using = kwargs.get('using') or router.db_for_write(Cart, instance=self)
+            previous_user = Cart.objects.using(using).filter(pk=self.pk).values_list('user', flat=True).first()
+        super().save(*args, **kwargs)
+        forget_user_carts(self.user_id, previous_user)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        forget_user_carts(self.user_id)
+        return result
 
     def total_cost(self):
-        return sum(cart_item.item.price * cart_item.quantity for cart_item in self.cartitem_set.all())
+        """
+        The live total of the cart. Use running_total to read the stored copy without scanning the cart items.
+        """
+        # use the value computed by CartQuerySet.with_total_cost() when available
+        if hasattr(self, 'annotated_total_cost'):
+            return self.annotated_total_cost
+        return Cart.objects.using(self._state.db).filter(pk=self.pk).with_total_cost().values_list('annotated_total_cost', flat=True).get()
 
     def __str__(self):
         return f'{self.user.username} Cart'
 
 
+class CartItemQuerySet(ShardedQuerySet):
+    def quantities_by_item(self):
+        """
+        {item id: total quantity} of these cart items.
+        """
+        return dict(self.order_by().values('item').annotate(total=Sum('quantity')).values_list('item', 'total'))
+
+    def add_quantity(self, cart_id, item_id, quantity):
+        """
+        Add quantity (which may be negative) to the cart item for the given
+        cart and item without reading it first, creating the cart item when
+        it does not exist (and quantity is positive) and deleting it when
+        its quantity reaches zero.
+        Returns (cart_item, created); cart_item is None when no cart item is left.
+        Raises Cart.DoesNotExist or Item.DoesNotExist when a cart item would be created for a missing cart or item.
+        Runs on the shard of the cart unless the queryset names a database.
+        """
+        line = self.using(self._db or shard_for_id(cart_id)).filter(cart=cart_id, item=item_id)
+        carts = Cart.objects.using(line.db).filter(pk=cart_id)
+        stats = ItemStats.objects.using(line.db)
+        with StockReservation(line.db) as stock, transaction.atomic(using=line.db):
+            if quantity >= 0:
+                if line.update(quantity=F('quantity') + quantity, reserved_at=timezone.now()):
+                    stock.take(item_id, quantity)
+                    carts.adjust_for_line(item_id, quantity)
+                    stats.adjust_for_line(item_id, quantity)
+                    return line.get().changed(CartEvent.UPDATED), False
+                if quantity == 0:
+                    # like a negative quantity, nothing to add to a missing cart item
+                    return None, False
+                # foreign keys are only checked on commit, so check them before inserting
+                if not carts.exists():
+                    raise Cart.DoesNotExist(f'Cart {cart_id} does not exist')
+                if not Item.objects.using(line.db).visible().filter(pk=item_id).exists():
+                    raise Item.DoesNotExist(f'Item {item_id} does not exist')
+                try:
+                    with transaction.atomic(using=line.db):
+                        return line.create(cart_id=cart_id, item_id=item_id, quantity=quantity), True
+                except IntegrityError:
+                    # another request created the cart item first
+                    line.update(quantity=F('quantity') + quantity, reserved_at=timezone.now())
+                    stock.take(item_id, quantity)
+                    carts.adjust_for_line(item_id, quantity)
+                    stats.adjust_for_line(item_id, quantity)
+                    return line.get().changed(CartEvent.UPDATED), False
+
+            while True:
+                if line.filter(quantity__gt=-quantity).update(quantity=F('quantity') + quantity, reserved_at=timezone.now()):
+                    stock.take(item_id, quantity)
+                    carts.adjust_for_line(item_id, quantity)
+                    stats.adjust_for_line(item_id, quantity)
+                    return line.get().changed(CartEvent.UPDATED), False
+                current = line.select_for_update().values_list('id', 'quantity').first()
+                if current is None:
+                    return None, False
+                # only delete the quantity we are about to take out of the cart total
+                pk, current = current
+                if line.filter(quantity=current).delete()[0]:
+                    stock.take(item_id, -current)
+                    carts.adjust_for_line(item_id, -current, -1)
+                    stats.adjust_for_line(item_id, -current, -1)
+                    CartEvent.objects.using(line.db).append([(cart_id, CartEvent.DELETED, pk, item_id, 0)])
+                    return None, False
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    # last change of the quantity, which holds that many units of a stocked
+    # item until the reservation expires (see shopping_cart.stock)
+    reserved_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = CartItemQuerySet.as_manager()
 
     class Meta:
         unique_together = ('cart', 'item')
 
+    def save(self, *args, **kwargs):
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(CartItem, instance=self)
+        carts = Cart.objects.using(using)
+        stats = ItemStats.objects.using(using)
+        with StockReservation(using) as stock, transaction.atomic(using=using):
+            previous = None
+            if not self._state.adding:
+                previous = CartItem.objects.using(using).select_for_update().filter(pk=self.pk).values('cart', 'item', 'quantity').first()
+            if previous is None:
+                stock.take(self.item_id, self.quantity)
+            elif previous['item'] == self.item_id:
+                stock.take(self.item_id, self.quantity - previous['quantity'])
+            else:
+                stock.take(previous['item'], -previous['quantity'])
+                stock.take(self.item_id, self.quantity)
+            self.reserved_at = timezone.now()
+            super().save(*args, **kwargs)
+            if previous is None:
+                carts.filter(pk=self.cart_id).adjust_for_line(self.item_id, self.quantity, 1)
+                stats.adjust_for_line(self.item_id, self.quantity, 1)
+                self.changed(CartEvent.CREATED)
+            elif previous['cart'] == self.cart_id and previous['item'] == self.item_id:
+                if previous['quantity'] != self.quantity:
+                    carts.filter(pk=self.cart_id).adjust_for_line(self.item_id, self.quantity - previous['quantity'])
+                    stats.adjust_for_line(self.item_id, self.quantity - previous['quantity'])
+                    self.changed(CartEvent.UPDATED)
+            else:
+                carts.filter(pk=previous['cart']).adjust_for_line(previous['item'], -previous['quantity'], -1)
+                carts.filter(pk=self.cart_id).adjust_for_line(self.item_id, self.quantity, 1)
+                stats.adjust_for_line(previous['item'], -previous['quantity'], -1)
+                stats.adjust_for_line(self.item_id, self.quantity, 1)
+                CartEvent.objects.using(using).append([
+                    (previous['cart'], CartEvent.DELETED, self.pk, previous['item'], 0),
+                    (self.cart_id, CartEvent.CREATED, self.pk, self.item_id, self.quantity),
+                ])
+
+    def delete(self, *args, **kwargs):
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(CartItem, instance=self)
+        with StockReservation(using) as stock, transaction.atomic(using=using):
+            quantity = CartItem.objects.using(using).select_for_update().filter(pk=self.pk).values_list('quantity', flat=True).first()
+            pk = self.pk
+            result = super().delete(*args, **kwargs)
+            if quantity is not None:
+                stock.take(self.item_id, -quantity)
+                Cart.objects.using(using).filter(pk=self.cart_id).adjust_for_line(self.item_id, -quantity, -1)
+                ItemStats.objects.using(using).adjust_for_line(self.item_id, -quantity, -1)
+                CartEvent.objects.using(using).append([(self.cart_id, CartEvent.DELETED, pk, self.item_id, 0)])
+            return result
+
+    def changed(self, kind):
+        """
+        Append a change event of the given kind for this cart item to the feed of its cart. Returns the cart item.
+        """
+        CartEvent.objects.using(self._state.db).append([(self.cart_id, kind, self.pk, self.item_id, self.quantity)])
+        return self
+
     def __str__(self):
         return f'User {self.cart.user.username} Cart Item: {self.item.name} (x{self.quantity})'
+
+
+class CartEventQuerySet(ShardedQuerySet):
+    def append(self, changes):
+        """
+        Append an event for every (cart id, kind, cart item id, item id,
+        quantity) change, numbered after the last event of its cart, and
+        publish the new version of each cart once the transaction commits.
+        Must be called inside the transaction writing the changes, after
+        the carts were updated, which keeps concurrent writers to a cart
+        from numbering their events alike.
+        """
+        changes = list(changes)
+        if not changes:
+            return
+        using = self.db
+        events = self.using(using)
+        versions = dict(
+            events.filter(cart__in={change[0] for change in changes}).order_by().values('cart').annotate(last=Max('version')).values_list('cart', 'last')
+        )
+        new_events = []
+        for cart_id, kind, cart_item_id, item_id, quantity in changes:
+            versions[cart_id] = versions.get(cart_id, 0) + 1
+            new_events.append(CartEvent(cart_id=cart_id, version=versions[cart_id], kind=kind, cart_item=cart_item_id, item=item_id, quantity=quantity))
+        events.bulk_create(new_events)
+        transaction.on_commit(lambda: publish_cart_versions(versions), using=using)
+
+
+class CartEvent(models.Model):
+    """
+    A change to a cart item of a cart, numbered by a version counting the
+    events of the cart. Stored on the shard of the cart and read by the
+    change feed (see shopping_cart.feeds). The quantity is the one after
+    the change (0 for a deleted cart item), so replaying an event is harmless.
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    KINDS = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    kind = models.CharField(max_length=10, choices=KINDS)
+    # ids of the cart item and its item, which may be deleted since
+    cart_item = models.BigIntegerField()
+    item = models.BigIntegerField()
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = CartEventQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('cart', 'version')
+
+
+class ItemStatsQuerySet(ShardedQuerySet):
+    def adjust_for_line(self, item_id, quantity_delta, line_delta=0):
+        """
+        Add quantity_delta units of the given item and line_delta carts
+        holding it to its counters, creating them on first use.
+        """
+        price = Subquery(Item.objects.filter(pk=item_id).values('price')[:1])
+        changes = {
+            'cart_count': F('cart_count') + line_delta,
+            'quantity': F('quantity') + quantity_delta,
+            'reserved_value': F('reserved_value') + Coalesce(price, Value(Decimal('0'))) * quantity_delta,
+        }
+        counters = self.filter(item=item_id)
+        if not counters.update(**changes):
+            self.bulk_create([ItemStats(item_id=item_id)], ignore_conflicts=True)
+            counters.update(**changes)
+
+    def count_lines(self, lines, sign=1):
+        """
+        Add the cart items of the lines queryset (on the same shard) to the
+        counters of their items, or take them out with sign=-1, in a single
+        UPDATE (after creating the missing counters when adding).
+        """
+        lines = lines.order_by()
+        if sign > 0:
+            self.bulk_create([ItemStats(item_id=item_id) for item_id in lines.values_list('item', flat=True).distinct()], ignore_conflicts=True)
+        per_item = lines.filter(item=OuterRef('item')).values('item')
+
+        def total(aggregate, zero):
+            return Coalesce(Subquery(per_item.annotate(total=aggregate).values('total')), Value(zero))
+        return self.filter(item__in=lines.values('item')).update(
+            cart_count=F('cart_count') + sign * total(Count('pk'), 0),
+            quantity=F('quantity') + sign * total(Sum('quantity'), 0),
+            reserved_value=F('reserved_value') + sign * total(Sum(F('quantity') * F('item__price')), Decimal('0')),
+        )
+
+    def recount(self):
+        """
+        The counters of this shard recounted from its cart items in a single
+        streaming pass, without a GROUP BY over the whole table, as
+        {item id: (cart count, quantity, reserved value)}.
+        """
+        counters = {}
+        lines = CartItem.objects.using(self.db).order_by().values_list('item', 'quantity', 'item__price')
+        for item_id, quantity, price in lines.iterator(chunk_size=getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)):
+            carts, units, value = counters.get(item_id, (0, 0, Decimal('0')))
+            counters[item_id] = (carts + 1, units + quantity, value + price * quantity)
+        return counters
+
+    def rebuild(self):
+        """
+        Replace the counters of this shard with recounted ones, holding the
+        write lock of the shard meanwhile. Returns the number of items counted.
+        """
+        with transaction.atomic(using=self.db):
+            counters = self.recount()
+            self.all().delete()
+            self.bulk_create(
+                [ItemStats(item_id=item_id, cart_count=carts, quantity=units, reserved_value=value) for item_id, (carts, units, value) in counters.items()],
+                batch_size=1000,
+            )
+        return len(counters)
+
+    def top(self, field, limit):
+        """
+        The limit visible items with the highest counter field (cart_count,
+        quantity or reserved_value), over every shard, as rows of the item
+        id, name and price and its counters.
+        """
+        rows = self.filter(item__hidden=False, cart_count__gt=0).values('item', 'item__name', 'item__price', 'cart_count', 'quantity', 'reserved_value')
+        shards = cart_shards()
+        if len(shards) == 1:
+            return list(rows.using(shards[0]).order_by(f'-{field}', 'item')[:limit])
+        # the counters of an item are split over the shards holding its cart items
+        totals = {}
+        for alias in shards:
+            for row in rows.using(alias):
+                total = totals.get(row['item'])
+                if total is None:
+                    totals[row['item']] = row
+                else:
+                    for name in ItemStats.COUNTERS:
+                        total[name] += row[name]
+        return heapq.nsmallest(limit, totals.values(), key=lambda row: (-row[field], row['item']))
+
+
+class ItemStats(models.Model):
+    """
+    Popularity counters of an item over the cart items of one shard: the
+    carts holding it, their units and the value of those units. Kept up to
+    date in the transactions writing the cart items, so that rankings read
+    them instead of aggregating CartItem; the rebuild_item_stats command
+    recounts them.
+    """
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, primary_key=True)
+    cart_count = models.IntegerField(default=0, db_index=True)
+    quantity = models.IntegerField(default=0, db_index=True)
+    reserved_value = models.DecimalField(max_digits=14, decimal_places=2, default=0, db_index=True)
+
+    COUNTERS = ('cart_count', 'quantity', 'reserved_value')
+
+    objects = ItemStatsQuerySet.as_manager()
+
+
+def release_deleted_cart(sender, instance, using, **kwargs):
+    # the cart items of a deleted cart go with it without CartItem.delete(),
+    # so give their stock back and take them out of the item counters first
+    lines = CartItem.objects.using(using).filter(cart=instance.pk)
+    StockReservation(using).give_back(lines.quantities_by_item())
+    ItemStats.objects.using(using).count_lines(lines, -1)
+
+
+class DeletionJob(models.Model):
+    """
+    The deletion of an item or a user run in the background: the object is
+    hidden right away, then the cart items depending on it are deleted in
+    chunks (see shopping_cart.jobs) before the object itself.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # label of the model of the deleted object, such as shopping_cart.item
+    model = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    # cart items depending on the object when the job started, and deleted so far
+    total = models.PositiveIntegerField(null=True)
+    deleted = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Deletion of {self.model} {self.object_id} ({self.status})'
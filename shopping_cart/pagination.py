@@ -0,0 +1,28 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on the primary key. The next and previous links
+    carry the last seen id instead of an offset, so every page costs the
+    same single indexed range query no matter how deep it is.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return getattr(settings, 'MAX_PAGE_SIZE', 1000)
+
+
+class SearchPagination(LimitOffsetPagination):
+    """
+    Offset pagination for ranked search results, which have no stable key
+    to resume from. The page size is read from the same page_size parameter.
+    """
+    limit_query_param = 'page_size'
+
+    @property
+    def max_limit(self):
+        return getattr(settings, 'MAX_PAGE_SIZE', 1000)
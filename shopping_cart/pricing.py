@@ -0,0 +1,90 @@
+"""
+Batch pricing of hypothetical carts, for pricing simulations that need the
+totals of many carts at once. Cart.total_cost() sums Decimals over the
+cart items of one stored cart, with a query per cart; price_carts()
+instead reads the price of every item involved once, as integer cents,
+and totals every cart with integer arithmetic, making a single Decimal
+per cart. Integer cents are exact, so the totals are the ones
+total_cost() gives for carts holding the same cart items.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+
+from .models import Item
+from .sharding import PRIMARY
+
+# item ids looked up per query
+PRICE_QUERY_BATCH = 10000
+
+
+def max_carts():
+    return getattr(settings, 'MAX_PRICE_BATCH_CARTS', 50000)
+
+
+def item_cents(item_ids, using=PRIMARY):
+    """
+    {item id: price in cents} of the visible items among item_ids.
+    """
+    item_ids = list(item_ids)
+    prices = {}
+    for start in range(0, len(item_ids), PRICE_QUERY_BATCH):
+        rows = Item.objects.using(using).visible().filter(pk__in=item_ids[start:start + PRICE_QUERY_BATCH]).values_list('id', 'price')
+        # prices have two decimal places, so shifting them by two digits is exact
+        prices.update((pk, int(price.scaleb(2))) for pk, price in rows)
+    return prices
+
+
+def price_carts(carts, prices=None, using=PRIMARY):
+    """
+    Total costs, as Decimals, of carts given as lists of (item id, quantity)
+    pairs, with the prices from item_cents() (loaded here when not given).
+    Raises Item.DoesNotExist when an item is not among the prices.
+    """
+    carts = [list(lines) for lines in carts]
+    if prices is None:
+        prices = item_cents({item_id for lines in carts for item_id, _ in lines}, using=using)
+    try:
+        # integer products and sums, with a single Decimal per cart
+        return [Decimal(sum([prices[item_id] * quantity for item_id, quantity in lines])).scaleb(-2) for lines in carts]
+    except KeyError as exc:
+        raise Item.DoesNotExist(f'Item {exc.args[0]} does not exist')
+
+
+def parse_int(value):
+    """
+    value as an int when it is one or a string of one, else None.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_cart(lines):
+    """
+    Check the shape of a cart of [item id, quantity] pairs and return
+    (errors, None) or (None, [(item id, quantity), ...]).
+    """
+    if not isinstance(lines, list):
+        return {'non_field_errors': ['Expected a list of [item id, quantity] pairs.']}, None
+    parsed, errors = [], {}
+    for position, line in enumerate(lines):
+        if not isinstance(line, (list, tuple)) or len(line) != 2:
+            errors[position] = ['Expected an [item id, quantity] pair.']
+            continue
+        item_id, quantity = map(parse_int, line)
+        if item_id is None:
+            errors[position] = [f'Incorrect type. Expected pk value, received {type(line[0]).__name__}.']
+        elif quantity is None:
+            errors[position] = ['A valid integer is required.']
+        elif quantity < 0:
+            # the same bound as the quantity of CartItemSerializer
+            errors[position] = ['Ensure this value is greater than or equal to 0.']
+        else:
+            parsed.append((item_id, quantity))
+    if errors:
+        return errors, None
+    return None, parsed
@@ -0,0 +1,156 @@
+"""
+Bulk user provisioning. Password hashing (PBKDF2 by default) is by design
+the slowest part of creating a user, so provision_users() validates a
+batch of {username, password} entries, hashes the passwords in a pool of
+worker processes spread over every core and inserts the users (and,
+optionally, their carts) with bulk_create(), in one transaction on every
+shard so that a failure leaves no user without its copies or its cart.
+"""
+import os
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
+
+from .models import Cart
+from .serializers import UserSerializer
+from .sharding import PRIMARY, cart_shards, group_by_shard, replicate, shard_for_user
+
+# most passwords handed to a worker process at once
+HASH_CHUNK_SIZE = 32
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def hash_workers():
+    return getattr(settings, 'PASSWORD_HASH_WORKERS', None) or os.cpu_count() or 1
+
+
+def _setup_worker():
+    # worker processes started with spawn instead of fork import Django from scratch
+    django.setup()
+
+
+def password_pool(workers):
+    """
+    The process pool of the given size, started on first use and kept for
+    the next batches of this process.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, initializer=_setup_worker)
+        return pool
+
+
+def hash_passwords(passwords, workers=None):
+    """
+    make_password() every password, in worker processes when there is more
+    than one worker and more than one password.
+    """
+    workers = workers or hash_workers()
+    if workers < 2 or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    chunksize = max(1, min(HASH_CHUNK_SIZE, len(passwords) // (workers * 4)))
+    try:
+        return list(password_pool(workers).map(make_password, passwords, chunksize=chunksize))
+    except BrokenProcessPool:
+        # a worker died (killed or out of memory): start a new pool next time, hash here this time
+        with _pools_lock:
+            _pools.pop(workers, None)
+        return [make_password(password) for password in passwords]
+
+
+def user_fields():
+    """
+    The username and password fields of UserSerializer, without the
+    per-row uniqueness query: provision_users() checks a whole batch at once.
+    """
+    fields = UserSerializer().fields
+    username = fields['username']
+    username.validators = [validator for validator in username.validators if not isinstance(validator, UniqueValidator)]
+    return {'username': username, 'password': fields['password']}
+
+
+def validate_entry(entry, fields):
+    if not isinstance(entry, dict):
+        return {'non_field_errors': ['Invalid data. Expected a dictionary.']}, None
+    values, errors = {}, {}
+    for name, field in fields.items():
+        try:
+            values[name] = field.run_validation(entry.get(name, serializers.empty))
+        except serializers.ValidationError as exc:
+            errors[name] = exc.detail
+    return errors or None, values
+
+
+def provision_users(entries, create_carts=False, workers=None, fields=None):
+    """
+    Create a user for every valid {username, password} entry, and a cart
+    for each of them with create_carts. Returns one result per entry, in
+    order: {'index', 'status': 'created', 'id'} or {'index', 'status': 'error', 'errors'}.
+    """
+    fields = fields or user_fields()
+    results = []
+    valid = {}
+    for index, entry in enumerate(entries):
+        errors, values = validate_entry(entry, fields)
+        if errors is None and values['username'] in valid:
+            errors = {'username': ['A user with that username appears earlier in the batch.']}
+        if errors is not None:
+            results.append({'index': index, 'status': 'error', 'errors': errors})
+        else:
+            valid[values['username']] = index
+            results.append({'index': index, 'status': None, 'username': values['username'], 'password': values['password']})
+
+    taken = set(User.objects.using(PRIMARY).filter(username__in=valid).values_list('username', flat=True)) if valid else set()
+    pending = [result for result in results if result['status'] is None and result['username'] not in taken]
+    hashes = hash_passwords([result.pop('password') for result in pending], workers)
+    users = [User(username=result['username'], password=password) for result, password in zip(pending, hashes)]
+
+    with ExitStack() as stack:
+        for alias in dict.fromkeys([PRIMARY, *cart_shards()]):
+            stack.enter_context(transaction.atomic(using=alias))
+        while users:
+            try:
+                with transaction.atomic(using=PRIMARY):
+                    User.objects.using(PRIMARY).bulk_create(users)
+                break
+            except IntegrityError:
+                # another request created some of the usernames since they were checked
+                taken |= set(User.objects.using(PRIMARY).filter(username__in=[user.username for user in users]).values_list('username', flat=True))
+                remaining = [user for user in users if user.username not in taken]
+                if len(remaining) == len(users):
+                    # not a username taken in the meantime, so retrying would fail again
+                    raise
+                users = remaining
+
+        if users and any(user.pk is None for user in users):
+            ids = dict(User.objects.using(PRIMARY).filter(username__in=[user.username for user in users]).values_list('username', 'id'))
+            for user in users:
+                user.pk = ids[user.username]
+        # bulk_create skips the signals copying users to the cart shards
+        replicate(User, users)
+        if create_carts:
+            for shard, user_ids in group_by_shard([user.pk for user in users], shard_for_user).items():
+                Cart.objects.using(shard).bulk_create([Cart(user_id=user_id) for user_id in user_ids])
+
+    ids = {user.username: user.pk for user in users}
+    for result in results:
+        if result['status'] is None:
+            username = result.pop('username')
+            result.pop('password', None)
+            if username in ids:
+                result.update(status='created', id=ids[username])
+            else:
+                result.update(status='error', errors={'username': ['A user with that username already exists.']})
+    return results
@@ -0,0 +1,263 @@
+"""
+In-memory catalog search. SearchIndex keeps an inverted index of the
+tokens of every item name and description, a sorted vocabulary for
+prefix lookups and the items sorted by price for range filters. It is
+built from the database on first use and then kept up to date by the
+Item save/delete signals of this process; when the catalog version moves
+because of another process (or a bulk write that skips the signals, see
+catalog_changed), the next search rebuilds it.
+"""
+import gc
+import heapq
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+
+from .cache import catalog_changed_locally, get_catalog_version
+from .serializers import ItemValuesSerializer
+from .sharding import PRIMARY
+
+TOKEN_RE = re.compile(r'\w+')
+# weight of a query token matching an item token exactly or as a prefix, in the name or the description
+NAME_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+PREFIX_FACTOR = 0.5
+# sorts after every token starting with the same characters
+PREFIX_END = '\U0010ffff'
+
+ORDERINGS = ('relevance', 'price', '-price', 'name', '-name', 'id', '-id')
+
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+class SearchResults:
+    """
+    The items matching a search, ranked lazily: slicing only sorts the
+    rows in front of the end of the slice.
+    """
+
+    def __init__(self, index, ids, scores, ordering):
+        self.index = index
+        self.ids = ids
+        self.scores = scores
+        self.ordering = ordering
+
+    def __len__(self):
+        return len(self.ids)
+
+    def key(self):
+        rows, scores = self.index.rows, self.scores
+        field = self.ordering.lstrip('-')
+        if field == 'relevance':
+            return lambda pk: (-scores.get(pk, 0), pk)
+        if field == 'id':
+            return None
+        if field == 'price':
+            prices = self.index.prices
+            return lambda pk: (prices[pk], pk)
+        return lambda pk: (rows[pk]['name'].lower(), pk)
+
+    def __getitem__(self, index):
+        start, stop = index.start or 0, index.stop
+        reverse = self.ordering.startswith('-')
+        # writes and rebuilds change the index in other threads; rows are replaced, never changed, so the
+        # rows of the page taken under the lock stay as they were while they are serialized
+        with self.index.lock:
+            key, rows = self.key(), self.index.rows
+            # skip the items removed since the search
+            ids = [pk for pk in self.ids if pk in rows]
+            if stop is None or stop >= len(ids):
+                ids = sorted(ids, key=key, reverse=reverse)
+            elif reverse:
+                ids = heapq.nlargest(stop, ids, key=key)
+            else:
+                ids = heapq.nsmallest(stop, ids, key=key)
+            page = [rows[pk] for pk in ids[start:stop]]
+        return ItemValuesSerializer(page, many=True).data
+
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+        self.clear()
+
+    def clear(self):
+        self.rows = {}
+        self.prices = {}
+        self.tokens = {}
+        # token -> ids of the items with the token in their name / description
+        self.name_postings = {}
+        self.description_postings = {}
+        self.vocabulary = []
+        # (price, id) of every item, sorted
+        self.by_price = []
+
+    def build(self):
+        from .models import Item
+
+        with self.lock:
+            version = get_catalog_version()
+            self.clear()
+            rows = Item.objects.using(PRIMARY).visible().values(*ItemValuesSerializer.values_fields())
+            # the build allocates millions of small containers, which would
+            # otherwise set off the cyclic garbage collector over and over
+            collecting = gc.isenabled()
+            gc.disable()
+            try:
+                for row in rows.iterator(chunk_size=getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)):
+                    self._add(row)
+            finally:
+                if collecting:
+                    gc.enable()
+            self.vocabulary = sorted(set(self.name_postings) | set(self.description_postings))
+            self.by_price.sort()
+            self.version = version
+
+    def sync(self):
+        """
+        Rebuild the index unless every catalog change since it was last
+        synced was made by this process, whose signals already applied it.
+        """
+        version = get_catalog_version()
+        if version == self.version:
+            return
+        with self.lock:
+            if self.version is not None and catalog_changed_locally(self.version, version):
+                self.version = version
+            else:
+                self.build()
+
+    def _add(self, row):
+        # the rows are only serialized when they make it to a page of results
+        pk = row['id']
+        name_tokens, description_tokens = tokenize(row['name']), tokenize(row['description'])
+        self.rows[pk] = row
+        self.prices[pk] = row['price']
+        self.tokens[pk] = (name_tokens, description_tokens)
+        for tokens, postings in ((name_tokens, self.name_postings), (description_tokens, self.description_postings)):
+            for token in tokens:
+                ids = postings.get(token)
+                if ids is None:
+                    postings[token] = {pk}
+                else:
+                    ids.add(pk)
+        self.by_price.append((row['price'], pk))
+        return name_tokens | description_tokens
+
+    def _known(self, token):
+        position = bisect_left(self.vocabulary, token)
+        return position < len(self.vocabulary) and self.vocabulary[position] == token
+
+    def _remove(self, pk):
+        if pk not in self.rows:
+            return
+        name_tokens, description_tokens = self.tokens.pop(pk)
+        for tokens, postings in ((name_tokens, self.name_postings), (description_tokens, self.description_postings)):
+            for token in tokens:
+                postings[token].discard(pk)
+                if not postings[token]:
+                    # the token stays in the vocabulary, where it matches nothing
+                    del postings[token]
+        price = self.prices.pop(pk)
+        position = bisect_left(self.by_price, (price, pk))
+        del self.by_price[position]
+        del self.rows[pk]
+
+    def update(self, row):
+        with self.lock:
+            if self.version is None:
+                return
+            self._remove(row['id'])
+            for token in self._add(row):
+                if not self._known(token):
+                    insort(self.vocabulary, token)
+            # keep by_price sorted: move the new entry from the end to its place
+            entry = self.by_price.pop()
+            insort(self.by_price, entry)
+
+    def delete(self, pk):
+        with self.lock:
+            if self.version is not None:
+                self._remove(pk)
+
+    def _matches(self, token):
+        """
+        Scores of the items matching a query token, as a word or a word prefix.
+        """
+        scores = {}
+        # every vocabulary token the query token is a prefix of, however many
+        start, end = bisect_left(self.vocabulary, token), bisect_right(self.vocabulary, token + PREFIX_END)
+        for position in range(start, end):
+            candidate = self.vocabulary[position]
+            factor = 1.0 if candidate == token else PREFIX_FACTOR
+            for postings, weight in ((self.name_postings, NAME_WEIGHT), (self.description_postings, DESCRIPTION_WEIGHT)):
+                score = weight * factor
+                for pk in postings.get(candidate, ()):
+                    if scores.get(pk, 0) < score:
+                        scores[pk] = score
+        return scores
+
+    def search(self, query='', min_price=None, max_price=None, ordering='relevance'):
+        """
+        The items whose name or description contain every token of the
+        query, as words or word prefixes, within the price range.
+        """
+        self.sync()
+        with self.lock:
+            tokens = tokenize(query)
+            # a query without any word matches nothing
+            scores = {} if query and not tokens else None
+            for token in sorted(tokens, key=len, reverse=True):
+                matches = self._matches(token)
+                if scores is None:
+                    scores = matches
+                else:
+                    # keep the smaller dict on the outside of the intersection
+                    small, large = (scores, matches) if len(scores) <= len(matches) else (matches, scores)
+                    scores = {pk: score + large[pk] for pk, score in small.items() if pk in large}
+                if not scores:
+                    break
+
+            if min_price is not None or max_price is not None:
+                low = 0 if min_price is None else bisect_left(self.by_price, (min_price,))
+                high = len(self.by_price) if max_price is None else bisect_right(self.by_price, (max_price, float('inf')))
+                if scores is None:
+                    ids = list(map(itemgetter(1), self.by_price[low:high]))
+                else:
+                    ids = [pk for pk in scores if (min_price is None or self.prices[pk] >= min_price)
+                           and (max_price is None or self.prices[pk] <= max_price)]
+            else:
+                ids = list(scores) if scores is not None else list(self.rows)
+            if scores is None and ordering == 'relevance':
+                ordering = 'id'
+            return SearchResults(self, ids, scores or {}, ordering)
+
+
+index = SearchIndex()
+
+
+def _row(instance):
+    return {name: getattr(instance, name) for name in ItemValuesSerializer.values_fields()}
+
+
+def item_saved(sender, instance, using, **kwargs):
+    if using == PRIMARY and instance.hidden:
+        item_deleted(sender, instance, using)
+    elif using == PRIMARY:
+        row = _row(instance)
+        row['price'] = Decimal(str(row['price']))
+        transaction.on_commit(lambda: index.update(row), using=using)
+
+
+def item_deleted(sender, instance, using, **kwargs):
+    if using == PRIMARY:
+        pk = instance.pk
+        transaction.on_commit(lambda: index.delete(pk), using=using)
@@ -1,8 +1,29 @@
+from decimal import Decimal
+
+from django.core.exceptions import ObjectDoesNotExist
 from rest_framework import serializers
-from .models import Item, Cart, CartItem
+from rest_framework.validators import UniqueTogetherValidator
+from .models import Item, Cart, CartItem, DeletionJob
+from .sharding import group_by_shard, shard_for_id, shard_for_user
 from django.contrib.auth.models import User
 
-class UserSerializer(serializers.ModelSerializer):
+class SparseFieldsSerializerMixin:
+    """
+    Only output the fields listed in the fields key of the context (set
+    from ?fields= by the views) for the top level rows of a response;
+    nested serializers keep all their fields.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        names = self.context.get('fields')
+        parent = self.parent.parent if isinstance(self.parent, serializers.ListSerializer) else self.parent
+        if names is not None and parent is None:
+            fields = {name: field for name, field in fields.items() if name in names}
+        return fields
+
+
+class UserSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'password')
@@ -11,22 +32,221 @@ class UserSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         return User.objects.create_user(**validated_data)
 
-class ItemSerializer(serializers.ModelSerializer):
+class ItemSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Item
-        fields = ['id', 'name', 'description', 'price']
+        fields = ['id', 'name', 'description', 'price', 'sku', 'stock']
+        # the cached catalog responses would show a stale stock, so it is read from GET /api/admin/items/<id>/stock/
+        extra_kwargs = {'stock': {'write_only': True}}
+
+
+class CartPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Look the cart up on the shard its id belongs to.
+    """
+
+    def to_internal_value(self, data):
+        try:
+            shard = shard_for_id(data)
+        except (TypeError, ValueError):
+            return super().to_internal_value(data)
+        try:
+            return self.get_queryset().using(shard).get(pk=data)
+        except ObjectDoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+
+
+class CartShardUniqueTogetherValidator(UniqueTogetherValidator):
+    """
+    UniqueTogetherValidator run on the shard of the cart.
+    """
+
+    def filter_queryset(self, attrs, queryset, serializer):
+        cart = attrs.get('cart', getattr(serializer.instance, 'cart', None))
+        if cart is not None:
+            queryset = queryset.using(cart._state.db)
+        return super().filter_queryset(attrs, queryset, serializer)
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
+    cart = CartPrimaryKeyRelatedField(queryset=Cart.objects.all())
+    # items being deleted in the background cannot be added to carts
+    item = serializers.PrimaryKeyRelatedField(queryset=Item.objects.visible())
+
     class Meta:
         model = CartItem
         fields = ['id', 'cart', 'item', 'quantity']
+        extra_kwargs = {'quantity': {'min_value': 0}}
+        validators = [CartShardUniqueTogetherValidator(queryset=CartItem.objects.all(), fields=('cart', 'item'))]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if 'item' in data and 'item' in self.context.get('expand', ()):
+            # one ItemSerializer for every cart item of a list, so its fields are only built once
+            if not hasattr(self, '_item_serializer'):
+                self._item_serializer = ItemSerializer()
+            data['item'] = self._item_serializer.to_representation(instance.item)
+        return data
+
+    def validate_cart(self, cart):
+        if self.instance is not None and cart._state.db != self.instance._state.db:
+            raise serializers.ValidationError('A cart item cannot be moved to a cart stored on another shard.')
+        return cart
 
 
-class CartSerializer(serializers.ModelSerializer):
-    items = CartItemSerializer(many=True, read_only=True)
-    total_cost = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
+class CartSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
+    items = CartItemSerializer(source='cartitem_set', many=True, read_only=True)
+    total_cost = serializers.DecimalField(source='running_total', max_digits=12, decimal_places=2, read_only=True)
 
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'items', 'total_cost']
\ No newline at end of file
+        fields = ['id', 'user', 'items', 'total_cost', 'item_count']
+        read_only_fields = ['item_count']
+        # replaced by validate_user, which looks on the shard of the user
+        extra_kwargs = {'user': {'validators': []}}
+
+    def validate_user(self, user):
+        shard = shard_for_user(user.pk)
+        carts = Cart.objects.using(shard).filter(user=user)
+        if self.instance is not None:
+            if shard != self.instance._state.db:
+                raise serializers.ValidationError('A cart cannot be moved to a user whose carts are stored on another shard.')
+            carts = carts.exclude(pk=self.instance.pk)
+        if carts.exists():
+            raise serializers.ValidationError('cart with this user already exists.')
+        return user
+
+class DeletionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeletionJob
+        fields = ['id', 'model', 'object_id', 'status', 'total', 'deleted', 'error', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+def decimal_formatter(decimal_places):
+    """
+    Format a Decimal the way a DecimalField with the given decimal places
+    (and COERCE_DECIMAL_TO_STRING) represents it.
+    """
+    exponent = Decimal(1).scaleb(-decimal_places)
+
+    def format_decimal(value):
+        return '{:f}'.format(value.quantize(exponent))
+    return format_decimal
+
+
+format_money = decimal_formatter(2)
+
+
+class ValuesSerializer:
+    """
+    Read-only counterpart of a ModelSerializer for rows of QuerySet.values().
+    Subclasses list their output fields as (name, values key, formatter)
+    once; every row is then mapped straight to a dict, without building
+    model instances or running the serializer field machinery, and with
+    the same output as the ModelSerializer.
+    """
+    fields = ()
+
+    def __init__(self, instance, many=False, fields=None):
+        self.instance = instance
+        self.many = many
+        if fields is not None:
+            # only output the given field names
+            self.fields = tuple(field for field in self.fields if field[0] in fields)
+
+    @classmethod
+    def values_fields(cls, names=None):
+        """
+        The values() keys read by the given output fields, all of them by default.
+        """
+        return list(dict.fromkeys(key for name, key, _ in cls.fields if names is None or name in names))
+
+    def to_representation(self, row):
+        return {
+            name: row[key] if formatter is None or row[key] is None else formatter(row[key])
+            for name, key, formatter in self.fields
+        }
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row) for row in self.instance]
+        return self.to_representation(self.instance)
+
+
+class ItemValuesSerializer(ValuesSerializer):
+    fields = (
+        ('id', 'id', None),
+        ('name', 'name', None),
+        ('description', 'description', None),
+        ('price', 'price', format_money),
+        ('sku', 'sku', None),
+    )
+
+
+class CartItemValuesSerializer(ValuesSerializer):
+    fields = (
+        ('id', 'id', None),
+        ('cart', 'cart_id', None),
+        ('item', 'item_id', None),
+        ('quantity', 'quantity', None),
+    )
+
+
+class CartValuesSerializer(ValuesSerializer):
+    fields = (
+        ('id', 'id', None),
+        ('user', 'user_id', None),
+        # replaced by the cart items of the cart in to_representation()
+        ('items', 'id', None),
+        ('total_cost', 'running_total', format_money),
+        ('item_count', 'item_count', None),
+    )
+
+    def __init__(self, instance, many=False, fields=None, items=None):
+        super().__init__(instance, many, fields)
+        # serialized cart items by cart id, read from the database when not given
+        self.items = items
+
+    def to_representation(self, row):
+        data = super().to_representation(row)
+        if 'items' in data:
+            data['items'] = self.items[row['id']]
+        return data
+
+    @property
+    def data(self):
+        carts = list(self.instance) if self.many else [self.instance]
+        if self.items is None:
+            # the cart items of every cart in one query per shard, like the prefetch used with CartSerializer
+            self.items = {cart['id']: [] for cart in carts}
+            if carts and any(name == 'items' for name, _, _ in self.fields):
+                item_serializer = CartItemValuesSerializer(None)
+                for shard, cart_ids in group_by_shard(self.items).items():
+                    rows = CartItem.objects.using(shard).filter(cart__in=cart_ids).order_by('pk').values(*CartItemValuesSerializer.values_fields())
+                    for row in rows:
+                        self.items[row['cart_id']].append(item_serializer.to_representation(row))
+        data = [self.to_representation(cart) for cart in carts]
+        return data if self.many else data[0]
+
+
+class CartEventValuesSerializer(ValuesSerializer):
+    fields = (
+        ('version', 'version', None),
+        ('kind', 'kind', None),
+        ('cart_item', 'cart_item', None),
+        ('item', 'item', None),
+        ('quantity', 'quantity', None),
+        ('created_at', 'created_at', serializers.DateTimeField().to_representation),
+    )
+
+
+class ItemStatsValuesSerializer(ValuesSerializer):
+    fields = (
+        ('item', 'item', None),
+        ('name', 'item__name', None),
+        ('price', 'item__price', format_money),
+        ('cart_count', 'cart_count', None),
+        ('quantity', 'quantity', None),
+        ('reserved_value', 'reserved_value', format_money),
+    )
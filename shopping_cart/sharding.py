@@ -0,0 +1,268 @@
+"""
+Cart sharding. Carts and cart items are stored on one of the databases
+listed in settings.CART_SHARDS, picked from the id of the user owning
+the cart. Users and items are written to the primary database and copied
+to every other shard, so that the foreign keys and joins of a cart (its
+user, the prices of its items) resolve on the shard holding it.
+
+Each shard hands out cart and cart item ids from its own range: the
+index of the shard in CART_SHARDS goes in the bits above SHARD_ID_BITS.
+The shard of a cart or cart item is therefore known from its id alone,
+and walking the shards in order walks the rows in id order.
+"""
+from copy import copy
+from itertools import chain, islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import QuerySet
+
+PRIMARY = DEFAULT_DB_ALIAS
+SHARD_ID_BITS = 40
+SHARDED_MODELS = ('shopping_cart.cart', 'shopping_cart.cartitem', 'shopping_cart.cartevent', 'shopping_cart.itemstats')
+# copied from the primary database to every shard
+REPLICATED_MODELS = ('auth.user', 'shopping_cart.item')
+
+
+def cart_shards():
+    return list(getattr(settings, 'CART_SHARDS', [PRIMARY]))
+
+
+def replica_databases():
+    return [alias for alias in cart_shards() if alias != PRIMARY]
+
+
+def shard_for_user(user_id):
+    shards = cart_shards()
+    return shards[int(user_id) % len(shards)]
+
+
+def shard_for_id(pk):
+    """
+    The shard holding the cart or cart item with the given id.
+    """
+    if isinstance(pk, bool):
+        raise TypeError('a cart or cart item id is required')
+    shards = cart_shards()
+    return shards[(int(pk) >> SHARD_ID_BITS) % len(shards)]
+
+
+def shard_for_instance(instance):
+    label = instance._meta.label_lower
+    if label == 'auth.user' and instance.pk is not None:
+        return shard_for_user(instance.pk)
+    if label == 'shopping_cart.cart':
+        if instance.pk is not None:
+            return shard_for_id(instance.pk)
+        if instance.user_id is not None:
+            return shard_for_user(instance.user_id)
+    if label == 'shopping_cart.cartitem':
+        if instance.pk is not None:
+            return shard_for_id(instance.pk)
+        if instance.cart_id is not None:
+            return shard_for_id(instance.cart_id)
+    # cart events have ids of their own shard, but not from its range
+    if label == 'shopping_cart.cartevent' and instance.cart_id is not None:
+        return shard_for_id(instance.cart_id)
+    return instance._state.db
+
+
+def is_sharded(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+class CartShardRouter:
+    """
+    Send carts and cart items to their shard whenever Django passes the
+    instance involved, and everything else to the primary database.
+    Queries without an instance go to the primary database too, so views
+    pick the shard with using() or spread a listing with on_shards().
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if is_sharded(model) and instance is not None:
+            return shard_for_instance(instance)
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # users and items exist on every shard
+        if obj1._meta.label_lower in REPLICATED_MODELS or obj2._meta.label_lower in REPLICATED_MODELS:
+            return True
+        return None
+
+
+def on_shards(queryset, pk=None, user=None):
+    """
+    Route a cart or cart item queryset to the shard holding the given
+    cart/cart item id or the cart of the given user id, or spread it over
+    every shard. Ids that are not numbers leave the queryset as it is, so
+    filtering on them fails the same way it does without shards.
+    """
+    shards = cart_shards()
+    if not is_sharded(queryset.model) or queryset._db is not None or len(shards) == 1:
+        return queryset
+    try:
+        if pk is not None:
+            return queryset.using(shard_for_id(pk))
+        if user is not None:
+            return queryset.using(shard_for_user(user))
+    except (TypeError, ValueError):
+        return queryset
+    return FanOutQuerySet([queryset.using(alias) for alias in shards])
+
+
+def group_by_shard(ids, shard=shard_for_id):
+    groups = {}
+    for pk in ids:
+        groups.setdefault(shard(pk), []).append(pk)
+    return groups
+
+
+class FanOutQuerySet:
+    """
+    Read-only view of the same query run on several shards, in shard order.
+    Methods returning a queryset are applied to every shard; rows are read
+    shard after shard, which is id order because of the id ranges, and a
+    slice stops querying shards once it has enough rows. Only id ordering
+    is supported, which is all pagination and exports need.
+    """
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+        self.model = querysets[0].model
+
+    def __getattr__(self, name):
+        method = getattr(type(self.querysets[0]), name)
+
+        def apply(*args, **kwargs):
+            results = [method(queryset, *args, **kwargs) for queryset in self.querysets]
+            if isinstance(results[0], QuerySet):
+                return FanOutQuerySet(results)
+            return results
+        return apply
+
+    def _ordered(self):
+        ordering = self.querysets[0].query.order_by
+        if ordering and ordering[0] not in ('pk', 'id', '-pk', '-id'):
+            raise ValueError('rows spread over shards can only be ordered by id')
+        if ordering and ordering[0].startswith('-'):
+            return self.querysets[::-1]
+        return self.querysets
+
+    def __iter__(self):
+        return chain.from_iterable(self._ordered())
+
+    def __len__(self):
+        return sum(len(queryset) for queryset in self.querysets)
+
+    def __bool__(self):
+        return any(queryset.exists() for queryset in self.querysets)
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            return self[index:index + 1][0]
+        if index.step is not None or (index.start or 0) < 0 or (index.stop is not None and index.stop < 0):
+            raise ValueError('only positive slices without a step are supported')
+        start, stop = index.start or 0, index.stop
+        rows = []
+        for queryset in self._ordered():
+            if stop is None:
+                rows.extend(queryset)
+            elif len(rows) < stop:
+                rows.extend(queryset[:stop - len(rows)])
+        return rows[start:stop]
+
+    def iterator(self, chunk_size=None):
+        kwargs = {} if chunk_size is None else {'chunk_size': chunk_size}
+        return chain.from_iterable(queryset.iterator(**kwargs) for queryset in self._ordered())
+
+    def count(self):
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def exists(self):
+        return bool(self)
+
+    def first(self):
+        return next(iter(self[:1]), None)
+
+    def in_bulk(self, id_list):
+        """
+        QuerySet.in_bulk() run on the shards holding the given ids only.
+        """
+        querysets = {queryset.db: queryset for queryset in self.querysets}
+        objects = {}
+        for alias, ids in group_by_shard(id_list).items():
+            objects.update(querysets[alias].in_bulk(ids))
+        return objects
+
+    def get(self, *args, **kwargs):
+        rows = list(islice(chain.from_iterable(queryset.filter(*args, **kwargs)[:2] for queryset in self.querysets), 2))
+        if not rows:
+            raise self.model.DoesNotExist(f'{self.model._meta.object_name} matching query does not exist.')
+        if len(rows) > 1:
+            raise self.model.MultipleObjectsReturned(f'get() returned more than one {self.model._meta.object_name}')
+        return rows[0]
+
+
+def replicate(model, objs):
+    """
+    Copy rows saved on the primary database to every other shard.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    for alias in replica_databases():
+        model._base_manager.using(alias).bulk_create(
+            [copy(obj) for obj in objs], update_conflicts=True, unique_fields=[model._meta.pk.name], update_fields=fields,
+        )
+
+
+def replicate_ids(model, ids, batch_size=1000):
+    """
+    Copy the rows with the given ids from the primary database to every other shard.
+    """
+    if not replica_databases():
+        return
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        replicate(model, model._base_manager.using(PRIMARY).filter(pk__in=ids[start:start + batch_size]))
+
+
+def replicate_saved(sender, instance, using, **kwargs):
+    if using == PRIMARY:
+        replicate(sender, [instance])
+
+
+def replicate_deleted(sender, instance, using, **kwargs):
+    # deleting the copies also deletes the carts and cart items pointing at them on each shard
+    if using == PRIMARY:
+        for alias in replica_databases():
+            sender._base_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def reserve_id_ranges(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Make the cart and cart item ids of the given shard start at its range.
+    Connected to post_migrate, and safe to run again.
+    """
+    from .models import Cart, CartItem
+
+    shards = cart_shards()
+    if using not in shards:
+        return
+    start = shards.index(using) << SHARD_ID_BITS
+    if not start:
+        return
+    with connections[using].cursor() as cursor:
+        for model in (Cart, CartItem):
+            table = model._meta.db_table
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            elif row[0] < start:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
@@ -0,0 +1,68 @@
+"""
+Expiry of stock reservations. Every cart item of an item with stock holds
+its quantity of the stock (see ItemQuerySet.reserve and StockReservation)
+from the last change of its quantity, its reserved_at. Carts are often
+abandoned, so expire_reservations() removes the cart items of stocked
+items left unchanged for STOCK_RESERVATION_TTL seconds, a chunk at a time,
+and gives their units back with a single UPDATE per chunk. Cart items of
+items without stock are never expired.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import active_carts
+from .jobs import delete_chunk_size
+from .models import Cart, CartEvent, CartItem, ItemStats, StockReservation
+from .sharding import cart_shards
+from .transactions import retry_on_locked
+
+
+def reservation_ttl():
+    return getattr(settings, 'STOCK_RESERVATION_TTL', 1800)
+
+
+def expire_reservations(ttl=None):
+    """
+    Remove the cart items of stocked items unchanged for ttl seconds
+    (STOCK_RESERVATION_TTL by default) from their carts and give their
+    stock back. Returns the number of cart items removed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=reservation_ttl() if ttl is None else ttl)
+    expired = 0
+    for alias in cart_shards():
+        while (count := expire_chunk(alias, cutoff)) is not None:
+            expired += count
+    return expired
+
+
+@retry_on_locked
+def expire_chunk(alias, cutoff):
+    """
+    Remove up to DELETE_CHUNK_SIZE expired cart items of the shard in one
+    transaction that also keeps the totals of their carts, the counters of
+    their items and the change feeds in step. Returns the number of cart
+    items removed, or None when none had expired.
+    """
+    expired = CartItem.objects.using(alias).filter(reserved_at__lt=cutoff, item__stock__isnull=False)
+    cart_ids = set(expired.values_list('cart', flat=True)[:delete_chunk_size()])
+    if not cart_ids:
+        return None
+    # the active-cart store may hold newer quantities for these carts, which persisting renews
+    with active_carts.bypass(cart_ids):
+        with StockReservation(alias) as stock, transaction.atomic(using=alias):
+            rows = list(expired.filter(cart__in=cart_ids).values_list('id', 'cart', 'item', 'quantity'))
+            if not rows:
+                return 0
+            quantities = {}
+            for _, _, item_id, quantity in rows:
+                quantities[item_id] = quantities.get(item_id, 0) + quantity
+            stock.give_back(quantities)
+            chunk = CartItem.objects.using(alias).filter(pk__in=[pk for pk, _, _, _ in rows])
+            ItemStats.objects.using(alias).count_lines(chunk, -1)
+            deleted = chunk._raw_delete(alias)
+            Cart.objects.using(alias).filter(pk__in=cart_ids).refresh_totals()
+            CartEvent.objects.using(alias).append((cart_id, CartEvent.DELETED, pk, item_id, 0) for pk, cart_id, item_id, _ in rows)
+    return deleted
@@ -1,10 +1,35 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIClient
 from rest_framework.views import status
-from .models import Item, Cart, CartItem
+from . import active_carts, pricing
+from .benchmark import ENDPOINTS, measure, seed
+from .cache import CATALOG_VERSION_KEY, USER_CART_KEY, active_cart_cache, user_cart_cache
+from .instrumentation import count_query, registry
+from .models import Item, Cart, CartEvent, CartEventQuerySet, CartItem, DeletionJob, ItemStats, OutOfStock
+from .provisioning import provision_users
+from .search import index
 from .serializers import ItemSerializer, CartSerializer, CartItemSerializer, UserSerializer
+from .sharding import SHARD_ID_BITS, reserve_id_ranges, shard_for_id, shard_for_user
+from .transactions import retry_on_locked
 
 class BaseViewTest(APITestCase):
     client = APIClient()
@@ -30,6 +55,9 @@ class BaseViewTest(APITestCase):
             return CartItem.objects.create(cart=cart, item=item, quantity=quantity)
 
     def setUp(self):
+        cache.clear()
+        user_cart_cache().clear()
+
         # create a user
         self.user1 = self.create_user("testuser1", "testpassword1")
         self.user2 = self.create_user("testuser2", "testpassword2")
@@ -60,7 +88,7 @@ class GetAllUsersTest(BaseViewTest):
         # fetch the data from db
         expected = User.objects.all()
         serialized = UserSerializer(expected, many=True)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 class GetAllItemsTest(BaseViewTest):
@@ -75,7 +103,7 @@ class GetAllItemsTest(BaseViewTest):
         # fetch the data from db
         expected = Item.objects.all()
         serialized = ItemSerializer(expected, many=True)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 class GetAllCartsTest(BaseViewTest):
@@ -90,7 +118,7 @@ class GetAllCartsTest(BaseViewTest):
         # fetch the data from db
         expected = Cart.objects.all()
         serialized = CartSerializer(expected, many=True)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 class GetAllCartItemsTest(BaseViewTest):
@@ -105,7 +133,7 @@ class GetAllCartItemsTest(BaseViewTest):
         # fetch the data from db
         expected = CartItem.objects.all()
         serialized = CartItemSerializer(expected, many=True)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
     
     def test_get_all_cart_items_user_given(self):
@@ -117,8 +145,8 @@ class GetAllCartItemsTest(BaseViewTest):
         response = self.client.get(f"{reverse('cartitem-list')}?user={self.user1.id}")
         expected = CartItem.objects.all().filter(cart__user__id=self.user1.id)
         serialized = CartItemSerializer(expected, many=True)
-        self.assertEqual(len(response.data), 2)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
     
     def test_get_cart_items_cart_given(self):
@@ -130,8 +158,8 @@ class GetAllCartItemsTest(BaseViewTest):
         response = self.client.get(f"{reverse('cartitem-list')}?cart={self.cart2.id}")
         expected = CartItem.objects.all().filter(cart__id=self.cart2.id)
         serialized = CartItemSerializer(expected, many=True)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data, serialized.data)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 class GetCartTest(BaseViewTest):
@@ -158,8 +186,8 @@ class GetCartTest(BaseViewTest):
         response = self.client.get(f"{reverse('cart-list')}?user={self.user1.id}")
         expected = Cart.objects.get(pk=self.cart1.id)
         serialized = CartSerializer(expected)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0], serialized.data)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0], serialized.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
@@ -371,3 +399,1696 @@ class DeleteCartItemTest(BaseViewTest):
 
         cart1_item1_found = CartItem.objects.all().filter(id=self.cart1_item1.id)
         self.assertEqual(cart1_item1_found.count(), 0)
+
+class CartQueryCountTest(BaseViewTest):
+    def test_get_all_carts_query_count(self):
+        """
+        This test ensures that listing carts runs a fixed number of queries
+        (carts with their totals, then the prefetched cart items)
+        no matter how many carts and cart items exist
+        """
+        for i in range(5):
+            user = self.create_user(f"bulkuser{i}", "bulkpassword")
+            cart = self.create_cart(user)
+            self.create_cart_item(cart, self.item1, i + 1)
+            self.create_cart_item(cart, self.item2, 1)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("cart-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 7)
+        self.assertEqual(response.data['results'][0]["total_cost"], "50.00")
+        self.assertEqual(len(response.data['results'][0]["items"]), 2)
+
+    def test_get_total_cost_query_count(self):
+        """
+        This test ensures that the total cost of a cart is computed in a single query
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("cart-total-cost", kwargs={"pk": self.cart1.id}))
+        self.assertEqual(response.data["total_cost"], 50.0)
+
+    def test_get_total_cost_for_empty_cart(self):
+        """
+        This test ensures that a cart without cart items has a total cost of zero
+        """
+        user = self.create_user("emptyuser", "emptypassword")
+        cart = self.create_cart(user)
+        response = self.client.get(reverse("cart-total-cost", kwargs={"pk": cart.id}))
+        self.assertEqual(response.data["total_cost"], 0)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+class StoredCartTotalsTest(BaseViewTest):
+    def assertStoredTotals(self, cart, total_cost, item_count):
+        cart.refresh_from_db()
+        self.assertEqual(cart.running_total, Decimal(total_cost))
+        self.assertEqual(cart.item_count, item_count)
+        self.assertEqual(cart.total_cost(), cart.running_total)
+
+    def test_stored_totals_follow_cart_item_writes(self):
+        """
+        Ensure creating, updating and deleting cart items keeps the stored cart totals current
+        """
+        self.assertStoredTotals(self.cart1, "50.00", 2)
+        item3 = self.create_item("item3", "description3", 2.5)
+        response = self.client.post(reverse('cartitem-list'), {'cart': self.cart1.id, 'item': item3.id, 'quantity': 4}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertStoredTotals(self.cart1, "60.00", 3)
+
+        url = reverse('cartitem-detail', kwargs={'pk': self.cart1_item2.id})
+        response = self.client.patch(url, {'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertStoredTotals(self.cart1, "40.00", 3)
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertStoredTotals(self.cart1, "20.00", 2)
+
+    def test_stored_totals_follow_item_price_changes(self):
+        """
+        Ensure changing or deleting an item updates the stored totals of every cart holding it
+        """
+        url = reverse('item-detail', kwargs={'pk': self.item1.id})
+        response = self.client.patch(url, {'price': 12.5}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertStoredTotals(self.cart1, "52.50", 2)
+        self.assertStoredTotals(self.cart2, "62.50", 1)
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertStoredTotals(self.cart1, "40.00", 1)
+        self.assertStoredTotals(self.cart2, "0.00", 0)
+
+    def test_get_cart_reads_stored_totals(self):
+        """
+        Ensure the cart endpoints serve the stored totals without scanning cart items
+        """
+        response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart1.id}))
+        self.assertEqual(response.data["total_cost"], "50.00")
+        self.assertEqual(response.data["item_count"], 2)
+
+    def test_rebuild_cart_totals_command(self):
+        """
+        Ensure the rebuild_cart_totals command detects and repairs stale stored totals
+        """
+        Cart.objects.filter(pk=self.cart1.id).update(running_total=0, item_count=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_cart_totals', '--check', stdout=StringIO())
+        call_command('rebuild_cart_totals', stdout=StringIO())
+        self.assertStoredTotals(self.cart1, "50.00", 2)
+        call_command('rebuild_cart_totals', '--check', stdout=StringIO())
+
+class BulkCartItemTest(BaseViewTest):
+    def test_bulk_upsert_cart_items(self):
+        """
+        Ensure many cart items can be created and updated in one request
+        with a fixed number of queries, and that errors are reported per entry
+        """
+        item3 = self.create_item("item3", "description3", 25.0)
+        url = reverse('cartitem-bulk')
+        data = [
+            {'cart': self.cart1.id, 'item': self.item1.id, 'quantity': 4},
+            {'user': self.user1.id, 'item': item3.id, 'quantity': 2},
+            {'cart': self.cart2.id, 'item': self.item2.id, 'quantity': 1},
+            {'cart': self.cart2.id, 'item': 9999, 'quantity': 1},
+            {'cart': self.cart2.id, 'item': self.item2.id, 'quantity': -1},
+        ]
+        # carts, items, then existing lines, stock of each item, item counters, upsert, totals and change feed events inside a savepoint
+        with self.assertNumQueries(17):
+            response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['updated', 'created', 'created', 'error', 'error'])
+        self.assertIn('item', results[3]['errors'])
+        self.assertIn('quantity', results[4]['errors'])
+
+        self.assertEqual(CartItem.objects.get(cart=self.cart1, item=self.item1).quantity, 4)
+        self.assertEqual(CartItem.objects.get(cart=self.cart1, item=item3).quantity, 2)
+        self.cart1.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("130.00"))
+        self.assertEqual(self.cart1.item_count, 3)
+        self.cart2.refresh_from_db()
+        self.assertEqual(self.cart2.running_total, Decimal("70.00"))
+
+    def test_bulk_upsert_requires_list(self):
+        """
+        Ensure the bulk endpoint rejects a request body that is not a list
+        """
+        response = self.client.post(reverse('cartitem-bulk'), {'cart': self.cart1.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class AddCartItemQuantityTest(BaseViewTest):
+    def test_add_quantity_to_existing_cart_item(self):
+        """
+        Ensure adding to an existing cart item increments its quantity in place
+        """
+        url = reverse('cartitem-add')
+        response = self.client.post(url, {'cart': self.cart1.id, 'item': self.item1.id, 'quantity': 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['quantity'], 4)
+        response = self.client.post(url, {'user': self.user1.id, 'item': self.item1.id, 'quantity': -1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['quantity'], 3)
+        self.cart1.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("70.00"))
+
+    def test_add_quantity_creates_cart_item(self):
+        """
+        Ensure adding an item that is not yet in the cart creates the cart item
+        """
+        response = self.client.post(reverse('cartitem-add'), {'cart': self.cart2.id, 'item': self.item2.id, 'quantity': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(CartItem.objects.get(cart=self.cart2, item=self.item2).quantity, 2)
+        self.cart2.refresh_from_db()
+        self.assertEqual(self.cart2.running_total, Decimal("90.00"))
+        self.assertEqual(self.cart2.item_count, 2)
+
+    def test_remove_quantity_deletes_cart_item(self):
+        """
+        Ensure a cart item is deleted once its quantity reaches zero
+        """
+        response = self.client.post(reverse('cartitem-add'), {'cart': self.cart1.id, 'item': self.item2.id, 'quantity': -5}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(CartItem.objects.filter(pk=self.cart1_item2.id).exists())
+        self.cart1.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("10.00"))
+        self.assertEqual(self.cart1.item_count, 1)
+
+    def test_add_quantity_to_missing_item(self):
+        """
+        Ensure adding an item that does not exist returns 404
+        """
+        response = self.client.post(reverse('cartitem-add'), {'cart': self.cart1.id, 'item': 9999, 'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_add_zero_quantity_creates_nothing(self):
+        """
+        Ensure adding a zero quantity of an item that is not in the cart creates no cart item
+        """
+        response = self.client.post(reverse('cartitem-add'), {'cart': self.cart2.id, 'item': self.item2.id, 'quantity': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart2, item=self.item2).exists())
+        with override_settings(ACTIVE_CART_STORE=True):
+            active_cart_cache().clear()
+            response = self.client.post(reverse('cartitem-add'), {'cart': self.cart2.id, 'item': self.item2.id, 'quantity': 0}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+class CatalogCacheTest(BaseViewTest):
+    def test_item_list_is_served_from_cache(self):
+        """
+        Ensure a repeated GET of the items list is served from the cache with a stable ETag
+        """
+        url = reverse("item-list")
+        response = self.client.get(url)
+        etag = response["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.data['results'], ItemSerializer(Item.objects.all(), many=True).data)
+
+    def test_if_none_match_returns_not_modified(self):
+        """
+        Ensure a client sending the current ETag gets a 304 without any database query
+        """
+        for url in (reverse("item-list"), reverse("item-detail", kwargs={"pk": self.item1.id}), reverse("user-available-items")):
+            etag = self.client.get(url)["ETag"]
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(response["ETag"], etag)
+
+    def test_item_writes_invalidate_cache(self):
+        """
+        Ensure creating, updating and deleting items changes the ETag and the cached data
+        """
+        url = reverse("item-list")
+        etag = self.client.get(url)["ETag"]
+        self.client.post(url, {'name': 'New Item', 'description': 'New Description', 'price': 30.0}, format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 3)
+
+        detail_url = reverse("item-detail", kwargs={"pk": self.item1.id})
+        self.client.get(detail_url)
+        self.client.patch(detail_url, {'price': 15.0}, format='json')
+        self.assertEqual(self.client.get(detail_url).data['price'], '15.00')
+
+        self.client.delete(detail_url)
+        self.assertEqual(self.client.get(detail_url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.client.get(url).data['results']), 2)
+
+class PaginationTest(BaseViewTest):
+    def test_cursor_pagination_walks_all_pages(self):
+        """
+        Ensure list endpoints are paginated on the primary key and the next
+        links walk through every row exactly once
+        """
+        for i in range(5):
+            self.create_item(f"pageitem{i}", "description", 1.0)
+        url = f"{reverse('item-list')}?page_size=3"
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, list(Item.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_page_size_is_capped(self):
+        """
+        Ensure a client cannot ask for more than MAX_PAGE_SIZE rows in one page
+        """
+        for i in range(3):
+            self.create_user(f"pageuser{i}", "pagepassword")
+        with self.settings(MAX_PAGE_SIZE=2):
+            response = self.client.get(f"{reverse('user-list')}?page_size=100")
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_filters_are_kept_across_pages(self):
+        """
+        Ensure the user and cart filters still apply on following pages
+        """
+        response = self.client.get(f"{reverse('cartitem-list')}?user={self.user1.id}&page_size=1")
+        self.assertEqual(response.data['results'][0]['id'], self.cart1_item1.id)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'][0]['id'], self.cart1_item2.id)
+        self.assertIsNone(response.data['next'])
+
+class ExportTest(BaseViewTest):
+    def test_export_items_as_ndjson(self):
+        """
+        Ensure the items export streams one JSON object per item
+        """
+        response = self.client.get(f"{reverse('item-export')}?format=ndjson")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], f'{{"id": {self.item1.id}, "name": "item1", "description": "description1", "price": "10.00", "sku": null}}')
+        self.assertEqual(len(lines), 2)
+
+    def test_export_carts_as_csv(self):
+        """
+        Ensure the carts export streams a CSV with the stored totals and honours the user filter
+        """
+        response = self.client.get(f"{reverse('cart-export')}?format=csv&user={self.user1.id}")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(), ["id,user,total_cost,item_count", f"{self.cart1.id},{self.user1.id},50.00,2"])
+
+    def test_export_command(self):
+        """
+        Ensure the export command writes every cart item
+        """
+        out = StringIO()
+        call_command('export', 'cartitems', '--format', 'csv', '--chunk-size', '1', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 4)
+
+class ImportItemsTest(BaseViewTest):
+    def write_file(self, content, suffix):
+        f = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_import_items_creates_and_updates_by_sku(self):
+        """
+        Ensure import_items creates new items, updates existing ones by sku,
+        skips invalid rows and updates the totals of carts holding repriced items
+        """
+        Item.objects.filter(pk=self.item1.id).update(sku="SKU-1")
+        path = self.write_file(
+            "sku,name,description,price\n"
+            "SKU-1,item1,description1,12.00\n"
+            "SKU-2,New Item,New Description,3.50\n"
+            "SKU-3,Bad Item,Bad Description,not a price\n"
+            "SKU-4,,Missing name,1.00\n",
+            ".csv",
+        )
+        err = StringIO()
+        call_command('import_items', path, '--batch-size', '2', stdout=StringIO(), stderr=err)
+        self.assertEqual(Item.objects.count(), 3)
+        self.assertEqual(Item.objects.get(sku="SKU-1").price, Decimal("12.00"))
+        self.assertEqual(Item.objects.get(sku="SKU-2").name, "New Item")
+        self.assertIn("Row 3", err.getvalue())
+        self.assertIn("Row 4", err.getvalue())
+        self.cart2.refresh_from_db()
+        self.assertEqual(self.cart2.running_total, Decimal("60.00"))
+        self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+
+    def test_import_items_resumes_from_checkpoint(self):
+        """
+        Ensure an import run with --resume skips the rows of committed batches
+        """
+        path = self.write_file(
+            '{"sku": "A", "name": "A", "description": "first", "price": 1}\n'
+            '{"sku": "B", "name": "B", "description": "second", "price": 2}\n',
+            ".ndjson",
+        )
+        with open(f"{path}.checkpoint", "w") as f:
+            f.write('{"rows": 1}')
+        self.addCleanup(lambda: os.path.exists(f"{path}.checkpoint") and os.remove(f"{path}.checkpoint"))
+        call_command('import_items', path, '--resume', stdout=StringIO())
+        self.assertFalse(Item.objects.filter(sku="A").exists())
+        self.assertEqual(Item.objects.get(sku="B").price, Decimal("2.00"))
+
+    def test_import_items_reports_ndjson_rows_that_are_not_objects(self):
+        """
+        Ensure NDJSON lines holding valid JSON that is not an object are reported as failed rows
+        """
+        path = self.write_file('[1, 2]\n"x"\n{"sku": "C", "name": "C", "description": "third", "price": 3}\n', ".ndjson")
+        err = StringIO()
+        call_command('import_items', path, stdout=StringIO(), stderr=err)
+        self.assertIn("Row 1: {'non_field_errors': ['Invalid data. Expected a dictionary, but got list.']}", err.getvalue())
+        self.assertIn("Row 2", err.getvalue())
+        self.assertEqual(Item.objects.get(sku="C").price, Decimal("3.00"))
+
+class ValuesSerializerTest(BaseViewTest):
+    def test_values_serializers_match_model_serializers(self):
+        """
+        Ensure the responses served from .values() rows are byte for byte
+        the same as the ones of the ModelSerializers
+        """
+        self.create_cart(self.create_user("emptyuser", "emptypassword"))
+        Item.objects.filter(pk=self.item2.id).update(sku="SKU-2")
+        urls = [
+            reverse("item-list"),
+            reverse("item-detail", kwargs={"pk": self.item2.id}),
+            reverse("user-available-items"),
+            reverse("cart-list"),
+            f"{reverse('cart-list')}?user={self.user1.id}",
+            reverse("cart-detail", kwargs={"pk": self.cart1.id}),
+            reverse("cartitem-list"),
+            f"{reverse('cartitem-list')}?cart={self.cart1.id}&page_size=1",
+            reverse("cartitem-detail", kwargs={"pk": self.cart2_item1.id}),
+        ]
+        for url in urls:
+            contents = []
+            for fast in (True, False):
+                cache.clear()
+                with self.settings(FAST_READ_SERIALIZERS=fast):
+                    response = self.client.get(url, HTTP_ACCEPT="application/json")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                contents.append(response.content)
+            self.assertEqual(contents[0], contents[1], url)
+
+    def test_values_serializers_query_count(self):
+        """
+        Ensure the fast read path keeps a fixed number of queries for carts
+        """
+        with self.settings(FAST_READ_SERIALIZERS=True), self.assertNumQueries(2):
+            self.client.get(reverse("cart-list"))
+        with self.settings(FAST_READ_SERIALIZERS=True), self.assertNumQueries(1):
+            self.client.get(reverse("cartitem-list"))
+
+class QueryBudgetTest(BaseViewTest):
+    def test_endpoints_stay_within_query_budget(self):
+        """
+        Ensure no endpoint runs more SQL queries than its budget in
+        shopping_cart.benchmark, however many rows there are
+        """
+        seed(items=20, users=10, cart_items=60)
+        ids = {'user': self.user1.id, 'cart': self.cart1.id, 'item': self.item1.id, 'cart_item': self.cart1_item1.id}
+        for endpoint in ENDPOINTS:
+            with self.subTest(endpoint=endpoint.name):
+                result = measure(self.client, endpoint, ids, iterations=2, clear_cache=True)
+                self.assertLessEqual(result['queries'], endpoint.budget)
+
+class RequestMetricsTest(BaseViewTest):
+    def test_server_timing_header(self):
+        """
+        Ensure every response carries the database and serialization time in a Server-Timing header
+        """
+        response = self.client.get(reverse("cart-list"))
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="2 queries", serialize;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_metrics_endpoint(self):
+        """
+        Ensure the metrics endpoint exposes per viewset action histograms in the Prometheus text format
+        """
+        registry.clear()
+        self.client.get(reverse("cart-list"))
+        self.client.get(reverse("cart-total-cost", kwargs={"pk": self.cart1.id}))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = response.content.decode()
+        self.assertIn('# TYPE shopping_cart_request_duration_seconds histogram', content)
+        self.assertIn('shopping_cart_db_queries_bucket{view="CartViewSet.list",le="2"} 1', content)
+        self.assertIn('shopping_cart_db_queries_bucket{view="CartViewSet.total_cost",le="+Inf"} 1', content)
+        self.assertIn('shopping_cart_response_size_bytes_count{view="CartViewSet.list"} 1', content)
+
+    @override_settings(CART_FEED_TIMEOUT=0.3, CART_FEED_POLL_INTERVAL=0.05)
+    async def test_concurrent_async_requests_count_their_own_queries(self):
+        """
+        Ensure queries run while async requests overlap are counted for the request running them only
+        """
+        feed = reverse("cart-changes", kwargs={"pk": self.cart1.id})
+        version = (await self.async_client.get(feed)).json()["version"]
+        waiting = asyncio.ensure_future(self.async_client.get(feed, {"since": version}))
+        await asyncio.sleep(0.05)
+        listing = await self.async_client.get(reverse("cart-list"))
+        waited = await waiting
+        self.assertIn('desc="2 queries"', listing["Server-Timing"])
+        self.assertIn('desc="0 queries"', waited["Server-Timing"])
+        # installed once on the connection running the queries, never stacked
+        self.assertEqual(await sync_to_async(lambda: connection.execute_wrappers.count(count_query))(), 1)
+
+class SQLiteProfileTest(BaseViewTest):
+    def test_connection_pragmas(self):
+        """
+        Ensure new connections run the PRAGMAs of the database OPTIONS
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(cursor.fetchone()[0], -64000)
+        self.assertEqual(connection.transaction_mode, "IMMEDIATE")
+
+    def test_lock_errors_are_not_retried_inside_a_transaction(self):
+        """
+        Ensure a lock error inside an enclosing transaction is raised at once
+        """
+        calls = []
+
+        @retry_on_locked
+        def write():
+            calls.append(1)
+            raise OperationalError("database is locked")
+
+        with transaction.atomic(), self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(calls), 1)
+
+    def test_contention_command(self):
+        """
+        Ensure the contention benchmark commits every transaction with the tuned profile
+        """
+        out = StringIO()
+        call_command("sqlite_contention", threads=2, transactions=10, carts=1, profile=["tuned"], stdout=out)
+        self.assertRegex(out.getvalue(), r"tuned\s+20\s+0\s")
+
+class RetryOnLockedTest(SimpleTestCase):
+    def test_retries_lock_errors(self):
+        """
+        Ensure lock errors are retried until the call succeeds
+        """
+        calls = []
+
+        @retry_on_locked
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError("database is locked")
+            return "done"
+
+        with self.settings(DATABASE_LOCK_BACKOFF=0):
+            self.assertEqual(write(), "done")
+        self.assertEqual(len(calls), 3)
+
+    def test_gives_up_after_the_last_retry(self):
+        """
+        Ensure the lock error is raised once DATABASE_LOCK_RETRIES is exhausted
+        and other errors are never retried
+        """
+        calls = []
+
+        @retry_on_locked
+        def write(message):
+            calls.append(1)
+            raise OperationalError(message)
+
+        with self.settings(DATABASE_LOCK_RETRIES=2, DATABASE_LOCK_BACKOFF=0):
+            with self.assertRaises(OperationalError):
+                write("database is locked")
+            self.assertEqual(len(calls), 3)
+            with self.assertRaises(OperationalError):
+                write("no such table: shopping_cart_cart")
+            self.assertEqual(len(calls), 4)
+
+class ShardTransactionRetryTest(TransactionTestCase):
+    databases = {"default", "carts_1"}
+
+    def test_lock_errors_inside_a_shard_transaction_are_not_retried(self):
+        """
+        Ensure a lock error inside a transaction on a cart shard, not the default database, is raised at once
+        """
+        calls = []
+
+        @retry_on_locked
+        def write():
+            calls.append(1)
+            raise OperationalError("database is locked")
+
+        with transaction.atomic(using="carts_1"), self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(calls), 1)
+
+@override_settings(CART_SHARDS=["default", "carts_1", "carts_2"])
+class ShardingTest(BaseViewTest):
+    databases = {"default", "carts_1", "carts_2"}
+
+    def setUp(self):
+        for alias in ("default", "carts_1", "carts_2"):
+            reserve_id_ranges(using=alias)
+        super().setUp()
+
+    def test_carts_are_stored_on_the_shard_of_their_user(self):
+        """
+        Ensure carts and cart items are written to the shard of their user, with ids from its range,
+        and users and items are copied to every shard
+        """
+        self.assertNotEqual(self.cart1._state.db, self.cart2._state.db)
+        for user, cart, cart_item in ((self.user1, self.cart1, self.cart1_item1), (self.user2, self.cart2, self.cart2_item1)):
+            shard = shard_for_user(user.id)
+            self.assertEqual(cart._state.db, shard)
+            self.assertEqual(shard_for_id(cart.id), shard)
+            self.assertEqual(shard_for_id(cart_item.id), shard)
+            self.assertTrue(Cart.objects.using(shard).filter(pk=cart.id, user=user).exists())
+            self.assertEqual(Cart.objects.using(shard).get(pk=cart.id).running_total, cart.total_cost())
+        for alias in ("carts_1", "carts_2"):
+            self.assertEqual(User.objects.using(alias).count(), 2)
+            self.assertEqual(Item.objects.using(alias).count(), 2)
+        self.assertGreater(max(self.cart1.id, self.cart2.id), 1 << SHARD_ID_BITS)
+
+    def test_listings_fan_out_over_the_shards(self):
+        """
+        Ensure cart and cart item listings and exports merge every shard in id order, page after page
+        """
+        for cart in (self.cart1, self.cart2):
+            cart.refresh_from_db()
+        carts = sorted([self.cart1, self.cart2], key=lambda cart: cart.id)
+        response = self.client.get(reverse("cart-list"))
+        self.assertEqual(response.data["results"], CartSerializer(carts, many=True).data)
+
+        seen = []
+        url = reverse("cartitem-list") + "?page_size=1"
+        while url:
+            response = self.client.get(url)
+            seen.extend(row["id"] for row in response.data["results"])
+            url = response.data["next"]
+        self.assertEqual(seen, sorted([self.cart1_item1.id, self.cart1_item2.id, self.cart2_item1.id]))
+
+        response = self.client.get(reverse("cart-export") + "?format=ndjson")
+        self.assertEqual(b"".join(response.streaming_content).count(b"\n"), 2)
+
+    def test_item_stats_merge_the_shards(self):
+        """
+        Ensure the counters of an item are kept on the shards of its cart items and summed for the rankings
+        """
+        self.create_cart_item(self.cart2, self.item2, 20)
+        for cart in (self.cart1, self.cart2):
+            self.assertTrue(ItemStats.objects.using(cart._state.db).filter(item=self.item2).exists())
+        response = self.client.get(reverse("item-stats") + "?ordering=quantity")
+        self.assertEqual(
+            [(row["item"], row["cart_count"], row["quantity"], row["reserved_value"]) for row in response.data["results"]],
+            [(self.item2.id, 2, 22, "440.00"), (self.item1.id, 2, 6, "60.00")],
+        )
+
+    def test_reads_by_id_and_user_use_one_shard(self):
+        """
+        Ensure detail routes, the user filters and the cart_id lookup find rows stored on any shard
+        """
+        for user, cart in ((self.user1, self.cart1), (self.user2, self.cart2)):
+            cart.refresh_from_db()
+            response = self.client.get(reverse("cart-detail", kwargs={"pk": cart.id}))
+            self.assertEqual(response.data, CartSerializer(cart).data)
+            response = self.client.get(reverse("cart-total-cost", kwargs={"pk": cart.id}))
+            self.assertEqual(response.data["total_cost"], cart.total_cost())
+            response = self.client.get(reverse("cart-cart-id") + f"?user={user.id}")
+            self.assertEqual(response.data, {"cart": cart.id})
+            response = self.client.get(reverse("cartitem-list") + f"?user={user.id}")
+            self.assertEqual(len(response.data["results"]), cart.item_count)
+        response = self.client.get(reverse("cartitem-detail", kwargs={"pk": self.cart2_item1.id}))
+        self.assertEqual(response.data, CartItemSerializer(self.cart2_item1).data)
+
+    def test_multi_get_reads_the_shards_of_the_ids(self):
+        """
+        Ensure a cart multi-get finds carts on every shard and only queries the shards of the ids
+        """
+        for cart in (self.cart1, self.cart2):
+            cart.refresh_from_db()
+        url = reverse("cart-list") + f"?ids={self.cart2.id},{self.cart1.id}&expand=item"
+        response = self.client.get(url)
+        self.assertEqual([cart["id"] for cart in response.data["results"]], [self.cart2.id, self.cart1.id])
+        self.assertEqual(response.data["results"][1]["items"][1]["item"], ItemSerializer(self.item2).data)
+        with self.assertNumQueries(2, using=self.cart1._state.db), self.assertNumQueries(0, using=self.cart2._state.db):
+            self.client.get(reverse("cart-list") + f"?ids={self.cart1.id}&expand=item")
+
+    def test_bulk_users_and_carts_reach_their_shards(self):
+        """
+        Ensure bulk provisioned users are copied to every shard and their carts stored on the shard of each user
+        """
+        data = [{"username": f"bulkuser{n}", "password": "bulkpassword"} for n in range(4)]
+        with self.settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]):
+            response = self.client.post(reverse("user-bulk") + "?carts=true", data, format="json")
+        for result in response.data["results"]:
+            for alias in ("default", "carts_1", "carts_2"):
+                self.assertTrue(User.objects.using(alias).filter(pk=result["id"]).exists())
+            cart = Cart.objects.using(shard_for_user(result["id"])).get(user=result["id"])
+            self.assertEqual(shard_for_id(cart.id), shard_for_user(result["id"]))
+
+    @override_settings(BACKGROUND_JOBS=False, DELETE_CHUNK_SIZE=1)
+    def test_background_item_deletion_covers_every_shard(self):
+        """
+        Ensure a background item deletion removes the cart items holding it on every shard
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse("item-detail", kwargs={"pk": self.item1.id}) + "?mode=background")
+        self.assertEqual(DeletionJob.objects.get().deleted, 2)
+        for alias in ("default", "carts_1", "carts_2"):
+            self.assertFalse(CartItem.objects.using(alias).filter(item=self.item1.id).exists())
+            self.assertFalse(Item.objects.using(alias).filter(pk=self.item1.id).exists())
+        self.assertEqual(Cart.objects.using(self.cart2._state.db).get(pk=self.cart2.id).item_count, 0)
+
+    def test_cart_item_writes_go_to_the_cart_shard(self):
+        """
+        Ensure creating, adding to, bulk writing, updating and deleting cart items keep the totals on their shard
+        """
+        response = self.client.post(reverse("cartitem-list"), {"user": self.user2.id, "item": self.item2.id, "quantity": 1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse("cartitem-list"), {"cart": self.cart2.id, "item": self.item2.id, "quantity": 1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse("cartitem-add"), {"cart": self.cart1.id, "item": self.item1.id, "quantity": 2}, format="json")
+        self.assertEqual(response.data["quantity"], 3)
+        response = self.client.post(reverse("cartitem-bulk"), [
+            {"cart": self.cart1.id, "item": self.item2.id, "quantity": 4},
+            {"user": self.user2.id, "item": self.item1.id, "quantity": 1},
+        ], format="json")
+        self.assertEqual([result["status"] for result in response.data["results"]], ["updated", "updated"])
+        response = self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart2_item1.id}), {"quantity": 2}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.cart1.refresh_from_db()
+        self.cart2.refresh_from_db()
+        self.assertEqual((self.cart1.running_total, self.cart1.item_count), (Decimal("30.00"), 1))
+        self.assertEqual((self.cart2.running_total, self.cart2.item_count), (Decimal("40.00"), 2))
+        call_command("rebuild_cart_totals", check=True, stdout=StringIO())
+
+    def test_catalog_and_user_changes_reach_every_shard(self):
+        """
+        Ensure repricing or deleting an item updates the carts of every shard, and deleting a user deletes its cart
+        """
+        self.client.patch(reverse("item-detail", kwargs={"pk": self.item1.id}), {"price": "15.00"}, format="json")
+        for alias in ("carts_1", "carts_2"):
+            self.assertEqual(Item.objects.using(alias).get(pk=self.item1.id).price, Decimal("15.00"))
+        self.cart1.refresh_from_db()
+        self.cart2.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("55.00"))
+        self.assertEqual(self.cart2.running_total, Decimal("75.00"))
+
+        self.client.delete(reverse("item-detail", kwargs={"pk": self.item1.id}))
+        self.cart2.refresh_from_db()
+        self.assertEqual((self.cart2.running_total, self.cart2.item_count), (Decimal("0.00"), 0))
+        self.assertFalse(CartItem.objects.using(self.cart2._state.db).filter(item=self.item1.id).exists())
+
+        shard = self.cart2._state.db
+        self.client.delete(reverse("user-detail", kwargs={"pk": self.user2.id}))
+        self.assertFalse(Cart.objects.using(shard).filter(pk=self.cart2.id).exists())
+        self.assertFalse(User.objects.using(shard).filter(pk=self.user2.id).exists())
+
+class UserCartCacheTest(BaseViewTest):
+    def test_cart_id_is_cached(self):
+        """
+        Ensure the cart of a user is read from the database once and then served from the cache
+        """
+        url = reverse("cart-cart-id") + f"?user={self.user1.id}"
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).data, {"cart": self.cart1.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data, {"cart": self.cart1.id})
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("cartitem-list") + f"?user={self.user1.id}")
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.cart1_item1.id, self.cart1_item2.id])
+
+    def test_cart_changes_invalidate_the_cache(self):
+        """
+        Ensure deleting a cart, moving it to another user or deleting its user drops the cached cart id
+        """
+        user3 = self.create_user("testuser3", "testpassword3")
+        self.assertEqual(Cart.objects.id_for_user(self.user1.id), self.cart1.id)
+        response = self.client.patch(reverse("cart-detail", kwargs={"pk": self.cart1.id}), {"user": user3.id}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(Cart.objects.id_for_user(self.user1.id))
+        self.assertEqual(Cart.objects.id_for_user(user3.id), self.cart1.id)
+
+        self.client.delete(reverse("cart-detail", kwargs={"pk": self.cart1.id}))
+        response = self.client.get(reverse("cart-cart-id") + f"?user={user3.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(Cart.objects.id_for_user(self.user2.id), self.cart2.id)
+        self.client.delete(reverse("user-detail", kwargs={"pk": self.user2.id}))
+        self.assertIsNone(user_cart_cache().get(USER_CART_KEY.format(self.user2.id)))
+        response = self.client.post(reverse("cartitem-list"), {"user": self.user2.id, "item": self.item1.id, "quantity": 1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_queryset_delete_drops_the_cached_cart_id(self):
+        """
+        Ensure deleting carts with a queryset, without Cart.delete(), drops the cached cart ids of their users
+        """
+        self.assertEqual(Cart.objects.id_for_user(self.user1.id), self.cart1.id)
+        Cart.objects.filter(pk=self.cart1.id).delete()
+        self.assertIsNone(user_cart_cache().get(USER_CART_KEY.format(self.user1.id)))
+        self.assertIsNone(Cart.objects.id_for_user(self.user1.id))
+
+class ItemSearchTest(BaseViewTest):
+    def setUp(self):
+        super().setUp()
+        self.shoes = self.create_item("Red running shoes", "Light shoes for road running", 80.0)
+        self.shirt = self.create_item("Blue running shirt", "Breathable shirt", 25.0)
+        self.hat = self.create_item("Red hat", "A hat for running in the sun", 15.0)
+
+    def search(self, query):
+        return self.client.get(reverse("item-search") + query)
+
+    def test_search_ranks_prefix_and_token_matches(self):
+        """
+        Ensure items matching every query token, as words or prefixes, come back with name matches first
+        """
+        response = self.search("?q=runn")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.shoes.id, self.shirt.id, self.hat.id])
+        self.assertEqual(response.data["results"][0], ItemSerializer(Item.objects.get(pk=self.shoes.id)).data)
+
+        response = self.search("?q=red+run")
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.shoes.id, self.hat.id])
+        self.assertEqual(self.search("?q=green").data["count"], 0)
+
+    def test_prefix_matches_every_word_it_starts(self):
+        """
+        Ensure a short prefix finds the items of every word it starts, however many words there are
+        """
+        Item.objects.bulk_create([Item(name=f"Widget{n:03}", description="Spare part", price=1) for n in range(100)])
+        cache.incr(CATALOG_VERSION_KEY)
+        self.assertEqual(self.search("?q=widget").data["count"], 100)
+        self.assertEqual(self.search("?q=w").data["count"], 100)
+
+    def test_price_range_ordering_and_pagination(self):
+        """
+        Ensure results can be filtered on price, ordered and paginated
+        """
+        response = self.search("?q=running&max_price=30&ordering=-price")
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.shirt.id, self.hat.id])
+        response = self.search("?min_price=15&max_price=25&ordering=price&page_size=1")
+        self.assertEqual(response.data["count"], 3)
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.hat.id])
+        response = self.client.get(response.data["next"])
+        self.assertEqual([row["id"] for row in response.data["results"]], [self.item2.id])
+
+    def test_invalid_parameters(self):
+        """
+        Ensure a search needs a query or a price range, and rejects unknown orderings and bad prices
+        """
+        self.assertEqual(self.search("").status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.search("?q=red&ordering=popularity&min_price=abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {"ordering", "min_price"})
+
+    def test_index_follows_item_writes(self):
+        """
+        Ensure item writes update the index without a rebuild, and changes made elsewhere trigger one
+        """
+        self.search("?q=red")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse("item-detail", kwargs={"pk": self.hat.id}), {"name": "Green hat"}, format="json")
+            self.client.post(reverse("item-list"), {"name": "Red scarf", "description": "Wool", "price": "12.00"}, format="json")
+            self.client.delete(reverse("item-detail", kwargs={"pk": self.shoes.id}))
+        with self.assertNumQueries(0):
+            response = self.search("?q=red")
+        self.assertEqual([row["name"] for row in response.data["results"]], ["Red scarf"])
+
+        # a write from another process: the catalog version moves without this process' signals
+        Item.objects.filter(pk=self.shirt.id).update(name="Red shirt")
+        cache.incr(CATALOG_VERSION_KEY)
+        response = self.search("?q=red")
+        self.assertEqual([row["name"] for row in response.data["results"]], ["Red shirt", "Red scarf"])
+
+    def test_index_rebuilds_after_its_own_writes_without_an_atomic_cache(self):
+        """
+        Ensure a process trusts its own catalog versions only when the cache cannot hand them out twice
+        """
+        with tempfile.TemporaryDirectory() as location:
+            with self.settings(CACHES={**settings.CACHES, "default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}}):
+                self.search("?q=red")
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.patch(reverse("item-detail", kwargs={"pk": self.hat.id}), {"name": "Green hat"}, format="json")
+                # two processes bumping the file based cache at once can both get this version
+                with mock.patch.object(index, "build", wraps=index.build) as build:
+                    self.search("?q=red")
+                build.assert_called_once()
+
+    def test_bulk_writes_rebuild_the_index(self):
+        """
+        Ensure items written by import_items, which skips the signals, are found by the next search of the same process
+        """
+        self.search("?q=banana")
+        f = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+        f.write("sku,name,description,price\nSKU-B,Banana,Yellow fruit,1.00\n")
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        call_command("import_items", f.name, stdout=StringIO())
+        response = self.search("?q=banana")
+        self.assertEqual([row["name"] for row in response.data["results"]], ["Banana"])
+
+    def test_results_skip_items_removed_after_the_search(self):
+        """
+        Ensure a page of results taken after an item left the index leaves the item out instead of failing
+        """
+        results = index.search("red")
+        index.delete(self.hat.id)
+        self.assertEqual([row["id"] for row in results[0:10]], [self.shoes.id])
+
+class MultiGetTest(BaseViewTest):
+    def test_item_multi_get(self):
+        """
+        Ensure ?ids= returns the requested items in order with one query, and lists the missing ids
+        """
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("item-list") + f"?ids={self.item2.id},{self.item1.id},{self.item2.id},999")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"results": ItemSerializer([self.item2, self.item1], many=True).data, "missing": [999]})
+
+    def test_cart_multi_get(self):
+        """
+        Ensure ?ids= returns the requested carts with their cart items, with and without the values serializers
+        """
+        for cart in (self.cart1, self.cart2):
+            cart.refresh_from_db()
+        expected = CartSerializer([self.cart2, self.cart1], many=True).data
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_READ_SERIALIZERS=fast), self.assertNumQueries(2):
+                response = self.client.get(reverse("cart-list") + f"?ids={self.cart2.id},{self.cart1.id}")
+                self.assertEqual(response.data, {"results": expected, "missing": []})
+
+    def test_invalid_ids(self):
+        """
+        Ensure ids that are not numbers, or too many of them, are rejected
+        """
+        response = self.client.get(reverse("item-list") + "?ids=1,abc")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("ids", response.data)
+        with self.settings(MAX_PAGE_SIZE=2):
+            response = self.client.get(reverse("cart-list") + "?ids=1,2,3")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_expand_item(self):
+        """
+        Ensure ?expand=item inlines the items of cart items and carts without extra queries
+        """
+        item1, item2 = ItemSerializer(self.item1).data, ItemSerializer(self.item2).data
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("cartitem-list") + f"?cart={self.cart1.id}&expand=item")
+        self.assertEqual([row["item"] for row in response.data["results"]], [item1, item2])
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart1.id}) + "?expand=item")
+        self.assertEqual([row["item"] for row in response.data["items"]], [item1, item2])
+        self.assertEqual(response.data["items"][1]["quantity"], 2)
+
+        response = self.client.get(reverse("cartitem-list") + "?expand=cart")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("expand", response.data)
+
+class SparseFieldsTest(BaseViewTest):
+    def test_item_fields(self):
+        """
+        Ensure ?fields= trims the items to the given fields and only reads their columns
+        """
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_READ_SERIALIZERS=fast):
+                cache.clear()
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(reverse("item-list") + "?fields=id,name")
+                self.assertEqual(response.data["results"], [{"id": item.id, "name": item.name} for item in (self.item1, self.item2)])
+                self.assertEqual(len(context.captured_queries), 1)
+                self.assertNotIn("description", context.captured_queries[0]["sql"])
+
+                response = self.client.get(reverse("item-detail", kwargs={"pk": self.item1.id}) + "?fields=price")
+                self.assertEqual(response.data, {"price": "10.00"})
+
+    def test_cart_fields_skip_the_cart_items(self):
+        """
+        Ensure carts requested without their items are read with a single query, and with them otherwise
+        """
+        self.cart1.refresh_from_db()
+        for fast in (True, False):
+            with self.subTest(fast=fast), self.settings(FAST_READ_SERIALIZERS=fast):
+                with self.assertNumQueries(1):
+                    response = self.client.get(reverse("cart-list") + "?fields=id,total_cost")
+                self.assertEqual(response.data["results"][0], {"id": self.cart1.id, "total_cost": "50.00"})
+
+                with self.assertNumQueries(2):
+                    response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart1.id}) + "?fields=items")
+                self.assertEqual(response.data, {"items": CartItemSerializer([self.cart1_item1, self.cart1_item2], many=True).data})
+
+                response = self.client.get(reverse("cartitem-list") + f"?cart={self.cart1.id}&fields=item,quantity&expand=item")
+                self.assertEqual(response.data["results"][1], {"item": ItemSerializer(self.item2).data, "quantity": 2})
+
+                # the expanded relation is read even when its field is not asked for
+                with self.assertNumQueries(1):
+                    response = self.client.get(reverse("cartitem-list") + f"?cart={self.cart1.id}&fields=quantity&expand=item")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data["results"], [{"quantity": 1}, {"quantity": 2}])
+
+    def test_invalid_fields(self):
+        """
+        Ensure unknown and write only fields are rejected
+        """
+        for url in (reverse("user-list") + "?fields=id,password", reverse("cart-list") + "?fields=id,price"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("fields", response.data)
+
+    def test_writes_ignore_fields(self):
+        """
+        Ensure ?fields= does not change what writes accept or return
+        """
+        response = self.client.post(reverse("user-list") + "?fields=id", {"username": "testuser3", "password": "testpassword3"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(set(response.data), {"id", "username"})
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class ProvisionUsersTest(BaseViewTest):
+    def test_bulk_create_users_with_carts(self):
+        """
+        Ensure many users and their carts are created in one request with passwords hashed
+        by worker processes, and that errors are reported per entry
+        """
+        data = [
+            {"username": "bulkuser1", "password": "bulkpassword1"},
+            {"username": "testuser1", "password": "taken"},
+            {"username": "bulkuser2"},
+            {"username": "bulkuser1", "password": "again"},
+            {"username": "bulkuser3", "password": "bulkpassword3"},
+        ]
+        with self.settings(PASSWORD_HASH_WORKERS=2):
+            response = self.client.post(reverse("user-bulk") + "?carts=true", data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data["results"]
+        self.assertEqual([result["status"] for result in results], ["created", "error", "error", "error", "created"])
+        self.assertIn("username", results[1]["errors"])
+        self.assertIn("password", results[2]["errors"])
+        self.assertIn("username", results[3]["errors"])
+        self.assertEqual((response.data["created"], response.data["failed"]), (2, 3))
+
+        user = User.objects.get(pk=results[4]["id"])
+        self.assertTrue(user.check_password("bulkpassword3"))
+        self.assertEqual(Cart.objects.id_for_user(user.id), Cart.objects.get(user=user).id)
+
+    def test_bulk_create_users_requires_list(self):
+        """
+        Ensure the bulk endpoint rejects a request body that is not a list, or too long a list
+        """
+        response = self.client.post(reverse("user-bulk"), {"username": "bulkuser1"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(MAX_BULK_USERS=1):
+            response = self.client.post(reverse("user-bulk"), [{"username": "a", "password": "a"}] * 2, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_users_gives_up_on_other_integrity_errors(self):
+        """
+        Ensure an integrity error that no taken username explains is raised instead of retried forever
+        """
+        with mock.patch("django.db.models.QuerySet.bulk_create", side_effect=IntegrityError("CHECK constraint failed")):
+            with self.assertRaises(IntegrityError):
+                provision_users([{"username": "bulkuser1", "password": "bulkpassword1"}])
+
+    def test_bulk_create_users_is_atomic(self):
+        """
+        Ensure no user is left behind when creating the carts of the batch fails
+        """
+        with mock.patch("shopping_cart.models.CartQuerySet.bulk_create", side_effect=OperationalError("disk I/O error")):
+            with self.assertRaises(OperationalError):
+                provision_users([{"username": "bulkuser1", "password": "bulkpassword1"}], create_carts=True)
+        self.assertFalse(User.objects.filter(username="bulkuser1").exists())
+
+    def test_provision_users_command(self):
+        """
+        Ensure provision_users creates the users of a CSV file in batches and reports the invalid rows
+        """
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write("username,password\ncsvuser1,password1\ncsvuser2,password2\nnot valid!,password3\ncsvuser4,password4\n")
+        self.addCleanup(os.remove, f.name)
+        out, err = StringIO(), StringIO()
+        call_command("provision_users", f.name, "--batch-size", "2", "--workers", "2", stdout=out, stderr=err)
+        self.assertEqual(set(User.objects.filter(username__startswith="csvuser").values_list("username", flat=True)),
+                         {"csvuser1", "csvuser2", "csvuser4"})
+        self.assertFalse(Cart.objects.filter(user__username="csvuser1").exists())
+        self.assertIn("Row 3", err.getvalue())
+        self.assertIn("Created 3 users (1 failed)", out.getvalue())
+
+@override_settings(BACKGROUND_JOBS=False, DELETE_CHUNK_SIZE=1)
+class BackgroundDeletionTest(BaseViewTest):
+    def test_background_item_deletion(self):
+        """
+        Ensure an item deleted in the background is hidden right away, then removed
+        from every cart chunk by chunk and deleted, with its progress on the job
+        """
+        url = reverse("item-detail", kwargs={"pk": self.item1.id}) + "?mode=background"
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data["status"], DeletionJob.QUEUED)
+        self.assertEqual(response["Location"], "http://testserver" + reverse("deletionjob-detail", kwargs={"pk": response.data["id"]}))
+
+        # hidden before the job runs
+        self.assertEqual(self.client.get(reverse("item-detail", kwargs={"pk": self.item1.id})).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual([item["id"] for item in self.client.get(reverse("item-list")).data["results"]], [self.item2.id])
+        cart3 = self.create_cart(self.create_user("testuser3", "testpassword3"))
+        response = self.client.post(reverse("cartitem-add"), {"cart": cart3.id, "item": self.item1.id, "quantity": 1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(reverse("cartitem-list"), {"cart": cart3.id, "item": self.item1.id, "quantity": 1}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(CartItem.objects.filter(item=self.item1).exists())
+
+        for callback in callbacks:
+            callback()
+        job = self.client.get(reverse("deletionjob-detail", kwargs={"pk": DeletionJob.objects.get().id})).data
+        self.assertEqual((job["status"], job["total"], job["deleted"]), (DeletionJob.DONE, 2, 2))
+        self.assertFalse(Item.objects.filter(pk=self.item1.id).exists())
+        self.assertFalse(CartItem.objects.filter(item=self.item1.id).exists())
+        self.cart1.refresh_from_db()
+        self.assertEqual((self.cart1.running_total, self.cart1.item_count), (Decimal("40.00"), 1))
+        self.cart2.refresh_from_db()
+        self.assertEqual((self.cart2.running_total, self.cart2.item_count), (Decimal("0.00"), 0))
+
+    def test_background_user_deletion(self):
+        """
+        Ensure a user deleted in the background is hidden right away, then deleted with its cart
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse("user-detail", kwargs={"pk": self.user1.id}) + "?mode=background")
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual([user["id"] for user in self.client.get(reverse("user-list")).data["results"]], [self.user2.id])
+        self.assertEqual(DeletionJob.objects.get().deleted, 2)
+        self.assertFalse(User.objects.filter(pk=self.user1.id).exists())
+        self.assertFalse(Cart.objects.filter(pk=self.cart1.id).exists())
+        self.assertTrue(CartItem.objects.filter(cart=self.cart2).exists())
+
+    def test_inactive_users_stay_listed(self):
+        """
+        Ensure only the users being deleted in the background are hidden, not users deactivated otherwise
+        """
+        User.objects.filter(pk=self.user2.id).update(is_active=False)
+        DeletionJob.objects.create(model="auth.user", object_id=self.user1.id)
+        self.assertEqual([user["id"] for user in self.client.get(reverse("user-list")).data["results"]], [self.user2.id])
+        self.assertEqual(self.client.get(reverse("user-detail", kwargs={"pk": self.user1.id})).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_run_deletion_jobs_resumes_unfinished_jobs(self):
+        """
+        Ensure run_deletion_jobs finishes a job interrupted before it deleted anything
+        """
+        self.item2.hidden = True
+        self.item2.save()
+        job = DeletionJob.objects.create(model="shopping_cart.item", object_id=self.item2.id, status=DeletionJob.RUNNING)
+        out = StringIO()
+        call_command("run_deletion_jobs", stdout=out)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.deleted), (DeletionJob.DONE, 1))
+        self.assertFalse(Item.objects.filter(pk=self.item2.id).exists())
+        self.assertIn("Ran 1 deletion jobs", out.getvalue())
+
+@override_settings(CART_FEED_TIMEOUT=0.2, CART_FEED_POLL_INTERVAL=0.05, CART_FEED_STREAM_SECONDS=0.3)
+class CartFeedTest(BaseViewTest):
+    def changes(self, cart, query="", **headers):
+        return self.client.get(reverse("cart-changes", kwargs={"pk": cart.id}) + query, **headers)
+
+    async def read_stream(self, response):
+        return b"".join([chunk async for chunk in response]).decode()
+
+    def test_cart_item_writes_append_events(self):
+        """
+        Ensure every cart item write appends an event with the next version of its cart
+        """
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 3}, format="json")
+        self.client.post(reverse("cartitem-add"), {"cart": self.cart1.id, "item": self.item2.id, "quantity": -2}, format="json")
+        self.client.post(reverse("cartitem-bulk"), [{"cart": self.cart1.id, "item": self.item2.id, "quantity": 4}], format="json")
+        events = CartEvent.objects.filter(cart=self.cart1).order_by("version").values_list("version", "kind", "item", "quantity")
+        self.assertEqual(list(events), [
+            (1, "created", self.item1.id, 1),
+            (2, "created", self.item2.id, 2),
+            (3, "updated", self.item1.id, 3),
+            (4, "deleted", self.item2.id, 0),
+            (5, "created", self.item2.id, 4),
+        ])
+
+    def test_long_poll_returns_the_events_after_since(self):
+        """
+        Ensure a long poll starts from the current version, then gets the events of later writes
+        """
+        response = self.changes(self.cart1)
+        self.assertEqual(response.json(), {"cart": self.cart1.id, "version": 2, "events": [], "reset": False})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 3}, format="json")
+            self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        data = self.changes(self.cart1, "?since=2").json()
+        self.assertEqual(data["version"], 4)
+        self.assertEqual([(event["version"], event["kind"], event["cart_item"], event["quantity"]) for event in data["events"]],
+                         [(3, "updated", self.cart1_item1.id, 3), (4, "deleted", self.cart1_item2.id, 0)])
+
+    def test_idle_cart_costs_no_query(self):
+        """
+        Ensure waiting on a cart that does not change reads the cache only
+        """
+        self.changes(self.cart2)
+        with self.assertNumQueries(0):
+            response = self.changes(self.cart2, "?since=1")
+        self.assertEqual(response.json(), {"cart": self.cart2.id, "version": 1, "events": [], "reset": False})
+
+    def test_pruned_events_reset_the_client(self):
+        """
+        Ensure a client whose next events are gone is told to reload the cart
+        """
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 3}, format="json")
+        CartEvent.objects.filter(cart=self.cart1, version__lte=2).update(created_at=timezone.now() - timedelta(days=2))
+        out = StringIO()
+        call_command("prune_cart_events", stdout=out)
+        self.assertIn("Deleted 2 cart events", out.getvalue())
+        data = self.changes(self.cart1, "?since=1").json()
+        self.assertTrue(data["reset"])
+        self.assertEqual(data["version"], 3)
+
+    def test_pruning_keeps_the_last_event_of_each_cart(self):
+        """
+        Ensure pruning keeps the last event of an idle cart, so that its versions keep counting
+        """
+        CartEvent.objects.update(created_at=timezone.now() - timedelta(days=2))
+        call_command("prune_cart_events", retention=3600, stdout=StringIO())
+        self.assertEqual(list(CartEvent.objects.filter(cart=self.cart1).values_list("version", flat=True)), [2])
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 3}, format="json")
+        self.assertEqual(CartEvent.objects.filter(cart=self.cart1).latest("version").version, 3)
+
+    def test_deleting_an_item_appends_deleted_events(self):
+        """
+        Ensure deleting an item right away appends a deleted event for each of its cart items
+        """
+        item_id = self.item1.id
+        cart_item_ids = set(CartItem.objects.filter(item=item_id).values_list("id", flat=True))
+        self.item1.delete()
+        events = CartEvent.objects.filter(item=item_id, kind=CartEvent.DELETED)
+        self.assertEqual(set(events.values_list("cart_item", flat=True)), cart_item_ids)
+        self.assertEqual(self.changes(self.cart1, "?since=2").json()["events"][0]["kind"], "deleted")
+
+    def test_event_stream(self):
+        """
+        Ensure the changes can be streamed as Server-Sent Events resuming from Last-Event-ID
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 3}, format="json")
+        response = self.changes(self.cart1, HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID="2")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        # served under WSGI, the stream is a sync iterator
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn('id: 3\nevent: change\ndata: {"version": 3, "kind": "updated"', content)
+        self.assertNotIn("id: 2", content)
+
+    async def test_event_stream_under_asgi(self):
+        """
+        Ensure the ASGI application streams the changes asynchronously
+        """
+        headers = {"Accept": "text/event-stream", "Last-Event-ID": "1"}
+        response = await self.async_client.get(reverse("cart-changes", kwargs={"pk": self.cart1.id}), headers=headers)
+        self.assertTrue(response.is_async)
+        content = await self.read_stream(response)
+        self.assertIn('id: 2\nevent: change\ndata: {"version": 2, "kind": "created"', content)
+        self.assertIn(": keep-alive", content)
+
+    @override_settings(CART_FEED_TIMEOUT=25, CART_FEED_WSGI_TIMEOUT=0.1)
+    def test_waits_are_short_under_wsgi(self):
+        """
+        Ensure a long poll served under WSGI does not hold the worker longer than CART_FEED_WSGI_TIMEOUT
+        """
+        started = time.monotonic()
+        response = self.changes(self.cart2, "?since=1&timeout=20")
+        self.assertEqual(response.json()["events"], [])
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_invalid_requests(self):
+        """
+        Ensure a missing cart is a 404 and a bad version a 400
+        """
+        self.assertEqual(self.client.get(reverse("cart-changes", kwargs={"pk": 9999})).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.changes(self.cart1, "?since=abc").status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(ACTIVE_CART_STORE=True, BACKGROUND_JOBS=False, ACTIVE_CART_FLUSH_AFTER=30)
+class ActiveCartStoreTest(BaseViewTest):
+    def setUp(self):
+        active_cart_cache().clear()
+        super().setUp()
+
+    def add(self, item, quantity, cart=None):
+        return self.client.post(reverse("cartitem-add"), {"cart": (cart or self.cart1).id, "item": item.id, "quantity": quantity}, format="json")
+
+    def test_reads_see_their_own_writes(self):
+        """
+        Ensure the changes held by the store are read back before they reach the database
+        """
+        self.add(self.item1, 3)
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}), {"quantity": 5}, format="json")
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 1)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart1.id}))
+        self.assertEqual(response.data["total_cost"], "140.00")
+        self.assertEqual([(line["id"], line["quantity"]) for line in response.data["items"]], [(self.cart1_item1.id, 4), (self.cart1_item2.id, 5)])
+        response = self.client.get(reverse("cart-total-cost", kwargs={"pk": self.cart1.id}))
+        # a JSON number, as when the total is read from the database
+        self.assertEqual(response.json()["total_cost"], 140.0)
+        response = self.client.get(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}))
+        self.assertEqual(response.data["quantity"], 4)
+
+        self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        response = self.client.get(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart1.id}), {"fields": "total_cost,item_count"})
+        self.assertEqual(response.data, {"total_cost": "40.00", "item_count": 1})
+        # listings filtered on the cart persist it first
+        response = self.client.get(reverse("cartitem-list"), {"cart": self.cart1.id})
+        self.assertEqual([(line["id"], line["quantity"]) for line in response.data["results"]], [(self.cart1_item1.id, 4)])
+
+    def test_changes_are_persisted_in_one_batch(self):
+        """
+        Ensure the changes held for several carts are written with a few queries, once per cart item
+        """
+        for quantity in (1, 1, 1, -2):
+            self.add(self.item1, quantity)
+        self.add(self.item2, -10)
+        self.add(self.item1, 2, cart=self.cart2)
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 1)
+
+        with self.assertNumQueries(12):
+            active_carts.persist([self.cart1.id, self.cart2.id])
+        self.assertEqual(list(CartItem.objects.filter(cart=self.cart1).values_list("item", "quantity")), [(self.item1.id, 2)])
+        self.assertEqual(CartItem.objects.get(pk=self.cart2_item1.id).quantity, 7)
+        self.cart1.refresh_from_db()
+        self.assertEqual((self.cart1.running_total, self.cart1.item_count), (Decimal("20.00"), 1))
+        events = CartEvent.objects.filter(cart=self.cart1, version__gt=2).order_by("version").values_list("kind", "item", "quantity")
+        self.assertCountEqual(list(events), [("updated", self.item1.id, 2), ("deleted", self.item2.id, 0)])
+        with self.assertNumQueries(0):
+            self.assertEqual(active_carts.persist([self.cart1.id, self.cart2.id]), 0)
+
+    def test_idle_carts_are_flushed(self):
+        """
+        Ensure only the carts idle for ACTIVE_CART_FLUSH_AFTER seconds are flushed, unless all are asked for
+        """
+        self.add(self.item1, 1)
+        self.assertEqual(active_carts.flush_idle(), 0)
+        with override_settings(ACTIVE_CART_FLUSH_AFTER=0):
+            self.assertEqual(active_carts.flush_idle(), 1)
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 2)
+        self.add(self.item1, 1)
+        out = StringIO()
+        call_command("persist_carts", "--all", stdout=out)
+        self.assertIn("Persisted 1 carts", out.getvalue())
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 3)
+
+    def test_interrupted_flush_is_repeated(self):
+        """
+        Ensure a flush that fails before or after its commit leaves the changes registered, and the next one writes them once
+        """
+        self.add(self.item1, 4)
+        with mock.patch.object(CartEventQuerySet, "append", side_effect=OperationalError("disk I/O error")):
+            with self.assertRaises(OperationalError):
+                active_carts.flush([self.cart1.id])
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 1)
+        with mock.patch.object(active_carts, "save", side_effect=OperationalError("the process died")):
+            with self.assertRaises(OperationalError):
+                active_carts.flush([self.cart1.id])
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 5)
+
+        self.assertEqual(active_carts.flush_idle(everything=True), 1)
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 5)
+        self.cart1.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("90.00"))
+        self.assertEqual(active_cart_cache().get(active_carts.DIRTY_KEY), {})
+
+    def test_concurrent_changes_are_atomic(self):
+        """
+        Ensure concurrent additions to the same cart item are all applied
+        """
+        self.add(self.item1, 1)
+
+        def add_many():
+            for _ in range(20):
+                active_carts.add_quantity(self.cart1.id, self.item1.id, 1)
+        threads = [threading.Thread(target=add_many) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(active_carts.line(self.cart1.id, self.item1.id), [self.cart1_item1.id, 102])
+
+    def test_file_cache(self):
+        """
+        Ensure the store works on the file based cache, locked with lock files
+        """
+        with tempfile.TemporaryDirectory() as location:
+            file_cache = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}
+            with override_settings(CACHES={**settings.CACHES, "active_carts": file_cache}):
+                self.test_concurrent_changes_are_atomic()
+                self.assertTrue(os.path.exists(os.path.join(location, f"active-carts-{self.cart1.id}.lock")))
+                active_carts.persist([self.cart1.id])
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 102)
+
+    def test_writes_around_the_store_persist_first(self):
+        """
+        Ensure creating a cart item removed in the store, and bulk writes, see its changes
+        """
+        self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        response = self.client.post(reverse("cartitem-list"), {"cart": self.cart1.id, "item": self.item2.id, "quantity": 3}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.add(self.item1, 5)
+        self.client.post(reverse("cartitem-bulk"), [{"cart": self.cart1.id, "item": self.item2.id, "quantity": 1}], format="json")
+        self.assertEqual(dict(CartItem.objects.filter(cart=self.cart1).values_list("item", "quantity")), {self.item1.id: 6, self.item2.id: 1})
+        self.cart1.refresh_from_db()
+        self.assertEqual(self.cart1.running_total, Decimal("80.00"))
+
+    def test_new_and_repriced_items(self):
+        """
+        Ensure new cart items are inserted right away and totals follow price changes
+        """
+        response = self.add(self.item2, 2, cart=self.cart2)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(CartItem.objects.filter(pk=response.data["id"], quantity=2).exists())
+        self.assertEqual(self.add(Item(pk=9999), 1, cart=self.cart2).status_code, status.HTTP_404_NOT_FOUND)
+        self.client.patch(reverse("item-detail", kwargs={"pk": self.item2.id}), {"price": "25.00"}, format="json")
+        response = self.client.get(reverse("cart-detail", kwargs={"pk": self.cart2.id}))
+        self.assertEqual(response.data["total_cost"], "100.00")
+
+class ItemStatsTest(BaseViewTest):
+    def assertCounters(self, item, cart_count, quantity, reserved_value):
+        counters = ItemStats.objects.filter(item=item).values_list("cart_count", "quantity", "reserved_value").first() or (0, 0, Decimal("0"))
+        self.assertEqual(counters, (cart_count, quantity, Decimal(reserved_value)))
+        # and agree with a recount of the cart items
+        recounted = ItemStats.objects.recount().get(item.id, (0, 0, Decimal("0")))
+        self.assertEqual(counters, recounted)
+
+    def test_counters_follow_cart_item_writes(self):
+        """
+        Ensure creating, updating, adding to, bulk writing and deleting cart items keeps the item counters current
+        """
+        self.assertCounters(self.item1, 2, 6, "60.00")
+        self.assertCounters(self.item2, 1, 2, "40.00")
+        response = self.client.post(reverse("cartitem-list"), {"cart": self.cart2.id, "item": self.item2.id, "quantity": 3}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertCounters(self.item2, 2, 5, "100.00")
+
+        url = reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id})
+        self.assertEqual(self.client.patch(url, {"quantity": 4}, format="json").status_code, status.HTTP_200_OK)
+        self.assertCounters(self.item1, 2, 9, "90.00")
+        self.client.post(reverse("cartitem-add"), {"cart": self.cart2.id, "item": self.item1.id, "quantity": -5}, format="json")
+        self.assertCounters(self.item1, 1, 4, "40.00")
+
+        data = [{"cart": self.cart1.id, "item": self.item2.id, "quantity": 1}, {"cart": self.cart2.id, "item": self.item1.id, "quantity": 2}]
+        self.assertEqual(self.client.post(reverse("cartitem-bulk"), data, format="json").status_code, status.HTTP_200_OK)
+        self.assertCounters(self.item1, 2, 6, "60.00")
+        self.assertCounters(self.item2, 2, 4, "80.00")
+
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertCounters(self.item1, 1, 2, "20.00")
+
+    @override_settings(BACKGROUND_JOBS=False, DELETE_CHUNK_SIZE=1)
+    def test_counters_follow_prices_and_cascades(self):
+        """
+        Ensure price changes revalue the counters and cart items deleted with their cart, user or item leave them
+        """
+        self.client.patch(reverse("item-detail", kwargs={"pk": self.item1.id}), {"price": 12.5}, format="json")
+        self.assertCounters(self.item1, 2, 6, "75.00")
+
+        self.assertEqual(self.client.delete(reverse("cart-detail", kwargs={"pk": self.cart2.id})).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertCounters(self.item1, 1, 1, "12.50")
+        self.assertEqual(self.client.delete(reverse("user-detail", kwargs={"pk": self.user1.id})).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertCounters(self.item1, 0, 0, "0")
+        self.assertCounters(self.item2, 0, 0, "0")
+
+        cart3 = self.create_cart(self.create_user("testuser3", "testpassword3"))
+        self.create_cart_item(cart3, self.item2, 3)
+        self.create_cart_item(self.create_cart(self.create_user("testuser4", "testpassword4")), self.item2, 1)
+        self.assertCounters(self.item2, 2, 4, "80.00")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse("item-detail", kwargs={"pk": self.item2.id}) + "?mode=background")
+        self.assertFalse(ItemStats.objects.filter(item=self.item2.id).exists())
+        self.assertEqual(ItemStats.objects.recount(), {})
+
+    def test_stats_endpoint_ranks_items(self):
+        """
+        Ensure the stats endpoint ranks the visible items by carts, units or reserved value with one query
+        """
+        item3 = self.create_item("item3", "description3", 100.0)
+        self.create_cart_item(self.cart2, item3, 1)
+        url = reverse("item-stats")
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["ordering"], "cart_count")
+        self.assertEqual([row["item"] for row in response.data["results"]], [self.item1.id, self.item2.id, item3.id])
+        self.assertEqual(
+            response.data["results"][0],
+            {"item": self.item1.id, "name": "item1", "price": "10.00", "cart_count": 2, "quantity": 6, "reserved_value": "60.00"},
+        )
+        response = self.client.get(url + "?ordering=reserved_value&limit=2")
+        self.assertEqual([row["item"] for row in response.data["results"]], [item3.id, self.item1.id])
+        response = self.client.get(url + "?ordering=quantity")
+        self.assertEqual([row["item"] for row in response.data["results"]], [self.item1.id, self.item2.id, item3.id])
+
+        Item.objects.filter(pk=self.item1.id).update(hidden=True)
+        response = self.client.get(url)
+        self.assertEqual([row["item"] for row in response.data["results"]], [self.item2.id, item3.id])
+        response = self.client.get(url + "?ordering=price&limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {"ordering", "limit"})
+
+    def test_rebuild_item_stats_command(self):
+        """
+        Ensure the rebuild_item_stats command detects and repairs drifted counters
+        """
+        ItemStats.objects.filter(item=self.item1).update(cart_count=7, quantity=0)
+        ItemStats.objects.filter(item=self.item2).delete()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_item_stats", "--check", stdout=StringIO())
+        call_command("rebuild_item_stats", stdout=StringIO())
+        self.assertCounters(self.item1, 2, 6, "60.00")
+        self.assertCounters(self.item2, 1, 2, "40.00")
+        call_command("rebuild_item_stats", "--check", stdout=StringIO())
+
+class PriceBatchTest(BaseViewTest):
+    def test_price_batch_matches_total_cost(self):
+        """
+        Ensure batch pricing gives the totals that total_cost gives for carts holding the same cart items, with one query
+        """
+        item3 = self.create_item("item3", "description3", 0.07)
+        self.create_cart_item(self.cart2, item3, 3)
+        carts = [
+            list(CartItem.objects.filter(cart=cart).values_list("item", "quantity"))
+            for cart in (self.cart1, self.cart2)
+        ]
+        carts.append([])
+        with self.assertNumQueries(1):
+            response = self.client.post(reverse("cart-price-batch"), carts, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(result["index"], result["status"], result["total_cost"]) for result in response.data["results"]],
+            [(0, "priced", self.cart1.total_cost()), (1, "priced", self.cart2.total_cost()), (2, "priced", Decimal("0"))],
+        )
+        self.assertEqual(response.json()["results"][1]["total_cost"], self.client.get(reverse("cart-total-cost", kwargs={"pk": self.cart2.id})).json()["total_cost"])
+        self.assertEqual(pricing.price_carts(carts), [self.cart1.total_cost(), self.cart2.total_cost(), Decimal("0")])
+
+    def test_price_batch_reports_errors_per_cart(self):
+        """
+        Ensure malformed carts and unknown or hidden items are reported per cart while the other carts are priced
+        """
+        Item.objects.filter(pk=self.item2.id).update(hidden=True)
+        carts = [
+            [[self.item1.id, 2]],
+            [[self.item1.id, 1], [self.item2.id, 1], [9999, 1]],
+            [[self.item1.id, -1], ["x", 1], [self.item1.id, "\u00b2"]],
+            {"item": self.item1.id},
+        ]
+        response = self.client.post(reverse("cart-price-batch"), carts, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data["results"]
+        self.assertEqual(results[0]["total_cost"], Decimal("20.00"))
+        self.assertEqual(results[1]["errors"], {"items": [f'Invalid pk "{self.item2.id}" - object does not exist.', 'Invalid pk "9999" - object does not exist.']})
+        self.assertEqual(set(results[2]["errors"]), {0, 1, 2})
+        self.assertEqual(results[3]["status"], "error")
+        with self.assertRaises(Item.DoesNotExist):
+            pricing.price_carts([[(9999, 1)]])
+
+        response = self.client.post(reverse("cart-price-batch"), [[[9999, 1]]], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(MAX_PRICE_BATCH_CARTS=1):
+            response = self.client.post(reverse("cart-price-batch"), [[], []], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class StockTest(BaseViewTest):
+    def setUp(self):
+        active_cart_cache().clear()
+        super().setUp()
+        Item.objects.filter(pk=self.item1.id).update(stock=4)
+
+    def assertStock(self, item, stock):
+        response = self.client.get(reverse("item-stock", kwargs={"pk": item.id}))
+        self.assertEqual(response.data, {"item": item.id, "stock": stock})
+
+    def add(self, item, quantity, cart=None):
+        return self.client.post(reverse("cartitem-add"), {"cart": (cart or self.cart1).id, "item": item.id, "quantity": quantity}, format="json")
+
+    def test_cart_item_writes_reserve_stock(self):
+        """
+        Ensure creating, adding to, updating and deleting cart items take and give back stock, refusing to oversell
+        """
+        self.assertEqual(self.add(self.item1, 3).status_code, status.HTTP_200_OK)
+        self.assertStock(self.item1, 1)
+        response = self.add(self.item1, 2)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 4)
+        self.assertStock(self.item1, 1)
+
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart2_item1.id}), {"quantity": 2}, format="json")
+        self.assertStock(self.item1, 4)
+        self.assertEqual(self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id})).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertStock(self.item1, 8)
+
+        cart3 = self.create_cart(self.create_user("testuser3", "testpassword3"))
+        url = reverse("cartitem-list")
+        response = self.client.post(url, {"cart": cart3.id, "item": self.item1.id, "quantity": 9}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(CartItem.objects.filter(cart=cart3).exists())
+        response = self.client.post(url, {"cart": cart3.id, "item": self.item1.id, "quantity": 8}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertStock(self.item1, 0)
+        # items without stock are not tracked
+        self.assertEqual(self.add(self.item2, 100).status_code, status.HTTP_200_OK)
+        self.assertStock(self.item2, None)
+
+    def test_untracked_items_do_not_write_the_primary(self):
+        """
+        Ensure cart item writes of items without stock never UPDATE the items on the primary database
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.add(self.item2, 2)
+            self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}), {"quantity": 1}, format="json")
+            self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item2.id}))
+        self.assertFalse([query["sql"] for query in queries if query["sql"].startswith('UPDATE "shopping_cart_item"')])
+
+    def test_bulk_writes_and_cascades_reserve_stock(self):
+        """
+        Ensure bulk writes reserve stock per item and deleted carts and users give theirs back
+        """
+        data = [
+            {"cart": self.cart1.id, "item": self.item1.id, "quantity": 3},
+            {"cart": self.cart2.id, "item": self.item1.id, "quantity": 8},
+            {"cart": self.cart2.id, "item": self.item2.id, "quantity": 2},
+        ]
+        response = self.client.post(reverse("cartitem-bulk"), data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["status"] for result in response.data["results"]], ["error", "error", "created"])
+        self.assertEqual(response.data["results"][0]["errors"], {"quantity": ["Not enough stock."]})
+        self.assertStock(self.item1, 4)
+        data[1]["quantity"] = 6
+        response = self.client.post(reverse("cartitem-bulk"), data[:2], format="json")
+        self.assertEqual([result["status"] for result in response.data["results"]], ["updated", "updated"])
+        self.assertStock(self.item1, 1)
+
+        self.client.delete(reverse("cart-detail", kwargs={"pk": self.cart2.id}))
+        self.assertStock(self.item1, 7)
+        self.client.delete(reverse("user-detail", kwargs={"pk": self.user1.id}))
+        self.assertStock(self.item1, 10)
+
+    def test_item_writes_keep_reservations(self):
+        """
+        Ensure saving an item read before a reservation keeps it, the stock is only written when changed,
+        and the catalog responses leave it out
+        """
+        item = Item.objects.get(pk=self.item1.id)
+        Item.objects.reserve(self.item1.id, 3)
+        item.price = 11
+        item.save()
+        self.assertStock(self.item1, 1)
+        response = self.client.patch(reverse("item-detail", kwargs={"pk": self.item1.id}), {"stock": 50}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("stock", response.data)
+        self.assertNotIn("stock", self.client.get(reverse("item-detail", kwargs={"pk": self.item1.id})).data)
+        self.assertStock(self.item1, 50)
+        with self.assertRaises(OutOfStock):
+            Item.objects.reserve(self.item1.id, 51)
+
+    def test_expire_reservations_command(self):
+        """
+        Ensure cart items of stocked items left unchanged past the reservation TTL are removed and their stock given back
+        """
+        CartItem.objects.filter(cart=self.cart1).update(reserved_at=timezone.now() - timedelta(hours=1))
+        out = StringIO()
+        call_command("expire_reservations", ttl=600, stdout=out)
+        self.assertIn("Expired 1 cart items", out.getvalue())
+        self.assertStock(self.item1, 5)
+        # cart items of items without stock and recent reservations stay
+        self.assertEqual(sorted(CartItem.objects.values_list("id", flat=True)), sorted([self.cart1_item2.id, self.cart2_item1.id]))
+        self.cart1.refresh_from_db()
+        self.assertEqual((self.cart1.running_total, self.cart1.item_count), (Decimal("40.00"), 1))
+        self.assertEqual(ItemStats.objects.get(item=self.item1).cart_count, 1)
+        self.assertEqual(CartEvent.objects.filter(cart=self.cart1.id).latest("version").kind, CartEvent.DELETED)
+        call_command("expire_reservations", stdout=out)
+        self.assertStock(self.item1, 5)
+
+    @override_settings(ACTIVE_CART_STORE=True, BACKGROUND_JOBS=False)
+    def test_active_cart_store_reserves_stock(self):
+        """
+        Ensure the active-cart store reserves stock when it changes a quantity, before writing it behind
+        """
+        self.assertEqual(self.add(self.item1, 4).status_code, status.HTTP_200_OK)
+        self.assertStock(self.item1, 0)
+        self.assertEqual(self.add(self.item1, 1).status_code, status.HTTP_409_CONFLICT)
+        self.client.patch(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}), {"quantity": 2}, format="json")
+        self.assertStock(self.item1, 3)
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 1)
+        active_carts.persist([self.cart1.id])
+        self.assertEqual(CartItem.objects.get(pk=self.cart1_item1.id).quantity, 2)
+        self.assertStock(self.item1, 3)
+
+    @override_settings(ACTIVE_CART_STORE=True, BACKGROUND_JOBS=False)
+    def test_active_cart_store_gives_back_stock_once_written(self):
+        """
+        Ensure units the database holds are given back once the store writes the change, and units taken ahead of it when its document is lost
+        """
+        self.client.delete(reverse("cartitem-detail", kwargs={"pk": self.cart1_item1.id}))
+        # the database still holds the unit of the deleted cart item
+        self.assertStock(self.item1, 4)
+        active_carts.persist([self.cart1.id])
+        self.assertStock(self.item1, 5)
+
+        self.add(self.item1, 3, cart=self.cart2)
+        self.assertStock(self.item1, 2)
+        active_cart_cache().delete(active_carts.cart_key(self.cart2.id))
+        self.assertEqual(active_carts.flush_idle(), 0)
+        self.assertStock(self.item1, 5)
+        self.assertEqual(CartItem.objects.get(pk=self.cart2_item1.id).quantity, 5)
+
+        # a lost document replaced by a new one before the flusher noticed
+        self.add(self.item1, 3, cart=self.cart2)
+        active_cart_cache().delete(active_carts.cart_key(self.cart2.id))
+        self.add(self.item1, 1, cart=self.cart2)
+        self.assertStock(self.item1, 4)
+
+
+@override_settings(DATABASE_LOCK_RETRIES=200, DATABASE_LOCK_BACKOFF=0.001)
+class StockContentionTest(TransactionTestCase):
+    def test_hot_item_is_never_oversold(self):
+        """
+        Ensure threads adding the same item with little stock to their carts at once never take more than the stock
+        """
+        out = StringIO()
+        call_command("stock_contention", threads=8, stock=30, attempts=10, stdout=out)
+        header, row = out.getvalue().splitlines()
+        values = dict(zip(header.split(), row.split()))
+        self.assertEqual(
+            {name: values[name] for name in ("reserved", "rejected", "in-carts", "left", "oversold")},
+            {"reserved": "30", "rejected": "50", "in-carts": "30", "left": "0", "oversold": "0"},
+        )
+        self.assertGreater(float(values["res/s"]), 0)
@@ -0,0 +1,35 @@
+import random
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+
+def is_lock_error(exc):
+    message = str(exc).lower()
+    # "database table is locked" is what a shared-cache (in-memory) database reports instead
+    return 'database is locked' in message or 'database table is locked' in message or 'database is busy' in message
+
+
+def retry_on_locked(func):
+    """
+    Retry func with exponential backoff and jitter when the database
+    reports that it is locked, up to DATABASE_LOCK_RETRIES times.
+    Errors raised inside an enclosing transaction, on any database, are not
+    retried, since that transaction has to be rolled back as a whole.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = getattr(settings, 'DATABASE_LOCK_RETRIES', 5)
+        backoff = getattr(settings, 'DATABASE_LOCK_BACKOFF', 0.05)
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                # a transaction on any database, cart shards included, has to be rolled back as a whole
+                in_transaction = any(conn.in_atomic_block for conn in connections.all(initialized_only=True))
+                if attempt == retries or not is_lock_error(exc) or in_transaction:
+                    raise
+                time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
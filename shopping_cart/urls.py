@@ -1,13 +1,19 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework.routers import DefaultRouter
-from .views import ItemViewSet, CartViewSet, CartItemViewSet, UserViewSet
+from .feeds import cart_changes
+from .instrumentation import metrics_view
+from .views import ItemViewSet, ItemSearchView, CartViewSet, CartItemViewSet, DeletionJobViewSet, UserViewSet
 
 router = DefaultRouter()
 router.register(r'admin/items', ItemViewSet)
 router.register(r'carts', CartViewSet)
 router.register(r'cartitems', CartItemViewSet)
 router.register(r'users', UserViewSet)
+router.register(r'jobs', DeletionJobViewSet)
 
 urlpatterns = [
+    path('_metrics', metrics_view, name='metrics'),
+    re_path(r'^items/search/?$', ItemSearchView.as_view(), name='item-search'),
+    path('carts/<int:pk>/changes/', cart_changes, name='cart-changes'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,42 +1,421 @@
-from django.shortcuts import render
+import time
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
 from rest_framework import generics
+from rest_framework import serializers
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Item, Cart, CartItem, User
+from rest_framework.reverse import reverse
+from . import active_carts, pricing
+from .cache import cached_catalog_response
+from .export import EXPORT_COLUMNS, export_lines
+from .jobs import start_deletion
+from .pagination import SearchPagination
+from .provisioning import provision_users
+from .models import Item, Cart, CartEvent, CartItem, DeletionJob, ItemStats, OutOfStock, StockReservation, User
+from .renderers import CSVRenderer, NDJSONRenderer
+from .search import ORDERINGS, index as search_index
 from .serializers import ItemSerializer, CartSerializer, CartItemSerializer, UserSerializer
+from .serializers import ItemValuesSerializer, CartValuesSerializer, CartItemValuesSerializer, DeletionJobSerializer
+from .serializers import ItemStatsValuesSerializer
+from .sharding import group_by_shard, on_shards, shard_for_id, shard_for_user
+from .transactions import retry_on_locked
+
+class ValuesReadMixin:
+    """
+    Serve list and retrieve from QuerySet.values() rows through
+    values_serializer_class when settings.FAST_READ_SERIALIZERS is on.
+    The output is the same as the one of serializer_class.
+    """
+    values_serializer_class = None
+
+    def use_values_serializer(self):
+        return getattr(settings, 'FAST_READ_SERIALIZERS', False) and self.values_serializer_class is not None
+
+    def get_values_fields(self):
+        return self.values_serializer_class.values_fields()
+
+    def get_values_serializer(self, *args, **kwargs):
+        return self.values_serializer_class(*args, **kwargs)
+
+    def get_values_queryset(self):
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None)
+        return queryset.values(*self.get_values_fields())
+
+    def list(self, request, *args, **kwargs):
+        if not self.use_values_serializer():
+            return super().list(request, *args, **kwargs)
+        queryset = self.get_values_queryset()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_values_serializer(page, many=True).data)
+        return Response(self.get_values_serializer(queryset, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.use_values_serializer():
+            return super().retrieve(request, *args, **kwargs)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = get_object_or_404(self.get_values_queryset(), **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        self.check_object_permissions(request, row)
+        return Response(self.get_values_serializer(row).data)
+
+class SparseFieldsMixin:
+    """
+    Trim the rows of GET responses to the fields listed in ?fields=. The
+    queryset only loads the columns behind those fields, and related rows
+    are only prefetched when a field needs them (see wants_field()).
+    """
+
+    def requested_fields(self):
+        """
+        The output field names asked for, or None for all of them.
+        """
+        if self.request.method != 'GET' or 'fields' not in self.request.query_params:
+            return None
+        if not hasattr(self, '_requested_fields'):
+            readable = [name for name, field in self.get_serializer_class()().fields.items() if not field.write_only]
+            names = {name.strip() for name in self.request.query_params['fields'].split(',') if name.strip()}
+            unknown = sorted(names - set(readable))
+            if unknown:
+                raise serializers.ValidationError({'fields': [f"Invalid field '{name}' - expected one of {', '.join(readable)}" for name in unknown]})
+            self._requested_fields = names
+        return self._requested_fields
+
+    def wants_field(self, name):
+        names = self.requested_fields()
+        return names is None or name in names
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request is not None:
+            context['fields'] = self.requested_fields()
+        return context
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        names = self.requested_fields()
+        if names is None:
+            return queryset
+        fields = self.get_serializer_class()().fields
+        columns = [queryset.model._meta.pk.name]
+        for name in names:
+            try:
+                model_field = queryset.model._meta.get_field(fields[name].source)
+            except FieldDoesNotExist:
+                continue
+            # reverse relations, such as the items of a cart, are prefetched instead
+            if model_field.concrete:
+                columns.append(model_field.name)
+        # a relation followed with select_related (such as ?expand=) cannot be deferred
+        if isinstance(queryset.query.select_related, dict):
+            columns.extend(queryset.query.select_related)
+        return queryset.only(*dict.fromkeys(columns))
+
+    def get_values_fields(self):
+        # the id is always read, to look rows up by
+        return list(dict.fromkeys(['id', *self.values_serializer_class.values_fields(self.requested_fields())]))
+
+    def get_values_serializer(self, *args, **kwargs):
+        return super().get_values_serializer(*args, fields=self.requested_fields(), **kwargs)
+
+class MultiGetMixin:
+    """
+    Answer list requests with ?ids=1,2,3 with the rows of those ids, in
+    the requested order, read with a single in_bulk() query (per shard)
+    instead of one detail request per row. Ids without a row are listed
+    under missing.
+    """
+
+    def get_requested_ids(self):
+        try:
+            ids = [int(pk) for pk in self.request.query_params['ids'].split(',') if pk.strip()]
+        except ValueError:
+            raise serializers.ValidationError({'ids': ['Expected a comma separated list of ids.']})
+        max_ids = getattr(settings, 'MAX_PAGE_SIZE', 1000)
+        if len(ids) > max_ids:
+            raise serializers.ValidationError({'ids': [f'Ensure there are no more than {max_ids} ids.']})
+        return list(dict.fromkeys(ids))
+
+    def list(self, request, *args, **kwargs):
+        if 'ids' not in request.query_params:
+            return super().list(request, *args, **kwargs)
+        ids = self.get_requested_ids()
+        if self.use_values_serializer():
+            rows = {row['id']: row for row in self.get_values_queryset().filter(pk__in=ids)}
+            data = self.get_values_serializer([rows[pk] for pk in ids if pk in rows], many=True).data
+        else:
+            rows = self.filter_queryset(self.get_queryset()).in_bulk(ids)
+            data = self.get_serializer([rows[pk] for pk in ids if pk in rows], many=True).data
+        return Response({'results': data, 'missing': [pk for pk in ids if pk not in rows]})
 
-class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
+class ExpandMixin:
+    """
+    Inline the related objects named in ?expand= (a comma separated list
+    out of expandable) in the serialized rows. The serializers read the
+    names from the expand key of their context, and get_queryset() is
+    expected to select_related() them.
+    """
+    expandable = ()
+
+    def get_expand(self):
+        names = {name.strip() for name in self.request.query_params.get('expand', '').split(',') if name.strip()}
+        unknown = sorted(names - set(self.expandable))
+        if unknown:
+            raise serializers.ValidationError({'expand': [f"Invalid field '{name}' - expected one of {', '.join(self.expandable)}" for name in unknown]})
+        return names
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'expand': self.get_expand()}
+
+    def use_values_serializer(self):
+        # the values serializers only output the ids of related objects
+        return not self.get_expand() and super().use_values_serializer()
+
+class BackgroundDestroyMixin:
+    """
+    DELETE with ?mode=background hides the object and answers 202 with a
+    DeletionJob that removes the cart items depending on it in chunks,
+    then the object itself (see shopping_cart.jobs).
+    """
+
+    def destroy(self, request, *args, **kwargs):
+        if request.query_params.get('mode') != 'background':
+            return super().destroy(request, *args, **kwargs)
+        job = start_deletion(self.get_object())
+        location = reverse('deletionjob-detail', kwargs={'pk': job.pk}, request=request)
+        return Response(DeletionJobSerializer(job).data, status=202, headers={'Location': location})
+
+class UserViewSet(BackgroundDestroyMixin, SparseFieldsMixin, viewsets.ModelViewSet):
+    # hide the users being deleted in the background, not every inactive user
+    queryset = User.objects.exclude(
+        pk__in=DeletionJob.objects.filter(model=User._meta.label_lower).exclude(status=DeletionJob.DONE).values('object_id'),
+    )
     serializer_class = UserSerializer
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create many users at once, with their carts when ?carts=true.
+        Passwords are hashed in a pool of worker processes and the users
+        inserted with bulk_create; errors are reported per entry.
+        """
+        entries = request.data
+        if not isinstance(entries, list):
+            return Response({'error': 'a list of users is required'}, status=400)
+        max_users = getattr(settings, 'MAX_BULK_USERS', 10000)
+        if len(entries) > max_users:
+            return Response({'error': f'at most {max_users} users can be created at once'}, status=400)
+
+        started = time.perf_counter()
+        results = provision_users(entries, create_carts=request.query_params.get('carts') in ('true', '1'))
+        seconds = time.perf_counter() - started
+        created = sum(result['status'] == 'created' for result in results)
+        return Response({
+            'results': results,
+            'created': created,
+            'failed': len(results) - created,
+            'seconds': round(seconds, 3),
+            'users_per_second': round(created / seconds, 1) if seconds else None,
+        }, status=200 if created or not entries else 400)
+
     @action(detail=False)
     def available_items(self, request):
-        cart = Item.objects.all()
-        data = ItemSerializer(cart, many=True).data
-        return Response({'available_items': data})
+        def build():
+            if getattr(settings, 'FAST_READ_SERIALIZERS', False):
+                rows = Item.objects.visible().values(*ItemValuesSerializer.values_fields())
+                return {'available_items': ItemValuesSerializer(rows, many=True).data}
+            cart = Item.objects.visible()
+            return {'available_items': ItemSerializer(cart, many=True).data}
+        return cached_catalog_response(request, 'available-items', build)
 
-class ItemViewSet(viewsets.ModelViewSet):
-    queryset = Item.objects.all()
+class ItemViewSet(BackgroundDestroyMixin, MultiGetMixin, SparseFieldsMixin, ValuesReadMixin, viewsets.ModelViewSet):
+    queryset = Item.objects.visible()
     serializer_class = ItemSerializer
+    values_serializer_class = ItemValuesSerializer
+
+    # writes go through Item.save()/delete(), which bump the catalog version
+    def list(self, request, *args, **kwargs):
+        return cached_catalog_response(request, 'items', lambda: super(ItemViewSet, self).list(request, *args, **kwargs).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_catalog_response(request, 'item', lambda: super(ItemViewSet, self).retrieve(request, *args, **kwargs).data)
 
-class CartViewSet(viewsets.ModelViewSet):
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        return export_response(request, self.get_queryset(), 'items')
+
+    @action(detail=True)
+    def stock(self, request, pk=None):
+        """
+        The units of the item left to put in carts, read live rather than
+        from the cached catalog; null when its stock is not tracked.
+        """
+        item = self.get_object()
+        return Response({'item': item.pk, 'stock': item.stock})
+
+    @action(detail=False)
+    def stats(self, request):
+        """
+        The ?limit= (10 by default) items held by the most carts, or with
+        ?ordering=quantity / reserved_value the most units or the most value
+        in carts, read from the counters kept by the cart item writes.
+        """
+        errors = {}
+        ordering = request.query_params.get('ordering', 'cart_count')
+        if ordering not in ItemStats.COUNTERS:
+            errors['ordering'] = [f"Invalid ordering '{ordering}' - expected one of {', '.join(ItemStats.COUNTERS)}"]
+        max_limit = getattr(settings, 'MAX_PAGE_SIZE', 1000)
+        limit = request.query_params.get('limit', '10')
+        if not limit.isdigit() or not 1 <= int(limit) <= max_limit:
+            errors['limit'] = [f'A whole number between 1 and {max_limit} is required.']
+        if errors:
+            return Response(errors, status=400)
+        rows = ItemStats.objects.top(ordering, int(limit))
+        return Response({'ordering': ordering, 'results': ItemStatsValuesSerializer(rows, many=True).data})
+
+class ItemSearchView(generics.GenericAPIView):
+    """
+    Ranked search over item names and descriptions, served from the
+    in-memory search index without any database query.
+    """
+    pagination_class = SearchPagination
+
+    def get(self, request):
+        params = request.query_params
+        errors = {}
+        query = params.get('q', '').strip()
+        prices = {}
+        price_field = serializers.DecimalField(max_digits=None, decimal_places=None)
+        for name in ('min_price', 'max_price'):
+            if params.get(name):
+                try:
+                    prices[name] = price_field.run_validation(params[name])
+                except serializers.ValidationError as exc:
+                    errors[name] = exc.detail
+        ordering = params.get('ordering', 'relevance')
+        if ordering not in ORDERINGS:
+            errors['ordering'] = [f"Invalid ordering '{ordering}' - expected one of {', '.join(ORDERINGS)}"]
+        if not query and not prices and not errors:
+            errors['q'] = ['A search query or a price range is required.']
+        if errors:
+            return Response(errors, status=400)
+
+        results = search_index.search(query, ordering=ordering, **prices)
+        page = self.paginate_queryset(results)
+        return self.get_paginated_response(page)
+
+class CartViewSet(ExpandMixin, MultiGetMixin, SparseFieldsMixin, ValuesReadMixin, viewsets.ModelViewSet):
     queryset = Cart.objects.all()
     serializer_class = CartSerializer
+    values_serializer_class = CartValuesSerializer
+    expandable = ('item',)
+
+    def list(self, request, *args, **kwargs):
+        if active_carts.enabled():
+            # the listings of one user or of given ids read the changes held for their carts
+            user_id = request.query_params.get('user')
+            cart_ids = self.get_requested_ids() if 'ids' in request.query_params else []
+            if user_id is not None:
+                cart_ids.append(Cart.objects.id_for_user(user_id))
+            active_carts.persist(cart_ids)
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        doc = self.get_active_cart()
+        if doc is None:
+            return super().retrieve(request, *args, **kwargs)
+        cart, items = active_carts.cart_rows(doc)
+        items = {cart['id']: CartItemValuesSerializer(items, many=True).data}
+        return Response(CartValuesSerializer(cart, fields=self.requested_fields(), items=items).data)
+
+    def perform_update(self, serializer):
+        # the document of the cart would keep its previous user
+        with active_carts.bypass([serializer.instance.pk]):
+            super().perform_update(serializer)
+
+    def get_active_cart(self):
+        """
+        The active-cart store document of the cart of a detail route, which
+        holds its latest changes, or None to read the cart from the database.
+        """
+        cart_id = _pk_or_none(self.kwargs.get('pk'))
+        if not active_carts.enabled() or cart_id is None:
+            return None
+        if self.get_expand():
+            # documents do not hold the items: persist the changes for the database to serve them
+            active_carts.persist([cart_id])
+            return None
+        return active_carts.read(cart_id)
 
     @action(detail=True)
     def total_cost(self, request, pk=None):
+        doc = self.get_active_cart()
+        if doc is not None:
+            cart, _ = active_carts.cart_rows(doc)
+            # a Decimal, like the stored total below
+            return Response({'total_cost': cart['running_total']})
+        cart = self.get_object()
+        return Response({'total_cost': cart.running_total})
+
+    @action(detail=True, methods=['post'])
+    def persist(self, request, pk=None):
+        """
+        Write the changes the active-cart store holds for the cart to the database now.
+        """
         cart = self.get_object()
-        return Response({'total_cost': cart.total_cost()})
+        return Response({'cart': cart.pk, 'persisted': active_carts.persist([cart.pk])})
     
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        return export_response(request, self.get_queryset(), 'carts')
+
+    @action(detail=False, methods=['post'])
+    def price_batch(self, request):
+        """
+        Total costs of hypothetical carts, each a list of [item id, quantity]
+        pairs, priced together with one query for the prices of their items.
+        Errors are reported per cart.
+        """
+        carts = request.data
+        if not isinstance(carts, list):
+            return Response({'error': 'a list of carts is required'}, status=400)
+        if len(carts) > pricing.max_carts():
+            return Response({'error': f'at most {pricing.max_carts()} carts can be priced at once'}, status=400)
+
+        parsed = [pricing.parse_cart(lines) for lines in carts]
+        prices = pricing.item_cents({item_id for errors, lines in parsed if errors is None for item_id, _ in lines})
+        results, priced = [], []
+        for index, (errors, lines) in enumerate(parsed):
+            if errors is None:
+                missing = sorted({item_id for item_id, _ in lines if item_id not in prices})
+                if missing:
+                    errors = {'items': [f'Invalid pk "{item_id}" - object does not exist.' for item_id in missing]}
+            if errors:
+                results.append({'index': index, 'status': 'error', 'errors': errors})
+            else:
+                result = {'index': index, 'status': 'priced', 'total_cost': None}
+                results.append(result)
+                priced.append((result, lines))
+        totals = pricing.price_carts([lines for _, lines in priced], prices)
+        for (result, _), total in zip(priced, totals):
+            # the same representation as total_cost
+            result['total_cost'] = total
+        return Response({'results': results}, status=200 if priced or not carts else 400)
+
     @action(detail=False)
     def cart_id(self, request):
         user_id = request.query_params.get('user')
         if user_id is not None:
-            try:
-                user_cart = Cart.objects.get(user=user_id)
-                return Response({'cart': user_cart.id})
-            except:
+            cart_id = Cart.objects.id_for_user(user_id)
+            if cart_id is not None:
+                return Response({'cart': cart_id})
+            else:
                 return Response({'error': [f"Invalid user '{user_id}' - user does not exist or user does not have an associated cart"]}, status=404)
         else:
             return Response({'error': 'user parameter required'}, status=400)
@@ -44,33 +423,291 @@ class CartViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         queryset = Cart.objects.all()
+        if self.action not in ('total_cost', 'export', 'persist') and self.wants_field('items'):
+            items = CartItem.objects.order_by('pk')
+            if 'item' in self.get_expand():
+                items = items.select_related('item')
+            queryset = queryset.prefetch_related(Prefetch('cartitem_set', queryset=items))
         user_id = self.request.query_params.get('user', None)
         if user_id is not None:
             queryset = queryset.filter(user__id = user_id)
-        return queryset
+        # detail routes and ?user= read one shard, listings every shard
+        return on_shards(queryset, pk=self.kwargs.get(self.lookup_url_kwarg or self.lookup_field), user=user_id)
 
 
-class CartItemViewSet(viewsets.ModelViewSet):
+class CartItemViewSet(ExpandMixin, SparseFieldsMixin, ValuesReadMixin, viewsets.ModelViewSet):
     queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
+    values_serializer_class = CartItemValuesSerializer
+    expandable = ('item',)
 
+    @retry_on_locked
     def create(self, request, *args, **kwargs):
         user_id = self.request.data.get('user', None)
         if user_id is not None:
             self.request.data.pop('user', None)
-            try:
-                cart = Cart.objects.get(user = user_id)
-                self.request.data['cart'] = cart.id
-            except:
+            cart_id = Cart.objects.id_for_user(user_id)
+            if cart_id is not None:
+                self.request.data['cart'] = cart_id
+            else:
+                return Response({"error": [f"Invalid user '{user_id}' - user does not exist or user does not have an associated cart"]}, status=404)
+        with active_carts.bypass([_pk_or_none(self.request.data.get('cart'))]):
+            return super().create(request, args, kwargs)
+
+    def list(self, request, *args, **kwargs):
+        if active_carts.enabled():
+            # the cart items of one cart or user read the changes held for the cart
+            user_id = request.query_params.get('user')
+            active_carts.persist([
+                _pk_or_none(request.query_params.get('cart')),
+                Cart.objects.id_for_user(user_id) if user_id is not None else None,
+            ])
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        if active_carts.enabled():
+            # get_object() applies the changes held by the active-cart store
+            return Response(self.get_serializer(self.get_object()).data)
+        return super().retrieve(request, *args, **kwargs)
+
+    @retry_on_locked
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @retry_on_locked
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
+    def get_object(self):
+        cart_item = super().get_object()
+        if active_carts.enabled():
+            held = active_carts.line(cart_item.cart_id, cart_item.item_id)
+            if held is not None:
+                if held[1] is None:
+                    raise Http404('No CartItem matches the given query.')
+                cart_item.quantity = held[1]
+        return cart_item
+
+    def perform_update(self, serializer):
+        cart_item = serializer.instance
+        cart_id = getattr(serializer.validated_data.get('cart'), 'pk', cart_item.cart_id)
+        item_id = getattr(serializer.validated_data.get('item'), 'pk', cart_item.item_id)
+        if active_carts.enabled() and (cart_id, item_id) == (cart_item.cart_id, cart_item.item_id):
+            # a quantity change is written behind
+            quantity = serializer.validated_data.get('quantity', cart_item.quantity)
+            if not active_carts.set_quantity(cart_id, item_id, quantity):
+                raise Http404('No CartItem matches the given query.')
+            cart_item.quantity = quantity
+            return
+        with active_carts.bypass([cart_item.cart_id, cart_id]):
+            serializer.save()
+
+    def perform_destroy(self, instance):
+        if active_carts.enabled():
+            active_carts.set_quantity(instance.cart_id, instance.item_id, None)
+        else:
+            instance.delete()
+
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        return export_response(request, self.get_queryset(), 'cartitems')
+
+    @action(detail=False, methods=['post'])
+    @retry_on_locked
+    def add(self, request):
+        """
+        Add a (possibly negative) quantity to a cart item in place, creating
+        it when missing and deleting it when its quantity reaches zero.
+        """
+        errors, values = _parse_cart_item_entry(request.data, serializers.IntegerField())
+        if errors:
+            return Response(errors, status=400)
+
+        kind, cart_id, item_id, quantity = values
+        if kind == 'user':
+            user_id, cart_id = cart_id, Cart.objects.id_for_user(cart_id)
+            if cart_id is None:
                 return Response({"error": [f"Invalid user '{user_id}' - user does not exist or user does not have an associated cart"]}, status=404)
-        return super().create(request, args, kwargs)
+        try:
+            if active_carts.enabled():
+                row, created = active_carts.add_quantity(cart_id, item_id, quantity)
+                data = row and CartItemValuesSerializer(row).data
+            else:
+                cart_item, created = CartItem.objects.add_quantity(cart_id, item_id, quantity)
+                data = cart_item and CartItemSerializer(cart_item).data
+        except (Cart.DoesNotExist, Item.DoesNotExist) as exc:
+            return Response({'error': [str(exc)]}, status=404)
+        if data is None:
+            return Response(status=204)
+        return Response(data, status=201 if created else 200)
+
+    @action(detail=False, methods=['post'])
+    @retry_on_locked
+    def bulk(self, request):
+        """
+        Create or update many cart items at once. Every cart and item is
+        resolved with one query each and all valid entries are written
+        with a single upsert on (cart, item) in one transaction.
+        """
+        entries = request.data
+        if not isinstance(entries, list):
+            return Response({'error': 'a list of cart items is required'}, status=400)
+
+        quantity_field = CartItemSerializer().fields['quantity']
+        parsed = [_parse_cart_item_entry(entry, quantity_field) for entry in entries]
+
+        valid = [values for errors, values in parsed if errors is None]
+        # the carts of every shard in one query each
+        owners = {}
+        for kind, owner_id, _, _ in valid:
+            shard = shard_for_user(owner_id) if kind == 'user' else shard_for_id(owner_id)
+            owners.setdefault(shard, {'cart': set(), 'user': set()})[kind].add(owner_id)
+        carts = {}
+        for shard, ids in owners.items():
+            for cart_id, user_id in Cart.objects.using(shard).filter(Q(pk__in=ids['cart']) | Q(user__in=ids['user'])).values_list('id', 'user'):
+                carts[('cart', cart_id)] = cart_id
+                carts[('user', user_id)] = cart_id
+        item_ids = set(Item.objects.visible().filter(pk__in={item_id for _, _, item_id, _ in valid}).values_list('id', flat=True)) if valid else set()
+
+        results = []
+        lines = {}
+        for index, (errors, values) in enumerate(parsed):
+            if errors is None:
+                kind, owner_id, item_id, quantity = values
+                errors = {}
+                if (kind, owner_id) not in carts:
+                    if kind == 'user':
+                        errors['user'] = [f"Invalid user '{owner_id}' - user does not exist or user does not have an associated cart"]
+                    else:
+                        errors['cart'] = [f'Invalid pk "{owner_id}" - object does not exist.']
+                if item_id not in item_ids:
+                    errors['item'] = [f'Invalid pk "{item_id}" - object does not exist.']
+            if errors:
+                results.append({'index': index, 'status': 'error', 'errors': errors})
+                continue
+            cart_id = carts[(kind, owner_id)]
+            # a later entry for the same cart and item wins
+            lines[(cart_id, item_id)] = quantity
+            results.append({'index': index, 'status': None, 'cart': cart_id, 'item': item_id, 'quantity': quantity})
+
+        existing, out_of_stock = set(), set()
+        with active_carts.bypass({cart_id for cart_id, _ in lines}):
+            for shard, cart_ids in group_by_shard({cart_id for cart_id, _ in lines}).items():
+                shard_lines = {(cart_id, item_id): quantity for (cart_id, item_id), quantity in lines.items() if cart_id in cart_ids}
+                with StockReservation(shard) as stock, transaction.atomic(using=shard):
+                    previous = {
+                        (cart_id, item_id): quantity for cart_id, item_id, quantity in
+                        CartItem.objects.using(shard).filter(cart__in=cart_ids, item__in={item_id for _, item_id in shard_lines}).values_list('cart', 'item', 'quantity')
+                    }
+                    # one reservation per item for the quantities of all its entries
+                    deltas = {}
+                    for (cart_id, item_id), quantity in shard_lines.items():
+                        deltas[item_id] = deltas.get(item_id, 0) + quantity - previous.get((cart_id, item_id), 0)
+                    for item_id, delta in deltas.items():
+                        try:
+                            stock.take(item_id, delta)
+                        except OutOfStock:
+                            out_of_stock.update(key for key in shard_lines if key[1] == item_id)
+                    shard_lines = {key: quantity for key, quantity in shard_lines.items() if key not in out_of_stock}
+                    if not shard_lines:
+                        continue
+                    existing.update(key for key in previous if key in shard_lines)
+                    touched = CartItem.objects.using(shard).filter(cart__in=cart_ids, item__in={item_id for _, item_id in shard_lines})
+                    # the upsert bypasses CartItem.save() too, so count the touched lines out of the item counters and back in
+                    ItemStats.objects.using(shard).count_lines(touched, -1)
+                    CartItem.objects.using(shard).bulk_create(
+                        [CartItem(cart_id=cart_id, item_id=item_id, quantity=quantity) for (cart_id, item_id), quantity in shard_lines.items()],
+                        update_conflicts=True,
+                        unique_fields=['cart', 'item'],
+                        update_fields=['quantity', 'reserved_at'],
+                    )
+                    ItemStats.objects.using(shard).count_lines(touched)
+                    # bulk_create bypasses CartItem.save(), so recompute the stored totals of the touched carts
+                    Cart.objects.using(shard).filter(pk__in=cart_ids).refresh_totals()
+                    # and append the change events, with the ids of the cart items created by the upsert
+                    line_ids = touched.values_list('cart', 'item', 'id')
+                    CartEvent.objects.using(shard).append(
+                        (cart_id, CartEvent.UPDATED if (cart_id, item_id) in existing else CartEvent.CREATED, pk, item_id, shard_lines[(cart_id, item_id)])
+                        for cart_id, item_id, pk in line_ids if (cart_id, item_id) in shard_lines
+                    )
+        for result in results:
+            if result['status'] is None:
+                key = (result['cart'], result['item'])
+                if key in out_of_stock:
+                    result.update(status='error', errors={'quantity': [OutOfStock.default_detail]})
+                else:
+                    result['status'] = 'updated' if key in existing else 'created'
+
+        written = len(lines) - len(out_of_stock)
+        return Response({'results': results}, status=200 if written or not entries else 400)
     
     def get_queryset(self):
         queryset = CartItem.objects.all()
+        if 'item' in self.get_expand():
+            queryset = queryset.select_related('item')
         user_id = self.request.query_params.get('user', None)
         if user_id is not None:
-            queryset = queryset.filter(cart__user__id = user_id)
+            # skip the join through carts when the cart of the user is cached
+            user_cart_id = Cart.objects.id_for_user(user_id, read_through=False)
+            if user_cart_id is not None:
+                queryset = queryset.filter(cart = user_cart_id)
+            else:
+                queryset = queryset.filter(cart__user__id = user_id)
         cart_id = self.request.query_params.get('cart', None)
         if cart_id is not None:
             queryset = queryset.filter(cart__id = cart_id)
-        return queryset
+        return on_shards(queryset, pk=self.kwargs.get(self.lookup_url_kwarg or self.lookup_field) or cart_id, user=user_id)
+
+
+class DeletionJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Progress of the deletions started with DELETE ?mode=background.
+    """
+    queryset = DeletionJob.objects.all()
+    serializer_class = DeletionJobSerializer
+
+
+def export_response(request, queryset, name):
+    """
+    Stream every row of the queryset in the negotiated export format.
+    """
+    renderer = request.accepted_renderer
+    _, columns = EXPORT_COLUMNS[name]
+    response = StreamingHttpResponse(export_lines(queryset, columns, renderer.format), content_type=renderer.media_type)
+    response['Content-Disposition'] = f'attachment; filename="{name}.{renderer.format}"'
+    return response
+
+
+def _parse_cart_item_entry(entry, quantity_field):
+    """
+    Check the shape of a {cart|user, item, quantity} entry and return
+    (errors, None) or (None, (owner kind, owner id, item id, quantity)).
+    """
+    if not isinstance(entry, dict):
+        return {'non_field_errors': ['Invalid data. Expected a dictionary.']}, None
+    errors = {}
+    owner = ('user', entry['user']) if entry.get('user') is not None else ('cart', entry.get('cart'))
+    for name, value in (owner, ('item', entry.get('item'))):
+        if value is None:
+            errors[name] = ['This field is required.']
+        elif not _is_pk(value):
+            errors[name] = [f'Incorrect type. Expected pk value, received {type(value).__name__}.']
+    try:
+        quantity = quantity_field.run_validation(entry.get('quantity', serializers.empty))
+    except serializers.ValidationError as exc:
+        errors['quantity'] = exc.detail
+    if errors:
+        return errors, None
+    return None, (owner[0], int(owner[1]), int(entry['item']), quantity)
+
+
+def _pk_or_none(value):
+    return int(value) if _is_pk(value) else None
+
+
+def _is_pk(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    return isinstance(value, str) and value.isdigit()